@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Time firing events at class handlers which each want one class of event,
+# with and without those classes given as their event masks,
+# usage: bench-eventdispatch.py [handlers [events]]
+#
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.event
+
+wanted = [bb.event.ConfigParsed, bb.event.RecipeParsed, bb.event.BuildStarted,
+          bb.event.BuildCompleted, bb.event.NoProvider, bb.event.MultipleProviders,
+          bb.event.DepTreeGenerated, bb.event.TargetsTreeGenerated,
+          bb.event.RecipePreFinalise, bb.event.StampUpdate]
+
+def handler(cls):
+    def handle(e):
+        if not isinstance(e, cls):
+            return
+    return handle
+
+def dispatch(handlers, events, masked):
+    bb.event._handlers.clear()
+    bb.event._handler_masks.clear()
+    bb.event._handler_map.clear()
+    for i in xrange(handlers):
+        cls = wanted[i % len(wanted)]
+        mask = None
+        if masked:
+            mask = ["%s.%s" % (cls.__module__, cls.__name__)]
+        bb.event.register("handler%d" % i, handler(cls), mask)
+
+    fired = [bb.event.ParseProgress(1, 100), bb.event.CacheLoadProgress(1, 100),
+             bb.event.BuildStarted("world", [])]
+    start = time.time()
+    for i in xrange(events):
+        bb.event.fire_class_handlers(fired[i % len(fired)], None)
+    return (time.time() - start) / events
+
+def main(argv=None):
+    handlers = int(argv[0]) if argv else 50
+    events = int(argv[1]) if len(argv) > 1 else 20000
+    for masked in (False, True):
+        print "%d handlers, %-9s %.2fus per event" % (handlers, masked and "masked:" or "unmasked:",
+                                                      dispatch(handlers, events, masked) * 1e6)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
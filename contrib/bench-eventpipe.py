@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Time how fast the server takes log records from a task which logs heavily,
+# usage: bench-eventpipe.py [records [message length]]
+#
+# Each record is logged as a note, along with a debug message which the UI
+# does not show at the default log level
+#
+import os
+import sys
+import time
+import select
+import logging
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.event
+import bb.runqueue
+
+def worker(pipeout, records, length):
+    bb.event.worker_pid = os.getpid()
+    bb.event.worker_pipe = pipeout
+    logger = logging.getLogger("BitBake.Bench")
+    logger.propagate = False
+    logger.addHandler(bb.event.LogHandler())
+    message = "x" * length
+    for i in xrange(records):
+        logger.info("%d %s", i, message)
+        logger.debug(1, "%d %s", i, message)
+
+def main(argv=None):
+    records = int(argv[0]) if argv else 100000
+    length = int(argv[1]) if len(argv) > 1 else 100
+
+    received = [0]
+    def count(event, d):
+        if event.levelno >= logging.INFO:
+            received[0] += 1
+    bb.event.fire_ui_handlers = count
+
+    pipein, pipeout = os.pipe()
+    pipein = os.fdopen(pipein, 'rb', 4096)
+    pipeout = os.fdopen(pipeout, 'wb', 0)
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        pipein.close()
+        worker(pipeout, records, length)
+        bb.event.worker_flush()
+        os._exit(0)
+
+    pipe = bb.runqueue.runQueuePipe(pipein, pipeout, None)
+    cpu = os.times()
+    while True:
+        select.select([pipe.input], [], [], 0.5)
+        if not pipe.read() and os.waitpid(pid, os.WNOHANG)[0]:
+            break
+    pipe.close()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - sum(cpu[:2])
+
+    if received[0] != records:
+        print "Only received %d of %d records" % (received[0], records)
+        return 1
+    print "%d records of %d bytes: %.3fs, %d records/s, server cpu %.3fs" % (records, length, elapsed, records / elapsed, cpu)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
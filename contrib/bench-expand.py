@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Compare the datastore's variable expansion against the engine it
+# replaced, which expanded with regex substitutions only and dropped every
+# cached expansion on any change.  Times a synthetic datastore shaped like
+# OE's configuration with varying amounts of inline python and, when run
+# from a build directory, parsing every recipe BBFILES finds there and
+# expanding all of its variables,
+# usage: bench-expand.py [rounds]
+#
+import os
+import sys
+import time
+import random
+import logging
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.cache
+import bb.data
+import bb.data_smart
+from bb.data_smart import DataSmart, VariableParse, ExpansionError
+
+# The replaced engine, sharing VariableParse with the new one so only the
+# expansion loop and the cache invalidation differ
+def old_expandWithRefs(self, s, varname):
+    if not isinstance(s, basestring):
+        return VariableParse(varname, self, s)
+
+    if varname and varname in self.expand_cache:
+        return self.expand_cache[varname]
+
+    varparse = VariableParse(varname, self)
+    while s.find('${') != -1:
+        olds = s
+        try:
+            s = bb.data_smart.__expand_var_regexp__.sub(varparse.var_sub, s)
+            s = bb.data_smart.__expand_python_regexp__.sub(varparse.python_sub, s)
+            if s == olds:
+                break
+        except ExpansionError:
+            raise
+        except Exception as exc:
+            raise ExpansionError(varname, s, exc)
+    varparse.value = s
+
+    if varname:
+        self.expand_cache[varname] = varparse
+        # Makes every write call expand_invalidate() below
+        self.expand_volatile.add(varname)
+    return varparse
+
+def old_expand_invalidate(self, var):
+    self.expand_cache = {}
+    self.expand_volatile = set()
+
+engines = {
+    "old" : (old_expandWithRefs, old_expand_invalidate),
+    "new" : (DataSmart.expandWithRefs.im_func, DataSmart.expand_invalidate.im_func),
+}
+
+def use_engine(name):
+    DataSmart.expandWithRefs, DataSmart.expand_invalidate = engines[name]
+    bb.data_smart.__expand_tokens__.clear()
+
+common = {
+    "TOPDIR" : "/build", "TMPDIR" : "${TOPDIR}/tmp",
+    "PN" : "foo", "PV" : "1.0", "PR" : "r0", "EXTENDPE" : "",
+    "BPN" : "${PN}", "BP" : "${BPN}-${PV}",
+    "MACHINE" : "qemux86-64", "TUNE_PKGARCH" : "core2-64",
+    "PACKAGE_ARCH" : "${TUNE_PKGARCH}", "TARGET_VENDOR" : "-poky", "TARGET_OS" : "linux",
+    "MULTIMACH_TARGET_SYS" : "${PACKAGE_ARCH}${TARGET_VENDOR}-${TARGET_OS}",
+    "WORKDIR" : "${TMPDIR}/work/${MULTIMACH_TARGET_SYS}/${PN}/${EXTENDPE}${PV}-${PR}",
+    "S" : "${WORKDIR}/${BP}", "B" : "${S}", "D" : "${WORKDIR}/image",
+    "prefix" : "/usr", "exec_prefix" : "${prefix}", "bindir" : "${exec_prefix}/bin",
+    "libdir" : "${exec_prefix}/lib", "datadir" : "${prefix}/share",
+    "STAGING_DIR" : "${TMPDIR}/sysroots", "STAGING_DIR_HOST" : "${STAGING_DIR}/${MACHINE}",
+    "DISTRO_FEATURES" : "x11 wayland systemd",
+    "FEATURE_FLAGS" : "${@bb.utils.contains('DISTRO_FEATURES', 'x11', 'x', '', d)}",
+}
+
+def synthetic(python):
+    """
+    3000 variables layered over the common ones, every python'th one
+    using inline python, then 300 rounds of a write followed by 200
+    expanded reads, as in finalize and anonymous python
+    """
+    random.seed(1)
+    d = bb.data.init()
+    for var, value in common.iteritems():
+        d.setVar(var, value)
+    names = common.keys()
+    for i in xrange(3000):
+        refs = random.sample(common.keys(), 2) + random.sample(names[:len(common) + 200], 1)
+        if python and i % python == 0:
+            value = "${%s} ${@'%d'}" % (refs[0], i)
+        else:
+            value = "${%s}/x%d ${%s} ${%s}" % (refs[0], i, refs[1], refs[2])
+        d.setVar("VAR%d" % i, value)
+        names.append("VAR%d" % i)
+
+    start = time.clock()
+    for r in xrange(300):
+        d.setVar("RANDOM_%d" % r, "x")
+        if r % 10 == 0:
+            d.setVar("PR", "r%d" % r)
+        for var in random.sample(names, 200):
+            d.getVar(var, True)
+    return time.clock() - start
+
+def parse_recipes(cooker, recipes):
+    """
+    Parse each recipe and expand all its variables, as bitbake -e does
+    """
+    start = time.clock()
+    for fn in recipes:
+        datastores = bb.cache.Cache.load_bbfile(fn, cooker.get_file_appends(fn), cooker.configuration.data)
+        bb.data.emit_env(StringIO(), datastores[""], True)
+    return time.clock() - start
+
+def measure(engine, func, *args):
+    """
+    Time func in a child process, so that neither engine profits from
+    what the other left behind or pays for its garbage
+    """
+    pipein, pipeout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipein)
+        use_engine(engine)
+        os.write(pipeout, repr(func(*args)))
+        os._exit(0)
+    os.close(pipeout)
+    result = os.read(pipein, 64)
+    os.close(pipein)
+    os.waitpid(pid, 0)
+    return float(result)
+
+def compare(name, rounds, func, *args):
+    times = dict((engine, []) for engine in engines)
+    for i in xrange(rounds):
+        for engine in sorted(engines, reverse=i % 2):
+            times[engine].append(measure(engine, func, *args))
+    old, new = min(times["old"]), min(times["new"])
+    print "%-32s old %.3fs  new %.3fs  (%+.1f%%)" % (name, old, new, (new - old) * 100 / old)
+
+def main(argv=None):
+    rounds = int(argv[0]) if argv else 5
+    compare("synthetic, no python", rounds, synthetic, 0)
+    compare("synthetic, 1 in 25 python", rounds, synthetic, 25)
+    compare("synthetic, 1 in 4 python", rounds, synthetic, 4)
+
+    if os.path.exists(os.path.join("conf", "bblayers.conf")) or os.environ.get("BBPATH"):
+        import bb.tinfoil
+        tinfoil = bb.tinfoil.Tinfoil()
+        tinfoil.logger.setLevel(logging.WARNING)
+        cooker = tinfoil.cooker
+        cooker.parseConfiguration()
+        recipes = cooker.collect_bbfiles()[0]
+        compare("parsing %d recipes" % len(recipes), rounds, parse_recipes, cooker, recipes)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
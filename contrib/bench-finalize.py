@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Compare the datastore's finalize() against the one it replaced, which
+# walked the appends and prepends separately, checked every part of every
+# condition against the OVERRIDES list and set the variable once for each
+# entry that applied.  Times finalizing copies of a synthetic datastore
+# with thousands of conditional appends and prepends, and checks both
+# leave the same values and flags behind,
+# usage: bench-finalize.py [rounds [numvars [numconditionals]]]
+#
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.data
+import bb.data_smart
+from bb.data_smart import DataSmart
+
+def old_finalize(self):
+    """Performs final steps upon the datastore, including application of overrides"""
+
+    overrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
+
+    for o in overrides:
+        # calculate '_'+override
+        l = len(o) + 1
+
+        # see if one should even try
+        if o not in self._seen_overrides:
+            continue
+
+        vars = self._seen_overrides[o].copy()
+        for var in vars:
+            name = var[:-l]
+            try:
+                self.setVar(name, self.getVar(var, False))
+                self.delVar(var)
+            except Exception:
+                bb.data_smart.logger.info("Untracked delVar")
+
+    # now on to the appends and prepends
+    for op in bb.data_smart.__setvar_keyword__:
+        if op in self._special_values:
+            appends = self._special_values[op] or []
+            for append in appends:
+                keep = []
+                for (a, o) in self.getVarFlag(append, op) or []:
+                    match = True
+                    if o:
+                        for o2 in o.split("_"):
+                            if not o2 in overrides:
+                                match = False
+                    if not match:
+                        keep.append((a ,o))
+                        continue
+
+                    if op == "_append":
+                        sval = self.getVar(append, False) or ""
+                        sval += a
+                        self.setVar(append, sval)
+                    elif op == "_prepend":
+                        sval = a + (self.getVar(append, False) or "")
+                        self.setVar(append, sval)
+
+                # We save overrides that may be applied at some later stage
+                if keep:
+                    self.setVarFlag(append, op, keep)
+                else:
+                    self.delVarFlag(append, op)
+
+engines = {
+    "old" : old_finalize,
+    "new" : DataSmart.finalize.im_func,
+}
+
+overrides = ["linux", "x86-64", "qemux86-64", "class-target", "poky",
+             "libc-glibc", "forcevariable", "pn-foo", "task-compile", "virtclass"]
+inactive = ["arm", "mips", "class-native", "musl", "qemuarm"]
+
+def synthetic(numvars, numconditionals):
+    """
+    numvars variables with numconditionals appends and prepends spread over
+    them, most conditional on one or two overrides, some of which aren't
+    active
+    """
+    random.seed(1)
+    d = bb.data.init()
+    d.setVar("OVERRIDES", ":".join(overrides))
+    for i in xrange(numvars):
+        d.setVar("VAR%d" % i, "value%d" % i)
+    for i in xrange(numconditionals):
+        var = "VAR%d" % random.randrange(numvars)
+        op = random.choice(("_append", "_prepend"))
+        conditions = random.sample(overrides + inactive, random.choice((0, 1, 1, 1, 2)))
+        if conditions:
+            d.setVar("%s%s_%s" % (var, op, "_".join(conditions)), " %d" % i)
+        else:
+            d.setVar(var + op, " %d" % i)
+    return d
+
+def snapshot(d, numvars):
+    return [(d.getVar("VAR%d" % i, False), d.getVarFlag("VAR%d" % i, "_append"),
+             d.getVarFlag("VAR%d" % i, "_prepend")) for i in xrange(numvars)]
+
+def run(numvars, numconditionals, copies):
+    """
+    Finalize copies of the datastore, returning the time taken and what
+    the last copy ended up with
+    """
+    d = synthetic(numvars, numconditionals)
+    datastores = [bb.data.createCopy(d) for i in xrange(copies)]
+    start = time.clock()
+    for copy in datastores:
+        copy.finalize()
+    elapsed = time.clock() - start
+    return elapsed, hash(repr(snapshot(datastores[-1], numvars)))
+
+def measure(engine, *args):
+    """
+    Time finalize() in a child process, so that neither engine profits
+    from what the other left behind or pays for its garbage
+    """
+    pipein, pipeout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipein)
+        DataSmart.finalize = engines[engine]
+        os.write(pipeout, repr(run(*args)))
+        os._exit(0)
+    os.close(pipeout)
+    result = os.read(pipein, 64)
+    os.close(pipein)
+    os.waitpid(pid, 0)
+    return eval(result)
+
+def main(argv=None):
+    rounds = int(argv[0]) if argv else 5
+    numvars = int(argv[1]) if len(argv) > 1 else 3000
+    numconditionals = int(argv[2]) if len(argv) > 2 else 15000
+
+    times = dict((engine, []) for engine in engines)
+    results = set()
+    for i in xrange(rounds):
+        for engine in sorted(engines, reverse=i % 2):
+            elapsed, result = measure(engine, numvars, numconditionals, 20)
+            times[engine].append(elapsed)
+            results.add(result)
+    old, new = min(times["old"]), min(times["new"])
+    print "20 finalize() of %d variables with %d conditionals" % (numvars, numconditionals)
+    print "old %.3fs  new %.3fs  (%+.1f%%)" % (old, new, (new - old) * 100 / old)
+    if len(results) != 1:
+        print "The engines left different values or flags behind"
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
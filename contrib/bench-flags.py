@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Measure the memory and time the datastore's per variable records take.
+# Builds a synthetic configuration shaped like OE's, where most variables
+# only have a value and some are functions or carry flags, then copies it
+# for a number of recipes which each set, append to and flag a share of
+# the variables before finalizing. Reports the growth in RSS of a fresh
+# process for each, usage: bench-flags.py [numvars [numrecipes]]
+#
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.data
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def configuration(numvars):
+    d = bb.data.init()
+    d.setVar("OVERRIDES", "linux:x86-64:class-target")
+    for i in xrange(numvars):
+        var = "VAR%d" % i
+        d.setVar(var, "${VAR%d}/value %d" % (i // 2, i))
+        if i % 10 == 0:
+            d.setVarFlag(var, "func", 1)
+            d.setVarFlag(var, "python", 1)
+        elif i % 10 == 1:
+            d.setVarFlag(var, "doc", "The documentation of %s" % var)
+        elif i % 10 == 2:
+            d.setVarFlag(var, "export", 1)
+    return d
+
+def recipe(config, numvars, seed):
+    random.seed(seed)
+    d = bb.data.createCopy(config)
+    for i in random.sample(xrange(numvars), numvars // 10):
+        var = "VAR%d" % i
+        if i % 3 == 0:
+            d.setVar(var, "recipe value")
+        elif i % 3 == 1:
+            d.setVar(var + "_append", " appended")
+            d.setVar(var + "_append_linux", " conditionally appended")
+        else:
+            d.setVarFlag(var, "vardeps", "VAR%d" % (i // 2))
+    d.finalize()
+    return d
+
+def measure(numvars, numrecipes):
+    """
+    Build the datastores in a child process, so the numbers aren't skewed
+    by what an earlier run left behind
+    """
+    pipein, pipeout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipein)
+        before = rss()
+        start = time.time()
+        config = configuration(numvars)
+        configtime = time.time() - start
+        configrss = rss() - before
+        start = time.time()
+        recipes = [recipe(config, numvars, i) for i in xrange(numrecipes)]
+        recipetime = time.time() - start
+        reciperss = rss() - before - configrss
+        os.write(pipeout, repr((configrss, configtime, reciperss, recipetime)))
+        os._exit(0)
+    os.close(pipeout)
+    result = os.read(pipein, 256)
+    os.close(pipein)
+    os.waitpid(pid, 0)
+    return eval(result)
+
+def main(argv=None):
+    numvars = int(argv[0]) if argv else 10000
+    numrecipes = int(argv[1]) if len(argv) > 1 else 6
+
+    configrss, configtime, reciperss, recipetime = measure(numvars, numrecipes)
+    print "configuration, %d variables    %6.1f MiB  %.3fs" % (numvars, configrss / 1048576.0, configtime)
+    print "%d recipe copies                  %6.1f MiB  %.3fs" % (numrecipes, reciperss / 1048576.0, recipetime)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
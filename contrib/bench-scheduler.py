@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Time the construction of the runqueue schedulers over synthetic task
+# graphs, usage: bench-scheduler.py [numtasks ...]
+#
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.runqueue
+
+class SyntheticRunQueueData(object):
+    """
+    Tasks spread over recipes of around 30 tasks each, weighted like a real
+    build where a few tasks are needed by most of the others
+    """
+    def __init__(self, numtasks):
+        self.runq_fnid = [task // 30 for task in xrange(numtasks)]
+        self.runq_weight = [int(random.paretovariate(1.2)) for task in xrange(numtasks)]
+
+def main(argv=None):
+    sizes = [int(arg) for arg in argv] or [10000, 30000, 100000]
+    random.seed(0)
+    for numtasks in sizes:
+        rqdata = SyntheticRunQueueData(numtasks)
+        for scheduler in (bb.runqueue.RunQueueSchedulerSpeed, bb.runqueue.RunQueueSchedulerCompletion):
+            start = time.time()
+            scheduler(None, rqdata)
+            print "%-10s %7d tasks: %.3fs" % (scheduler.name, numtasks, time.time() - start)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
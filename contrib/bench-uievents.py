@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Time sending events from an xmlrpc server to a UI in another process on
+# this machine, with and without compression,
+# usage: bench-uievents.py [events]
+#
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.event
+import bb.server.xmlrpc
+from bb.ui import uievent
+
+def server(xmlrpcserver, events):
+    logger = logging.getLogger("BitBake.Bench")
+    record = logger.makeRecord("BitBake.Bench", logging.INFO, __file__, 0, "%s", ("x" * 100,), None)
+    fired = [bb.event.ParseProgress(1, 100), record]
+    sent = [0]
+
+    def fire(server, data, abort):
+        if abort or sent[0] >= events:
+            return False
+        if bb.event._ui_handlers:
+            # Like a server busy parsing or building, fire a few events at
+            # a time between requests
+            for i in xrange(100):
+                bb.event.fire_ui_handlers(fired[i % 2], None)
+            sent[0] += 100
+            return True
+        return 0.1
+
+    xmlrpcserver.register_idle_function(fire, None)
+    xmlrpcserver._serve_forever()
+
+def bench(events, compress):
+    xmlrpcserver = bb.server.xmlrpc.BitBakeXMLRPCServer(("localhost", 0))
+    pid = os.fork()
+    if pid == 0:
+        server(xmlrpcserver, events)
+        os._exit(0)
+    host, port = xmlrpcserver.host, xmlrpcserver.port
+    xmlrpcserver.server_close()
+
+    connection = bb.server.xmlrpc._create_server(host, port)
+    start = time.time()
+    queue = uievent.BBUIEventQueue(connection, ("localhost", 0), compress)
+    received = 0
+    while received < events:
+        if queue.waitEvent(5) is None:
+            break
+        received += 1
+    elapsed = time.time() - start
+    queue.system_quit()
+    connection.terminateServer()
+    os.waitpid(pid, 0)
+    return received, elapsed
+
+def main(argv=None):
+    events = int(argv[0]) if argv else 100000
+    for compress in (False, True):
+        received, elapsed = bench(events, compress)
+        if received != events:
+            print "Only received %d of %d events" % (received, events)
+            return 1
+        print "%d events, %-13s %.3fs, %d events/s" % (events, compress and "compressed:" or "uncompressed:",
+                                                      elapsed, events / elapsed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
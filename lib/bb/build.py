@@ -189,11 +189,14 @@ def exec_func(func, d, dirs = None):
     runfile = os.path.join(tempdir, runfn)
     bb.utils.mkdirhier(os.path.dirname(runfile))
 
-    with bb.utils.fileslocked(lockfiles):
-        if ispython:
-            exec_func_python(func, d, runfile, cwd=adir)
-        else:
-            exec_func_shell(func, d, runfile, cwd=adir)
+    try:
+        with bb.utils.fileslocked(lockfiles):
+            if ispython:
+                exec_func_python(func, d, runfile, cwd=adir)
+            else:
+                exec_func_shell(func, d, runfile, cwd=adir)
+    finally:
+        bb.event.worker_flush()
 
 _functionfmt = """
 def {function}(d):
@@ -31,6 +31,9 @@
 
 import os
 import logging
+import mmap
+import time
+import struct
 from collections import defaultdict
 import bb.utils
 
@@ -43,7 +46,7 @@ except ImportError:
     logger.info("Importing cPickle failed. "
                 "Falling back to a very slow implementation.")
 
-__cache_version__ = "145"
+__cache_version__ = "150"
 
 def getCacheFile(path, filename, data_hash):
     return os.path.join(path, filename + "." + data_hash)
@@ -93,6 +96,8 @@ class CoreRecipeInfo(RecipeInfoCommon):
     __slots__ = ()
 
     cachefile = "bb_cache.dat"   
+    # Seconds taken to parse the recipe file, set by Cache.parse()
+    parsetime = None
 
     def __init__(self, filename, metadata):      
         self.file_depends = metadata.getVar('__depends', False)
@@ -253,6 +258,301 @@ class CoreRecipeInfo(RecipeInfoCommon):
         cachedata.fakerootdirs[fn] = self.fakerootdirs
 
 
+class IndexedCacheFile(object):
+    """
+    On-disk store for the records of one RecipeInfo class
+
+    The file holds a sequence of pickled records followed by a pickled
+    index which maps each virtual filename to the offset and length of
+    its record, plus the cache and bitbake versions.  A fixed size
+    trailer at the end of the file points at the index.
+
+    Changes are not written to the file itself but appended to a
+    journal next to it, one record per added or removed entry.  Once
+    the journal grows past a limit, the two are compacted back into a
+    single file.  Each compacted file gets a new generation number and
+    the journal starts with the generation it applies to, so a journal
+    left over from before a compaction is never replayed.
+
+    Both files are mapped with mmap and records are only unpickled when
+    they are first asked for.
+    """
+
+    trailer = struct.Struct("<Q8s")
+    magic = "BBCACHE2"
+    # Journal record header: key length and pickled data length.  A
+    # zero data length marks the removal of the key.
+    record = struct.Struct("<II")
+    # Journal header: the generation of the cache file it applies to
+    journalheader = struct.Struct("<Q")
+
+    def __init__(self, cachefile):
+        self.cachefile = cachefile
+        self.journalfile = cachefile + ".journal"
+        self.index = {}
+        self.journal = {}
+        self.size = 0
+        self.generation = 0
+        self.journalsize = 0
+        self.valid = False
+        self.map = None
+        self.journalmap = None
+
+    def load(self):
+        try:
+            f = open(self.cachefile, "rb")
+        except IOError:
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.trailer.size:
+                logger.info('Invalid cache, rebuilding...')
+                return
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        indexoffset, magic = self.trailer.unpack(self.map[size - self.trailer.size:])
+        try:
+            if magic != self.magic or indexoffset > size:
+                raise ValueError("bad cache trailer")
+            header = pickle.loads(self.map[indexoffset:size - self.trailer.size])
+            cache_ver, bitbake_ver = header[:2]
+        except Exception:
+            logger.info('Invalid cache, rebuilding...')
+            self.close()
+            return
+
+        if cache_ver != __cache_version__:
+            logger.info('Cache version mismatch, rebuilding...')
+            self.close()
+            return
+        elif bitbake_ver != bb.__version__:
+            logger.info('Bitbake version mismatch, rebuilding...')
+            self.close()
+            return
+
+        self.generation, self.index = header[2:]
+        self.size = size
+        self.valid = True
+        self.load_journal()
+
+    def load_journal(self):
+        try:
+            f = open(self.journalfile, "rb")
+        except IOError:
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.journalheader.size:
+                return
+            self.journalmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        generation, = self.journalheader.unpack_from(self.journalmap, 0)
+        if generation != self.generation:
+            # Written against an older cache file, the next append
+            # starts the journal afresh
+            self.journalmap.close()
+            self.journalmap = None
+            return
+
+        # Only the record headers and keys are read, a truncated record
+        # at the end (from an interrupted sync) is ignored
+        offset = self.journalheader.size
+        while offset + self.record.size <= size:
+            keylen, datalen = self.record.unpack_from(self.journalmap, offset)
+            keyoffset = offset + self.record.size
+            end = keyoffset + keylen + datalen
+            if end > size:
+                break
+            key = self.journalmap[keyoffset:keyoffset + keylen]
+            if datalen:
+                self.journal[key] = (keyoffset + keylen, datalen)
+            else:
+                self.journal[key] = None
+            offset = end
+        self.journalsize = offset
+
+    def close(self):
+        for m in (self.map, self.journalmap):
+            if m is not None:
+                m.close()
+        self.map = None
+        self.journalmap = None
+        self.index = {}
+        self.journal = {}
+        self.valid = False
+
+    def __contains__(self, key):
+        if key in self.journal:
+            return self.journal[key] is not None
+        return key in self.index
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        keys = set(self.index)
+        for key, location in self.journal.iteritems():
+            if location is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return list(keys)
+
+    def raw(self, key):
+        if key in self.journal:
+            location, m = self.journal[key], self.journalmap
+            if location is None:
+                raise KeyError(key)
+        else:
+            location, m = self.index[key], self.map
+        offset, length = location
+        return m[offset:offset + length]
+
+    def get(self, key):
+        return pickle.loads(self.raw(key))
+
+    def update(self, changed, removed, limit=None):
+        """
+        Record the entries in changed and the removal of the keys in
+        removed, compacting the journal if it has grown past limit bytes
+        (by default half the size of the cache file)
+        """
+        removed = [key for key in removed if key in self]
+        if not changed and not removed:
+            return
+
+        if not self.valid:
+            self.rewrite(changed, removed)
+            return
+
+        records = []
+        for key, info in changed.iteritems():
+            data = pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+            records.append(self.record.pack(len(key), len(data)) + key + data)
+        for key in removed:
+            records.append(self.record.pack(len(key), 0) + key)
+
+        if limit is None:
+            limit = self.size / 2
+        if self.journalsize + sum(len(r) for r in records) > limit:
+            self.rewrite(changed, removed)
+            return
+
+        with open(self.journalfile, "ab") as f:
+            # Drop any partial record left by an interrupted sync, or a
+            # stale journal from an earlier generation
+            f.truncate(self.journalsize)
+            f.seek(self.journalsize)
+            if not self.journalsize:
+                records.insert(0, self.journalheader.pack(self.generation))
+            f.write("".join(records))
+
+    def rewrite(self, changed, removed):
+        """
+        Write out a compacted copy of the file with the journal and the
+        given changes folded in, copying unchanged records across
+        without unpickling them
+        """
+        index = {}
+        removed = set(removed)
+        # A random generation, so that a journal left behind by a cache
+        # file which has since been deleted can't match either
+        generation, = self.journalheader.unpack(os.urandom(self.journalheader.size))
+        tmpfile = "%s.%s" % (self.cachefile, os.getpid())
+        with open(tmpfile, "wb") as f:
+            for key in self.keys():
+                if key in removed or key in changed:
+                    continue
+                data = self.raw(key)
+                index[key] = (f.tell(), len(data))
+                f.write(data)
+            for key, info in changed.iteritems():
+                data = pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+                index[key] = (f.tell(), len(data))
+                f.write(data)
+            indexoffset = f.tell()
+            f.write(pickle.dumps((__cache_version__, bb.__version__, generation, index),
+                                 pickle.HIGHEST_PROTOCOL))
+            f.write(self.trailer.pack(indexoffset, self.magic))
+        # The old journal no longer matches the generation of the new
+        # file, so it is ignored if we crash before removing it
+        os.rename(tmpfile, self.cachefile)
+        bb.utils.remove(self.journalfile)
+
+
+class DependsCache(object):
+    """
+    Mapping of virtual filenames to RecipeInfo arrays backed by one
+    IndexedCacheFile per cache class
+
+    Entries are read from the cache files on first access.  Entries
+    which are added or removed afterwards are tracked so that only those
+    need to be written back out.
+    """
+
+    def __init__(self, cachefiles):
+        # One IndexedCacheFile per RecipeInfo class, CoreRecipeInfo first
+        self.cachefiles = cachefiles
+        self.loaded = {}
+        self.changed = set()
+        self.removed = set()
+
+    def __contains__(self, key):
+        if key in self.loaded:
+            return True
+        if key in self.removed or not self.cachefiles:
+            return False
+        return key in self.cachefiles[0]
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if key not in self:
+            raise KeyError(key)
+        info_array = [cachefile.get(key) for cachefile in self.cachefiles
+                                         if key in cachefile]
+        self.loaded[key] = info_array
+        return info_array
+
+    def __setitem__(self, key, info_array):
+        if self.loaded.get(key) is not info_array:
+            self.changed.add(key)
+        self.loaded[key] = info_array
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    def keys(self):
+        keys = set(self.loaded)
+        if self.cachefiles:
+            keys.update(key for key in self.cachefiles[0].keys()
+                            if key not in self.removed)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def close(self):
+        for cachefile in self.cachefiles:
+            cachefile.close()
+        self.loaded = {}
+
 
 class Cache(object):
     """
@@ -272,6 +572,12 @@ class Cache(object):
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
+        # How long recipes found to be out of date took to parse last time
+        self.parsetimes = {}
+        # Size in bytes at which the cache journals get compacted
+        self.journal_limit = data.getVar("BB_CACHE_JOURNAL_LIMIT", True)
+        if self.journal_limit:
+            self.journal_limit = int(self.journal_limit)
 
         if self.cachedir in [None, '']:
             self.has_cache = False
@@ -285,75 +591,40 @@ class Cache(object):
         logger.debug(1, "Using cache in '%s'", self.cachedir)
         bb.utils.mkdirhier(self.cachedir)
 
-        cache_ok = True
-        if self.caches_array:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                    cache_ok = cache_ok and os.path.exists(cachefile)
-                    cache_class.init_cacheData(self)
-        if cache_ok:
+        cachefiles = []
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
+                cachefiles.append(IndexedCacheFile(cachefile))
+                cache_class.init_cacheData(self)
+        self.depends_cache = DependsCache(cachefiles)
+
+        if all(os.path.exists(cachefile.cachefile) for cachefile in cachefiles):
             self.load_cachefile()
         elif os.path.isfile(self.cachefile):
             logger.info("Out of date cache found, rebuilding...")
 
     def load_cachefile(self):
-        # Firstly, using core cache file information for
-        # valid checking
-        with open(self.cachefile, "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
-            try:
-                cache_ver = pickled.load()
-                bitbake_ver = pickled.load()
-            except Exception:
-                logger.info('Invalid cache, rebuilding...')
-                return
-
-            if cache_ver != __cache_version__:
-                logger.info('Cache version mismatch, rebuilding...')
-                return
-            elif bitbake_ver != bb.__version__:
-                logger.info('Bitbake version mismatch, rebuilding...')
-                return
-
+        # Only the indexes are read here, the records themselves are
+        # unpickled on demand as the parser asks for them
+        cachefiles = self.depends_cache.cachefiles
+        cachesize = sum(os.path.getsize(cachefile.cachefile) for cachefile in cachefiles)
 
-        cachesize = 0
-        previous_progress = 0
-        previous_percent = 0
+        bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
 
-        # Calculate the correct cachesize of all those cache files
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
+        current_progress = 0
+        for cachefile in cachefiles:
+            cachefile.load()
+            if not cachefile.valid:
+                break
+            current_progress += cachefile.size
+            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
+                          self.data)
 
-        bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
-        
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    pickled = pickle.Unpickler(cachefile)                    
-                    while cachefile:
-                        try:
-                            key = pickled.load()
-                            value = pickled.load()
-                        except Exception:
-                            break
-                        if self.depends_cache.has_key(key):
-                            self.depends_cache[key].append(value)
-                        else:
-                            self.depends_cache[key] = [value]
-                        # only fire events on even percentage boundaries
-                        current_progress = cachefile.tell() + previous_progress
-                        current_percent = 100 * current_progress / cachesize
-                        if current_percent > previous_percent:
-                            previous_percent = current_percent
-                            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
-                                          self.data)
-
-                    previous_progress += current_progress
+        # If any one of the cache files is unusable, rebuild them all
+        if not all(cachefile.valid for cachefile in cachefiles):
+            for cachefile in cachefiles:
+                cachefile.close()
 
         # Note: depends cache number is corresponding to the parsing file numbers.
         # The same file has several caches, still regarded as one item in the cache
@@ -361,7 +632,6 @@ class Cache(object):
                                                   len(self.depends_cache)),
                       self.data)
 
-    
     @staticmethod
     def virtualfn2realfn(virtualfn):
         """
@@ -404,6 +674,7 @@ class Cache(object):
     def parse(cls, filename, appends, configdata, caches_array):
         """Parse the specified filename, returning the recipe information"""
         infos = []
+        starttime = time.time()
         datastores = cls.load_bbfile(filename, appends, configdata)
         depends = set()
         for variant, data in sorted(datastores.iteritems(),
@@ -421,6 +692,11 @@ class Cache(object):
                     info_array.append(info)
             infos.append((virtualfn, info_array))
 
+        # Kept so the next parse can schedule the slowest recipes first
+        parsetime = time.time() - starttime
+        for _, info_array in infos:
+            info_array[0].parsetime = parsetime
+
         return infos
 
     def load(self, filename, appends, configdata):
@@ -462,6 +738,24 @@ class Cache(object):
 
         return cached, skipped, virtuals
 
+    def prefetchMtimes(self, filelist, threads):
+        """
+        Stat every file in filelist and every file their cache entries
+        depend on up front, once per unique path and in parallel, so
+        the cacheValid() checks that follow only hit the mtime cache
+        """
+        if not self.has_cache:
+            return
+
+        files = set(filelist)
+        for fn in filelist:
+            if fn in self.depends_cache:
+                depends = self.depends_cache[fn][0].file_depends
+                if depends:
+                    files.update(f for f, _ in depends)
+
+        bb.parse.cached_mtime_prefetch(files, threads)
+
     def cacheValid(self, fn, appends):
         """
         Is the cache valid for fn?
@@ -562,6 +856,9 @@ class Cache(object):
         """
         if fn in self.depends_cache:
             logger.debug(1, "Removing %s from cache", fn)
+            parsetime = self.depends_cache[fn][0].parsetime
+            if parsetime is not None:
+                self.parsetimes[fn] = parsetime
             del self.depends_cache[fn]
         if fn in self.clean:
             logger.debug(1, "Marking %s as unclean", fn)
@@ -580,31 +877,19 @@ class Cache(object):
             logger.debug(2, "Cache is clean, not saving.")
             return
 
-        file_dict = {}
-        pickler_dict = {}
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
-
-        try:
-            for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
-        finally:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
-
+        # Only the entries parsed or removed during this run are appended
+        # to the journals, which are compacted once they grow too large.
+        # This runs in a thread alongside the build (see CookerParser).
+        depends_cache = self.depends_cache
+        for i, cachefile in enumerate(depends_cache.cachefiles):
+            changed = {}
+            for key in depends_cache.changed:
+                info_array = depends_cache.loaded[key]
+                if i < len(info_array):
+                    changed[key] = info_array[i]
+            cachefile.update(changed, depends_cache.removed, self.journal_limit)
+
+        depends_cache.close()
         del self.depends_cache
 
     @staticmethod
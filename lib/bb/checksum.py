@@ -66,7 +66,7 @@ class FileChecksumCache(MultiProcessCache):
         MultiProcessCache.__init__(self)
 
     def get_checksum(self, f):
-        entry = self.cachedata[0].get(f)
+        entry = self.cachedata_extras[0].get(f) or self.cachedata[0].get(f)
         cmtime = self.mtime_cache.cached_mtime(f)
         if entry:
             (mtime, hashval) = entry
@@ -1,6 +1,9 @@
 import ast
 import codegen
 import logging
+import marshal
+import hashlib
+import sys
 import os.path
 import bb.utils, bb.data
 from itertools import chain
@@ -35,14 +38,17 @@ def check_indent(codestr):
 
 class CodeParserCache(MultiProcessCache):
     cache_file_name = "bb_codeparser.dat"
-    CACHE_VERSION = 2
+    CACHE_VERSION = 4
+    DEPS_PER_FUNCTION = 4
 
     def __init__(self):
         MultiProcessCache.__init__(self)
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
+        self.depcache = self.cachedata[2]
         self.pythoncacheextras = self.cachedata_extras[0]
         self.shellcacheextras = self.cachedata_extras[1]
+        self.depcacheextras = self.cachedata_extras[2]
 
     def init_cache(self, d):
         MultiProcessCache.init_cache(self, d)
@@ -50,6 +56,24 @@ class CodeParserCache(MultiProcessCache):
         # cachedata gets re-assigned in the parent
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
+        self.depcache = self.cachedata[2]
+
+    def get_deps(self, h):
+        # Entries made by this process are newer than the ones loaded
+        return chain(self.depcacheextras.get(h, ()), self.depcache.get(h, ()))
+
+    def add_deps(self, h, entry):
+        entries = self.depcacheextras.setdefault(h, [])
+        entries.insert(0, entry)
+        del entries[self.DEPS_PER_FUNCTION:]
+
+    def merge_data(self, source, dest):
+        MultiProcessCache.merge_data(self, source[:2], dest[:2])
+        # A function gets an entry for each way it has been found to
+        # expand, so keep those of both, newest first
+        for h, entries in source[2].iteritems():
+            merged = entries + [e for e in dest[2].get(h, ()) if e not in entries]
+            dest[2][h] = merged[:self.DEPS_PER_FUNCTION]
 
     def compress_keys(self, data):
         # When the dicts are originally created, python calls intern() on the set keys
@@ -66,10 +90,14 @@ class CodeParserCache(MultiProcessCache):
             data[0][h]["execs"] = self.internSet(data[0][h]["execs"])
         for h in data[1]:
             data[1][h]["execs"] = self.internSet(data[1][h]["execs"])
+        for h in data[2]:
+            for entry in data[2][h]:
+                entry["refs"] = self.internSet(entry["refs"])
+                entry["execs"] = self.internSet(entry["execs"])
         return
 
     def create_cachedata(self):
-        data = [{}, {}]
+        data = [{}, {}, {}]
         return data
 
 codeparsercache = CodeParserCache()
@@ -83,6 +111,69 @@ def parser_cache_save(d):
 def parser_cache_savemerge(d):
     codeparsercache.save_merge(d)
 
+class CompileCache(MultiProcessCache):
+    """
+    Marshalled code objects from bb.utils.better_compile, keyed by a hash
+    of the source and the name it was compiled under, so that functions
+    shared between recipes are compiled once rather than in every parser
+    and task process
+    """
+    cache_file_name = "bb_compile.dat"
+    # Marshalled code is only readable by the same python version
+    CACHE_VERSION = (1, sys.hexversion)
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.code = self.cachedata[0]
+        self.codeextras = self.cachedata_extras[0]
+        self.codeobjects = {}
+
+    def init_cache(self, d):
+        MultiProcessCache.init_cache(self, d)
+
+        # cachedata gets re-assigned in the parent
+        self.code = self.cachedata[0]
+        self.codeobjects = {}
+
+    def save_extras(self, d):
+        if self.codeextras:
+            MultiProcessCache.save_extras(self, d)
+
+    def forked(self):
+        """
+        Count the entries a forked process inherited as known, so that it
+        only saves the ones it adds itself
+        """
+        self.code.update(self.codeextras)
+        self.codeextras.clear()
+
+    def get(self, text, filename, mode):
+        h = hashlib.md5("%s\0%s\0%s" % (filename, mode, text)).hexdigest()
+        code = self.codeobjects.get(h)
+        if code is None:
+            marshalled = self.code.get(h) or self.codeextras.get(h)
+            if marshalled is not None:
+                code = self.codeobjects[h] = marshal.loads(marshalled)
+        return h, code
+
+    def add(self, h, code):
+        self.codeobjects[h] = code
+        self.codeextras[h] = marshal.dumps(code)
+
+compilecache = CompileCache()
+
+def compile_cache_init(d):
+    compilecache.init_cache(d)
+
+def compile_cache_save(d):
+    compilecache.save_extras(d)
+
+def compile_cache_savemerge(d):
+    compilecache.save_merge(d)
+
+def compile_cache_forked():
+    compilecache.forked()
+
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
     def __init__(self, name, level=0, target=None):
@@ -76,6 +76,7 @@ class Command:
             return None, "Busy (%s in progress)" % self.currentAsyncCommand[0]
         if command not in CommandsAsync.__dict__:
             return None, "No such command"
+        self.cooker.handle_file_changes()
         self.currentAsyncCommand = (command, commandline)
         self.cooker.server_registration_cb(self.cooker.runCommands, self.cooker)
         return True, None
@@ -197,6 +198,34 @@ class CommandsSync:
         filterfunc = params[0]
         bb.parse.parse_py.ConfHandler.confFilters.append(filterfunc)
 
+    def setEventMask(self, command, params):
+        """
+        Only send a UI the events of the classes named in a list, given
+        the number of its event handler or None for every UI
+        """
+        handlerNum = params[0]
+        mask = params[1]
+        if handlerNum is None:
+            for handlerNum in bb.event._ui_handlers.keys():
+                bb.event.set_UIHmask(handlerNum, mask)
+        else:
+            bb.event.set_UIHmask(handlerNum, mask)
+
+    def setLogLevels(self, command, params):
+        """
+        Set the log level and the levels of the debug domains a UI shows,
+        given the number of its event handler or None for every UI, so
+        that tasks don't send it log records it would drop
+        """
+        handlerNum = params[0]
+        level = params[1]
+        debug_domains = params[2]
+        if handlerNum is None:
+            for handlerNum in bb.event._ui_handlers.keys():
+                bb.event.set_UIHloglevels(handlerNum, level, debug_domains)
+        else:
+            bb.event.set_UIHloglevels(handlerNum, level, debug_domains)
+
 class CommandsAsync:
     """
     A class of asynchronous commands
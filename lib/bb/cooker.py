@@ -39,6 +39,11 @@ from bb import utils, data, parse, event, cache, providers, taskdata, runqueue
 import Queue
 import prserv.serv
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 logger      = logging.getLogger("BitBake")
 collectlog  = logging.getLogger("BitBake.Collection")
 buildlog    = logging.getLogger("BitBake.Build")
@@ -63,6 +68,20 @@ class CollectionError(bb.BBHandledException):
 class state:
     initial, parsing, running, shutdown, stop = range(5)
 
+def globroot(pattern):
+    """
+    Return the directory a glob pattern starts searching from
+    """
+    parts = pattern.split(os.sep)
+    for i, part in enumerate(parts):
+        if glob.has_magic(part):
+            if i == 0:
+                return os.curdir
+            return os.sep.join(parts[:i]) or os.sep
+    if os.path.isdir(pattern):
+        return pattern
+    return os.path.dirname(pattern)
+
 
 class SkippedPackage:
     def __init__(self, info = None, reason = None):
@@ -79,6 +98,116 @@ class SkippedPackage:
         elif reason:
             self.skipreason = reason
 
+class FileWatcher(object):
+    """
+    Watches files, and whole directory trees such as layers, with inotify
+    and reports which of them changed since it was last asked
+    """
+
+    mask = 0
+    if pyinotify:
+        mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+
+    ignored = ('SCCS', 'CVS', '.svn', '.git')
+
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+        self.trees = set()
+        self.modified = set()
+        self.overflow = False
+        self.failed = False
+        self.watcher = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watcher, self.notification)
+
+    def notification(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if event.dir and event.mask & pyinotify.IN_MOVED_TO and self.in_tree(event.pathname):
+            # Only created directories get watched automatically
+            self.add_tree(event.pathname)
+        self.modified.add(event.pathname)
+
+    def excluded(self, path):
+        return os.path.basename(path) in self.ignored
+
+    def in_tree(self, path):
+        for tree in self.trees:
+            if path == tree or path.startswith(tree + os.sep):
+                return True
+        return False
+
+    def watch(self, path, **kwargs):
+        wds = self.watcher.add_watch(path, self.mask, quiet=True, **kwargs)
+        for wd in wds.values():
+            if wd < 0:
+                # Out of watches or not allowed to read the directory, so
+                # changes below path would go unnoticed
+                self.failed = True
+
+    def add_files(self, files):
+        """
+        Watch the directories holding files for changes to those files
+        """
+        for f in files:
+            if f in self.files:
+                continue
+            self.files.add(f)
+            self.add_dirs([os.path.dirname(f)])
+
+    def add_dirs(self, dirs):
+        """
+        Watch the entries of directories, but not the ones below them
+        """
+        for dirname in dirs:
+            if dirname in self.dirs or self.in_tree(dirname):
+                continue
+            self.dirs.add(dirname)
+            self.watch(dirname)
+
+    def add_tree(self, path):
+        """
+        Watch every directory below path, including ones created later, so
+        that new recipes anywhere in it are noticed
+        """
+        path = os.path.abspath(path)
+        if not os.path.isdir(path) or self.excluded(path):
+            return
+        self.trees.add(path)
+        self.watch(path, rec=True, auto_add=True, exclude_filter=self.excluded)
+
+    def add_trees(self, paths):
+        for path in paths:
+            if not self.in_tree(os.path.abspath(path)):
+                self.add_tree(path)
+
+    def changes(self):
+        """
+        Return the watched files, recipes and directories which changed
+        since the last call, and whether any events were lost
+        """
+        while self.notifier.check_events(timeout=0):
+            self.notifier.read_events()
+        self.notifier.process_events()
+
+        changed = set()
+        for f in self.modified:
+            if f in self.files or f.endswith((".bb", ".bbappend")):
+                changed.add(f)
+            elif self.in_tree(f) and os.path.isdir(f) and not self.excluded(f):
+                # A new directory may hold recipes which BBFILES matches
+                changed.add(f)
+        self.modified = set()
+
+        overflow, self.overflow = self.overflow, False
+        return changed, overflow
+
+    def close(self):
+        self.notifier.stop()
+
 #============================================================================#
 # BBCooker
 #============================================================================#
@@ -96,6 +225,17 @@ class BBCooker:
 
         self.configuration = configuration
 
+        # When the server stays resident and pyinotify is available, watch
+        # the layers, the directories BBFILES searches, the configuration
+        # and everything the recipes include so that the cooker knows which
+        # files changed between commands rather than having to stat them
+        # all again
+        self.inotify_config_files = set()
+        if pyinotify and configuration.server_only:
+            self.watcher = FileWatcher()
+        else:
+            self.watcher = None
+
         # Keep a datastore of the initial environment variables and their
         # values from when BitBake was launched to enable child processes
         # to use environment variables which have been cleaned from the
@@ -175,6 +315,67 @@ class BBCooker:
 
         self.parser = None
 
+    def add_filewatch(self, files):
+        """
+        Watch the directories holding files for changes to those files
+        """
+        if self.watcher:
+            self.watcher.add_files(files)
+            if self.watcher.failed:
+                self.drop_watcher()
+
+    def drop_watcher(self):
+        """
+        Some files couldn't be watched, so changes to them would be missed.
+        Stop using inotify and revalidate everything from the files again,
+        as a cooker without it does.
+        """
+        collectlog.warn("Unable to watch all files for changes, checking them on every parse instead")
+        self.watcher.close()
+        self.watcher = None
+        bb.parse.clear_mtime_cache()
+        bb.parse.BBHandler.cached_statements.clear()
+
+    def handle_file_changes(self):
+        """
+        Process the changes inotify has reported since the last call.
+        Changed files are dropped from the mtime and statement caches and
+        the cooker is sent back to parse, so the next command needing the
+        cache only revalidates and reparses the recipes they affect.  A
+        configuration change means reparsing the configuration too.
+        """
+        if not self.watcher:
+            return
+
+        changed, overflow = self.watcher.changes()
+        if self.watcher.failed:
+            # A directory created since the last command couldn't be watched
+            self.drop_watcher()
+            self.reset()
+            return
+
+        if overflow:
+            # Events were dropped so none of the cached state can be trusted
+            collectlog.debug(1, "inotify queue overflowed, rechecking all files")
+            bb.parse.clear_mtime_cache()
+            bb.parse.BBHandler.cached_statements.clear()
+            self.reset()
+            return
+
+        if not changed:
+            return
+
+        for f in changed:
+            collectlog.debug(1, "%s changed", f)
+            bb.parse.invalidate_mtime(f)
+            bb.parse.BBHandler.cached_statements.pop(f, None)
+        bb.parse.BBHandler.inherit_snapshots.clear()
+
+        if changed & self.inotify_config_files:
+            self.reset()
+        elif self.state == state.running:
+            self.state = state.initial
+
     def initConfigurationData(self):
         self.configuration.data = bb.data.init()
 
@@ -222,6 +423,7 @@ class BBCooker:
         if self.status:
             del self.status
         self.status = bb.cache.CacheData(self.caches_array)
+        self.skiplist = {}
 
         self.handleCollections( self.configuration.data.getVar("BBFILE_COLLECTIONS", True) )
 
@@ -876,17 +1078,22 @@ class BBCooker:
         # Nomally we only register event handlers at the end of parsing .bb files
         # We register any handlers we've found so far here...
         for var in data.getVar('__BBHANDLERS') or []:
-            bb.event.register(var, data.getVar(var))
+            bb.event.register(var, data.getVar(var), (data.getVarFlag(var, "eventmask", True) or "").split())
 
         if data.getVar("BB_WORKERCONTEXT", False) is None:
             bb.fetch.fetcher_init(data)
         bb.codeparser.parser_cache_init(data)
+        bb.codeparser.compile_cache_init(data)
+        bb.parse.BBHandler.statement_cache_init(data)
         bb.event.fire(bb.event.ConfigParsed(), data)
         bb.parse.init_parser(data)
         data.setVar('BBINCLUDED',bb.parse.get_file_depends(data))
         self.configuration.data = data
         self.configuration.data_hash = data.get_hash()
 
+        self.inotify_config_files = set(f for f, _ in data.getVar('__depends') or [])
+        self.add_filewatch(self.inotify_config_files)
+
     def handleCollections( self, collections ):
         """Handle collections"""
         errors = False
@@ -1053,6 +1260,7 @@ class BBCooker:
         self.buildSetVars()
 
         self.status = bb.cache.CacheData(self.caches_array)
+        self.skiplist = {}
         infos = bb.cache.Cache.parse(fn, self.get_file_appends(fn), \
                                      self.configuration.data,
                                      self.caches_array)
@@ -1113,7 +1321,7 @@ class BBCooker:
                 self.command.finishAsyncCommand()
                 return False
 
-            if not retval:
+            if retval is False or retval is None:
                 bb.event.fire(bb.event.BuildCompleted(len(rq.rqdata.runq_fnid), buildname, item, failures), self.configuration.event_data)
                 self.command.finishAsyncCommand()
                 return False
@@ -1153,7 +1361,8 @@ class BBCooker:
                 self.command.finishAsyncCommand()
                 return False
 
-            if not retval:
+            # An empty list of file descriptors to wait on isn't the end
+            if retval is False or retval is None:
                 bb.event.fire(bb.event.BuildCompleted(len(rq.rqdata.runq_fnid), buildname, targets, failures), self.configuration.data)
                 self.command.finishAsyncCommand()
                 return False
@@ -1204,6 +1413,11 @@ class BBCooker:
             (filelist, masked) = self.collect_bbfiles()
             self.configuration.data.renameVar("__depends", "__base_depends")
 
+            # The cache from any previous parse must be fully written out
+            # before it is loaded again
+            if self.parser and self.parser.syncthread:
+                self.parser.syncthread.join()
+
             self.parser = CookerParser(self, filelist, masked)
             self.state = state.parsing
 
@@ -1280,6 +1494,25 @@ class BBCooker:
             collectlog.error("no recipe files to build, check your BBPATH and BBFILES?")
             bb.event.fire(CookerExit(), self.configuration.event_data)
 
+        if self.watcher:
+            # Roots outside the layers, such as $HOME for a BBFILES entry
+            # of ~/*/recipes/*.bb, would mean watching everything below
+            # them, so only the directories matched now are watched there
+            layers = [os.path.abspath(l) for l in (self.configuration.data.getVar('BBLAYERS', True) or "").split()]
+            trees, dirs = list(layers), []
+            for f in files:
+                root = os.path.abspath(globroot(f))
+                if [l for l in layers if root == l or root.startswith(l + os.sep)]:
+                    trees.append(root)
+                elif os.path.isdir(f):
+                    dirs.append(os.path.abspath(f))
+                else:
+                    dirs.extend(d for d in glob.glob(os.path.dirname(os.path.abspath(f))) if os.path.isdir(d))
+            self.watcher.add_trees(trees)
+            self.watcher.add_dirs(dirs)
+            if self.watcher.failed:
+                self.drop_watcher()
+
         # Can't use set here as order is important
         newfiles = []
         for f in files:
@@ -1320,6 +1553,7 @@ class BBCooker:
                 collectlog.debug(1, "skipping %s: unknown file extension", f)
 
         # Build a list of .bbappend files for each .bb file
+        self.appendlist = {}
         for f in bbappend:
             base = os.path.basename(f).replace('.bbappend', '.bb')
             if not base in self.appendlist:
@@ -1377,6 +1611,13 @@ class BBCooker:
 
     def reset(self):
         self.state = state.initial
+        if not self.watcher:
+            # Without inotify we can't tell what changed since the last
+            # parse so nothing cached from the files can be trusted
+            bb.parse.clear_mtime_cache()
+            bb.parse.BBHandler.cached_statements.clear()
+        # The snapshots are layered over the old configuration
+        bb.parse.BBHandler.inherit_snapshots.clear()
         self.loadConfigurationData()
 
 def server_main(cooker, func, *args):
@@ -1454,35 +1695,6 @@ class ParsingFailure(Exception):
         self.recipe = recipe
         Exception.__init__(self, realexception, recipe)
 
-class Feeder(multiprocessing.Process):
-    def __init__(self, jobs, to_parsers, quit):
-        self.quit = quit
-        self.jobs = jobs
-        self.to_parsers = to_parsers
-        multiprocessing.Process.__init__(self)
-
-    def run(self):
-        while True:
-            try:
-                quit = self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                if quit == 'cancel':
-                    self.to_parsers.cancel_join_thread()
-                break
-
-            try:
-                job = self.jobs.pop()
-            except IndexError:
-                break
-
-            try:
-                self.to_parsers.put(job, timeout=0.5)
-            except Queue.Full:
-                self.jobs.insert(0, job)
-                continue
-
 class Parser(multiprocessing.Process):
     def __init__(self, jobs, results, quit, init):
         self.jobs = jobs
@@ -1495,7 +1707,6 @@ class Parser(multiprocessing.Process):
         if self.init:
             self.init()
 
-        pending = []
         while True:
             try:
                 self.quit.get_nowait()
@@ -1505,26 +1716,26 @@ class Parser(multiprocessing.Process):
                 self.results.cancel_join_thread()
                 break
 
-            if pending:
-                result = pending.pop()
-            else:
-                try:
-                    job = self.jobs.get(timeout=0.25)
-                except Queue.Empty:
-                    continue
+            # The parent queues every batch followed by one None per
+            # parser up front, so this never waits on an empty queue
+            batch = self.jobs.get()
+            if batch is None:
+                break
 
-                if job is None:
-                    break
+            results = []
+            for job in batch:
                 result = self.parse(*job)
-
-            try:
-                self.results.put(result, timeout=0.25)
-            except Queue.Full:
-                pending.append(result)
+                results.append(result)
+                if isinstance(result[1], BaseException):
+                    break
+            self.results.put((results, bb.parse.profile_collect()))
 
     def parse(self, filename, appends, caches_array):
         try:
-            return True, bb.cache.Cache.parse(filename, appends, self.cfg, caches_array)
+            start = time.time()
+            infos = bb.cache.Cache.parse(filename, appends, self.cfg, caches_array)
+            bb.parse.profile_record("recipe", filename, start)
+            return True, infos
         except Exception as exc:
             tb = sys.exc_info()[2]
             exc.recipe = filename
@@ -1554,10 +1765,13 @@ class CookerParser(object):
         self.total = len(filelist)
 
         self.current = 0
+        self.profile = cooker.configuration.profile_parse
+        self.profiledata = {}
         self.num_processes = int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS", True) or
                                  multiprocessing.cpu_count())
 
         self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
+        self.bb_cache.prefetchMtimes(self.filelist, self.num_processes)
         self.fromcache = []
         self.willparse = []
         for filename in self.filelist:
@@ -1569,9 +1783,42 @@ class CookerParser(object):
         self.toparse = self.total - len(self.fromcache)
         self.progress_chunk = max(self.toparse / 100, 1)
 
+        self.syncthread = None
         self.start()
         self.haveshutdown = False
 
+    def job_batches(self):
+        """
+        Split the recipes to parse into batches for the parser processes.
+        Recipes are ordered by how long they took to parse last time,
+        slowest first (recipes with no history go first, in file order),
+        and each batch takes a share of the estimated remaining time, so
+        batches shrink towards the end and the parsers finish together.
+        """
+        parsetimes = self.bb_cache.parsetimes
+        known = [parsetimes[job[0]] for job in self.willparse if job[0] in parsetimes]
+        if known:
+            default = sum(known) / len(known)
+        else:
+            default = 1.0
+
+        jobs = sorted(self.willparse, reverse=True,
+                      key=lambda job: parsetimes.get(job[0], float('inf')))
+
+        remaining = sum(parsetimes.get(job[0], default) for job in jobs)
+        batches = []
+        batch, batchcost = [], 0
+        for job in jobs:
+            batch.append(job)
+            batchcost += parsetimes.get(job[0], default)
+            if batchcost >= remaining / (self.num_processes * 4):
+                batches.append(batch)
+                remaining -= batchcost
+                batch, batchcost = [], 0
+        if batch:
+            batches.append(batch)
+        return batches
+
     def start(self):
         self.results = self.load_cached()
         self.processes = []
@@ -1579,15 +1826,20 @@ class CookerParser(object):
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
             def init():
                 Parser.cfg = self.cfgdata
+                if self.profile:
+                    bb.parse.profile_enable()
                 multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cfgdata,), exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.codeparser.compile_cache_save, args=(self.cfgdata,), exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.parse.BBHandler.statement_cache_save, args=(self.cfgdata,), exitpriority=1)
                 multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(self.cfgdata,), exitpriority=1)
 
-            self.feeder_quit = multiprocessing.Queue(maxsize=1)
             self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
-            self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
+            self.jobs = multiprocessing.Queue()
             self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
-            self.feeder.start()
+            for batch in self.job_batches():
+                self.jobs.put(batch)
+            for i in range(0, self.num_processes):
+                self.jobs.put(None)
             for i in range(0, self.num_processes):
                 parser = Parser(self.jobs, self.result_queue, self.parser_quit, init)
                 parser.start()
@@ -1609,12 +1861,7 @@ class CookerParser(object):
                                             self.total)
 
             bb.event.fire(event, self.cfgdata)
-            self.feeder_quit.put(None)
-            for process in self.processes:
-                self.jobs.put(None)
         else:
-            self.feeder_quit.put('cancel')
-
             self.parser_quit.cancel_join_thread()
             for process in self.processes:
                 self.parser_quit.put(None)
@@ -1627,14 +1874,19 @@ class CookerParser(object):
                 process.terminate()
             else:
                 process.join()
-        self.feeder.join()
 
-        sync = threading.Thread(target=self.bb_cache.sync)
-        sync.start()
-        multiprocessing.util.Finalize(None, sync.join, exitpriority=-100)
+        self.syncthread = threading.Thread(target=self.bb_cache.sync)
+        self.syncthread.start()
+        multiprocessing.util.Finalize(None, self.syncthread.join, exitpriority=-100)
         bb.codeparser.parser_cache_savemerge(self.cooker.configuration.data)
+        bb.codeparser.compile_cache_savemerge(self.cooker.configuration.data)
+        bb.parse.BBHandler.statement_cache_savemerge(self.cooker.configuration.data)
         bb.fetch.fetcher_parse_done(self.cooker.configuration.data)
 
+        if self.profile:
+            bb.parse.profile_report(self.profiledata, "profile-parse.log")
+            logger.info("Parse profile written to profile-parse.log")
+
     def load_cached(self):
         for filename, appends in self.fromcache:
             cached, infos = self.bb_cache.load(filename, appends, self.cfgdata)
@@ -1646,15 +1898,18 @@ class CookerParser(object):
                 break
 
             try:
-                result = self.result_queue.get(timeout=0.25)
+                results, profiledata = self.result_queue.get(timeout=0.25)
             except Queue.Empty:
                 pass
             else:
-                value = result[1]
-                if isinstance(value, BaseException):
-                    raise value
-                else:
-                    yield result
+                if profiledata:
+                    bb.parse.profile_merge(self.profiledata, profiledata)
+                for result in results:
+                    value = result[1]
+                    if isinstance(value, BaseException):
+                        raise value
+                    else:
+                        yield result
 
     def parse_next(self):
         result = []
@@ -1720,6 +1975,9 @@ class CookerParser(object):
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
             self.bb_cache.add_info(virtualfn, info_array, self.cooker.status,
                                         parsed=parsed)
+            self.cooker.add_filewatch([bb.cache.Cache.virtualfn2realfn(virtualfn)[0]] +
+                                      info_array[0].appends +
+                                      [f for f, _ in info_array[0].file_depends or []])
         return True
 
     def reparse(self, filename):
@@ -275,6 +275,89 @@ def update_data(d):
     """Performs final steps upon the datastore, including application of overrides"""
     d.finalize()
 
+# A single word without shell syntax can't change how the code around it
+# parses, so only matters if it ends up naming a command
+__inert_word__ = re.compile(r"^[\w./+:,@%~-]+$")
+__shell_reserved__ = frozenset(["case", "do", "done", "elif", "else", "esac", "fi",
+                                "for", "if", "in", "then", "until", "while"])
+
+def _inert(value):
+    return __inert_word__.match(value) is not None and value not in __shell_reserved__
+
+def _lookup_checks(lookups, python, execs, d):
+    """
+    What a cached entry has to check of each variable the function looked
+    up: that it is still undefined (None), that it is still an inert word
+    (True) where it didn't end up in a command name, or otherwise that a
+    hash of its expansion is unchanged.  Python code is sensitive to any
+    change of a value spliced into it, so gets hashes only.
+    """
+    checks = []
+    for var in lookups:
+        value = d.getVar(var, True)
+        if value is None:
+            checks.append((var, None))
+        elif not python and _inert(value) and not [cmd for cmd in execs if value in cmd]:
+            checks.append((var, True))
+        else:
+            checks.append((var, hash(value)))
+    return tuple(checks)
+
+def _lookups_match(checks, d):
+    for var, check in checks:
+        value = d.getVar(var, True)
+        if check is None or value is None:
+            if check is not value:
+                return False
+        elif check is True:
+            if not _inert(value):
+                return False
+        elif hash(value) != check:
+            return False
+    return True
+
+def build_func_dependencies(key, value, python, log, d):
+    """
+    Return the variables a function references and the functions it calls.
+
+    Most functions come unchanged from the same classes in every recipe, so
+    the result is kept in the codeparser cache against the unexpanded value
+    along with what it depended on of each variable it references, and
+    reused while those still match.
+    """
+    h = None
+    if isinstance(value, basestring):
+        h = hash("%s\0%s\0%s" % (key, bool(python), value))
+        for cached in bb.codeparser.codeparsercache.get_deps(h):
+            if _lookups_match(cached["lookups"], d):
+                if cached["tabs"]:
+                    logger.warn("Variable %s contains tabs, please remove these (%s)" % (key, d.getVar("FILE", True)))
+                return cached["refs"], cached["execs"]
+
+    parsedvar = d.expandWithRefs(value, key)
+    tabs = False
+    if python:
+        parser = bb.codeparser.PythonParser(key, logger)
+        if parsedvar.value and "\t" in parsedvar.value:
+            tabs = True
+            logger.warn("Variable %s contains tabs, please remove these (%s)" % (key, d.getVar("FILE", True)))
+        parser.parse_python(parsedvar.value)
+        refs = parser.references | parsedvar.references
+    else:
+        parser = bb.codeparser.ShellParser(key, logger)
+        parser.parse_shell(parsedvar.value)
+        refs = set(parsedvar.references)
+    if log:
+        parser.log.flush()
+    execs = parser.execs | parsedvar.execs
+
+    # Python expansions can read anything, so can't be checked later
+    if h is not None and not parsedvar.volatile:
+        lookups = _lookup_checks(parsedvar.lookups, python, execs, d)
+        bb.codeparser.codeparsercache.add_deps(h, {"lookups" : lookups, "refs" : refs,
+                                                   "execs" : execs, "tabs" : tabs})
+    return refs, execs
+
 def build_dependencies(key, keys, shelldeps, vardepvals, d):
     deps = set()
     vardeps = d.getVarFlag(key, "vardeps", True)
@@ -288,22 +371,11 @@ def build_dependencies(key, keys, shelldeps, vardepvals, d):
         if key in vardepvals:
            value =  d.getVarFlag(key, "vardepvalue", True)
         elif d.getVarFlag(key, "func"):
-            if d.getVarFlag(key, "python"):
-                parsedvar = d.expandWithRefs(value, key)
-                parser = bb.codeparser.PythonParser(key, logger)
-                if parsedvar.value and "\t" in parsedvar.value:
-                    logger.warn("Variable %s contains tabs, please remove these (%s)" % (key, d.getVar("FILE", True)))
-                parser.parse_python(parsedvar.value)
-                deps = deps | parser.references
-            else:
-                parsedvar = d.expandWithRefs(value, key)
-                parser = bb.codeparser.ShellParser(key, logger)
-                parser.parse_shell(parsedvar.value)
+            python = d.getVarFlag(key, "python")
+            refs, execs = build_func_dependencies(key, value, python, vardeps is None, d)
+            if not python:
                 deps = deps | shelldeps
-            if vardeps is None:
-                parser.log.flush()
-            deps = deps | parsedvar.references
-            deps = deps | (keys & parser.execs) | (keys & parsedvar.execs)
+            deps = deps | refs | (keys & execs)
         else:
             parser = d.expandWithRefs(value, key)
             deps |= parser.references
@@ -331,9 +403,17 @@ def build_dependencies(key, keys, shelldeps, vardepvals, d):
 
 def generate_dependencies(d):
 
-    keys = set(key for key in d.keys() if not key.startswith("__"))
-    shelldeps = set(key for key in keys if d.getVarFlag(key, "export") and not d.getVarFlag(key, "unexport"))
-    vardepvals = set(key for key in keys if d.getVarFlag(key, "vardepvalue"))
+    keys = set()
+    shelldeps = set()
+    vardepvals = set()
+    for key in d.keys():
+        if key.startswith("__"):
+            continue
+        keys.add(key)
+        if d.getVarFlag(key, "export") and not d.getVarFlag(key, "unexport"):
+            shelldeps.add(key)
+        if d.getVarFlag(key, "vardepvalue"):
+            vardepvals.add(key)
 
     deps = {}
     values = {}
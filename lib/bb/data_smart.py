@@ -41,8 +41,114 @@ logger = logging.getLogger("BitBake.Data")
 __setvar_keyword__ = ["_append", "_prepend"]
 __setvar_regexp__ = re.compile('(?P<base>.*?)(?P<keyword>_append|_prepend)(_(?P<add>.*))?$')
 __expand_var_regexp__ = re.compile(r"\${[^{}]+}")
+__expand_var_split__ = re.compile(r"(\${[^{}]+})")
 __expand_python_regexp__ = re.compile(r"\${@.+?}")
 
+# Values split around their variable references, shared by all datastores
+# since the same class and configuration values are expanded over and over.
+# Long values such as function bodies are rarely expanded twice and aren't
+# kept, and the whole cache is dropped once it is full, which keeps it to
+# a few megabytes.
+__expand_tokens__ = {}
+__expand_tokens_max__ = 8192
+__expand_tokens_maxlen__ = 1024
+
+def _tokenise(s):
+    """
+    Split s into alternating literal text and ${VAR} references, the same
+    pieces __expand_var_regexp__.sub() would see
+    """
+    tokens = __expand_tokens__.get(s)
+    if tokens is None:
+        tokens = __expand_var_split__.split(s)
+        if len(s) <= __expand_tokens_maxlen__:
+            if len(__expand_tokens__) >= __expand_tokens_max__:
+                __expand_tokens__.clear()
+            __expand_tokens__[s] = tokens
+    return tokens
+
+
+_missing = object()
+
+class VariableFlags(object):
+    """
+    The flags of one variable. Its value lives in a slot and any other
+    flags in a plain dict created on first use, which takes far less memory
+    than a dict for each of the many thousands of variables in every
+    datastore. DataSmart's own hot paths use the two fields directly.
+    """
+    __slots__ = ("_content", "_extra")
+
+    def __init__(self):
+        self._extra = None
+
+    def get(self, flag, default=None):
+        if flag == "_content":
+            return getattr(self, "_content", default)
+        if self._extra is not None:
+            return self._extra.get(flag, default)
+        return default
+
+    def __getitem__(self, flag):
+        value = self.get(flag, _missing)
+        if value is _missing:
+            raise KeyError(flag)
+        return value
+
+    def __setitem__(self, flag, value):
+        if flag == "_content":
+            self._content = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[flag] = value
+
+    def __delitem__(self, flag):
+        if flag == "_content":
+            try:
+                del self._content
+            except AttributeError:
+                raise KeyError(flag)
+        elif self._extra is not None and flag in self._extra:
+            del self._extra[flag]
+            if not self._extra:
+                self._extra = None
+        else:
+            raise KeyError(flag)
+
+    def __contains__(self, flag):
+        if flag == "_content":
+            return hasattr(self, "_content")
+        return self._extra is not None and flag in self._extra
+
+    def __iter__(self):
+        if hasattr(self, "_content"):
+            yield "_content"
+        if self._extra is not None:
+            for flag in self._extra.keys():
+                yield flag
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __nonzero__(self):
+        return self._extra is not None or hasattr(self, "_content")
+
+    def copy(self):
+        # Skips __init__, this is called for every variable a copied
+        # datastore writes to
+        flags = object.__new__(VariableFlags)
+        try:
+            flags._content = self._content
+        except AttributeError:
+            pass
+        if self._extra is not None:
+            flags._extra = self._extra.copy()
+        else:
+            flags._extra = None
+        return flags
+
+    __copy__ = copy
 
 class VariableParse:
     def __init__(self, varname, d, val = None):
@@ -53,19 +159,34 @@ class VariableParse:
         self.references = set()
         self.execs = set()
 
+        # Every variable looked up, defined or not, so the cached expansion
+        # can be dropped when any of them change
+        self.lookups = set()
+        # Set once python has been evaluated, since the variables it reads
+        # can't be tracked
+        self.volatile = False
+
     def var_sub(self, match):
-            key = match.group()[2:-1]
+        return self.var_ref(match.group())
+
+    def var_ref(self, ref):
+            key = ref[2:-1]
             if self.varname and key:
                 if self.varname == key:
                     raise Exception("variable %s references itself!" % self.varname)
+            self.lookups.add(key)
             var = self.d.getVar(key, True)
             if var is not None:
                 self.references.add(key)
+                cached = self.d.expand_cache.get(key)
+                if cached is not None and cached.volatile:
+                    self.volatile = True
                 return var
             else:
-                return match.group()
+                return ref
 
     def python_sub(self, match):
+            self.volatile = True
             code = match.group()[3:-1]
             codeobj = compile(code.strip(), self.varname or "<expansion>", "eval")
 
@@ -123,6 +244,17 @@ class DataSmart(MutableMapping):
         self._seen_overrides = seen
 
         self.expand_cache = {}
+        # Variable name -> names of cached expansions which looked it up
+        self.expand_users = {}
+        # Cached expansions which evaluated python, dropped on any change
+        self.expand_volatile = set()
+
+        # The datastore this one was copied from, whose dict is also our
+        # dict["_data"]. Each level caches the keys it adds on top of its
+        # parent so iterating a deep copy doesn't rebuild the whole chain.
+        self._parent = None
+        self._revision = 0
+        self._keys_cache = None
 
     def expandWithRefs(self, s, varname):
 
@@ -134,11 +266,25 @@ class DataSmart(MutableMapping):
 
         varparse = VariableParse(varname, self)
 
+        # The first pass works on the stored value, whose tokens are cached
+        tokens = None
+        if '${' in s:
+            tokens = _tokenise(s)
+
         while s.find('${') != -1:
             olds = s
             try:
-                s = __expand_var_regexp__.sub(varparse.var_sub, s)
-                s = __expand_python_regexp__.sub(varparse.python_sub, s)
+                if tokens is not None:
+                    if len(tokens) > 1:
+                        tokens = tokens[:]
+                        for i in xrange(1, len(tokens), 2):
+                            tokens[i] = varparse.var_ref(tokens[i])
+                        s = "".join(tokens)
+                    tokens = None
+                else:
+                    s = __expand_var_regexp__.sub(varparse.var_sub, s)
+                if '${@' in s:
+                    s = __expand_python_regexp__.sub(varparse.python_sub, s)
                 if s == olds:
                     break
             except ExpansionError:
@@ -150,9 +296,42 @@ class DataSmart(MutableMapping):
 
         if varname:
             self.expand_cache[varname] = varparse
+            if varparse.volatile:
+                # Dropped on any change, so its lookups needn't be tracked
+                self.expand_volatile.add(varname)
+            else:
+                users = self.expand_users
+                for key in varparse.lookups:
+                    if key in users:
+                        users[key].add(varname)
+                    else:
+                        users[key] = set((varname,))
 
         return varparse
 
+    def expand_invalidate(self, var):
+        """
+        Drop the cached expansion of var and of everything which looked
+        it up, directly or through other variables
+        """
+        if self.expand_volatile:
+            for name in self.expand_volatile:
+                self.expand_cache.pop(name, None)
+            self.expand_volatile = set()
+
+        self.expand_cache.pop(var, None)
+        users = self.expand_users.pop(var, None)
+        if not users:
+            return
+
+        pending = list(users)
+        while pending:
+            name = pending.pop()
+            self.expand_cache.pop(name, None)
+            users = self.expand_users.pop(name, None)
+            if users:
+                pending.extend(users)
+
     def expand(self, s, varname = None):
         return self.expandWithRefs(s, varname).value
 
@@ -194,40 +373,62 @@ class DataSmart(MutableMapping):
                 except Exception:
                     logger.info("Untracked delVar")
 
-        # now on to the appends and prepends
+        # now on to the appends and prepends. Each variable is visited once
+        # for both, and each distinct override condition is only checked
+        # against the active overrides once
+        overridesset = set(overrides)
+        active = {}
+        pending = {}
         for op in __setvar_keyword__:
             if op in self._special_values:
-                appends = self._special_values[op] or []
-                for append in appends:
-                    keep = []
-                    for (a, o) in self.getVarFlag(append, op) or []:
-                        match = True
-                        if o:
-                            for o2 in o.split("_"):
-                                if not o2 in overrides:
-                                    match = False
+                for append in self._special_values[op] or []:
+                    pending.setdefault(append, []).append(op)
+
+        for append, ops in pending.iteritems():
+            local_var = self._findVar(append)
+            if local_var is None or local_var._extra is None:
+                continue
+            sval = None
+            for op in ops:
+                entries = local_var._extra.get(op, _missing)
+                if entries is _missing:
+                    continue
+                keep = []
+                applied = []
+                for (a, o) in entries or []:
+                    if o:
+                        match = active.get(o)
+                        if match is None:
+                            match = active[o] = overridesset.issuperset(o.split("_"))
                         if not match:
                             keep.append((a ,o))
                             continue
+                    applied.append(a)
 
-                        if op == "_append":
-                            sval = self.getVar(append, False) or ""
-                            sval += a
-                            self.setVar(append, sval)
-                        elif op == "_prepend":
-                            sval = a + (self.getVar(append, False) or "")
-                            self.setVar(append, sval)
-
-                    # We save overrides that may be applied at some later stage
-                    if keep:
-                        self.setVarFlag(append, op, keep)
-                    else:
-                        self.delVarFlag(append, op)
+                if applied:
+                    if sval is None:
+                        sval = self.getVar(append, False) or ""
+                    if op == "_append":
+                        sval = sval + "".join(applied)
+                    elif op == "_prepend":
+                        sval = "".join(reversed(applied)) + sval
+
+                # We save overrides that may be applied at some later stage
+                if keep:
+                    self.setVarFlag(append, op, keep)
+                else:
+                    self.delVarFlag(append, op)
+
+            if sval is not None:
+                self.setVar(append, sval)
 
     def initVar(self, var):
-        self.expand_cache = {}
+        # Checked inline as this runs for every variable set while parsing
+        if self.expand_volatile or var in self.expand_cache or var in self.expand_users:
+            self.expand_invalidate(var)
         if not var in self.dict:
-            self.dict[var] = {}
+            self._revision += 1
+            self.dict[var] = VariableFlags()
 
     def _findVar(self, var):
         dest = self.dict
@@ -245,13 +446,12 @@ class DataSmart(MutableMapping):
 
         local_var = self._findVar(var)
 
-        if local_var:
-            self.dict[var] = copy.copy(local_var)
+        if local_var is not None:
+            self.dict[var] = local_var.copy()
         else:
             self.initVar(var)
 
     def setVar(self, var, value):
-        self.expand_cache = {}
         match  = __setvar_regexp__.match(var)
         if match and match.group("keyword") in __setvar_keyword__:
             base = match.group('base')
@@ -283,7 +483,10 @@ class DataSmart(MutableMapping):
                 self._seen_overrides[override].add( var )
 
         # setting var
-        self.dict[var]["_content"] = value
+        if self.expand_volatile or var in self.expand_cache or var in self.expand_users:
+            self.expand_invalidate(var)
+        self._revision += 1
+        self.dict[var]._content = value
 
     def getVar(self, var, expand=False, noweakdefault=False):
         value = self.getVarFlag(var, "_content", False, noweakdefault)
@@ -325,8 +528,9 @@ class DataSmart(MutableMapping):
         self.setVar(key, value)
 
     def delVar(self, var):
-        self.expand_cache = {}
-        self.dict[var] = {}
+        self.expand_invalidate(var)
+        self._revision += 1
+        self.dict[var] = VariableFlags()
         if '_' in var:
             override = var[var.rfind('_')+1:]
             if override and override in self._seen_overrides and var in self._seen_overrides[override]:
@@ -335,29 +539,59 @@ class DataSmart(MutableMapping):
     def setVarFlag(self, var, flag, flagvalue):
         if not var in self.dict:
             self._makeShadowCopy(var)
-        self.dict[var][flag] = flagvalue
+        if flag in ("_content", "defaultval"):
+            self.expand_invalidate(var)
+        self._revision += 1
+        local_var = self.dict[var]
+        if flag == "_content":
+            local_var._content = flagvalue
+        elif local_var._extra is None:
+            local_var._extra = {flag : flagvalue}
+        else:
+            local_var._extra[flag] = flagvalue
 
     def getVarFlag(self, var, flag, expand=False, noweakdefault=False):
         local_var = self._findVar(var)
         value = None
-        if local_var:
-            if flag in local_var:
-                value = copy.copy(local_var[flag])
-            elif flag == "_content" and "defaultval" in local_var and not noweakdefault:
-                value = copy.copy(local_var["defaultval"])
+        if local_var is not None:
+            if flag == "_content":
+                try:
+                    value = local_var._content
+                except AttributeError:
+                    if local_var._extra is not None and "defaultval" in local_var._extra and not noweakdefault:
+                        value = copy.copy(local_var._extra["defaultval"])
+                else:
+                    value = copy.copy(value)
+            else:
+                extra = local_var._extra
+                if extra is not None and flag in extra:
+                    value = copy.copy(extra[flag])
         if expand and value:
             value = self.expand(value, None)
         return value
 
     def delVarFlag(self, var, flag):
         local_var = self._findVar(var)
-        if not local_var:
+        if local_var is None:
+            return
+        if flag == "_content":
+            if not hasattr(local_var, "_content"):
+                return
+        elif local_var._extra is None or flag not in local_var._extra:
             return
         if not var in self.dict:
             self._makeShadowCopy(var)
 
-        if var in self.dict and flag in self.dict[var]:
-            del self.dict[var][flag]
+        if flag in ("_content", "defaultval"):
+            self.expand_invalidate(var)
+        self._revision += 1
+        local_var = self.dict[var]
+        if flag == "_content":
+            del local_var._content
+        else:
+            del local_var._extra[flag]
+            if not local_var._extra:
+                local_var._extra = None
 
     def appendVarFlag(self, key, flag, value):
         value = (self.getVarFlag(key, flag, False) or "") + value
@@ -371,6 +605,10 @@ class DataSmart(MutableMapping):
         if not var in self.dict:
             self._makeShadowCopy(var)
 
+        if "defaultval" in flags:
+            self.expand_invalidate(var)
+
+        self._revision += 1
         for i in flags:
             if i == "_content":
                 continue
@@ -380,7 +618,7 @@ class DataSmart(MutableMapping):
         local_var = self._findVar(var)
         flags = {}
 
-        if local_var:
+        if local_var is not None:
             for i in local_var:
                 if i.startswith("_"):
                     continue
@@ -396,17 +634,52 @@ class DataSmart(MutableMapping):
             self._makeShadowCopy(var)
 
         if var in self.dict:
+            self.expand_invalidate(var)
+            self._revision += 1
             content = None
 
             # try to save the content
             if "_content" in self.dict[var]:
                 content  = self.dict[var]["_content"]
-                self.dict[var]            = {}
+                self.dict[var]            = VariableFlags()
                 self.dict[var]["_content"] = content
             else:
                 del self.dict[var]
 
 
+    def getVarRecord(self, var):
+        """
+        Return a copy of everything held for var (its value, flags and
+        pending appends and prepends) or None if there is nothing
+        """
+        local_var = self._findVar(var)
+        if not local_var:
+            return None
+        return local_var.copy()
+
+    def setVarRecord(self, var, record):
+        """
+        Replace everything held for var with a record from getVarRecord()
+        """
+        self.expand_invalidate(var)
+        self._revision += 1
+        if record is None:
+            self.dict[var] = VariableFlags()
+            return
+        self.dict[var] = record.copy()
+
+        for keyword in __setvar_keyword__:
+            if keyword in record:
+                if keyword not in self._special_values:
+                    self._special_values[keyword] = set()
+                self._special_values[keyword].add(var)
+        if '_' in var:
+            override = var[var.rfind('_')+1:]
+            if override:
+                if override not in self._seen_overrides:
+                    self._seen_overrides[override] = set()
+                self._seen_overrides[override].add(var)
+
     def createCopy(self):
         """
         Create a copy of self by setting _data to self
@@ -414,6 +687,7 @@ class DataSmart(MutableMapping):
         # we really want this to be a DataSmart...
         data = DataSmart(seen=self._seen_overrides.copy(), special=self._special_values.copy())
         data.dict["_data"] = self.dict
+        data._parent = self
 
         return data
 
@@ -438,26 +712,37 @@ class DataSmart(MutableMapping):
             if key != '_data':
                 yield key
 
-    def __iter__(self):
-        def keylist(d):        
-            klist = set()
-            for key in d:
-                if key == "_data":
-                    continue
-                if not d[key]:
-                    continue
-                klist.add(key)
+    def _keysets(self):
+        """
+        Return a tuple of disjoint frozensets which together hold every key
+        with a non-empty entry in this datastore or the ones it was copied
+        from. The parent's sets are shared as they are, so only the keys
+        this level adds are collected, and only when it or a parent changed.
+        """
+        if self._parent is not None:
+            parentsets = self._parent._keysets()
+        else:
+            parentsets = ()
 
-            if "_data" in d:
-                klist |= keylist(d["_data"])
+        cache = self._keys_cache
+        if cache and cache[0] is parentsets and cache[1] == self._revision:
+            return cache[2]
 
-            return klist
+        added = frozenset(key for key, value in self.dict.iteritems()
+                          if key != "_data" and
+                          (value._extra is not None or hasattr(value, "_content")) and
+                          not any(key in keys for keys in parentsets))
+        keysets = parentsets + (added,)
+        self._keys_cache = (parentsets, self._revision, keysets)
+        return keysets
 
-        for k in keylist(self.dict):
-             yield k
+    def __iter__(self):
+        for keys in self._keysets():
+            for k in keys:
+                yield k
 
     def __len__(self):
-        return len(frozenset(self))
+        return sum(len(keys) for keys in self._keysets())
 
     def __getitem__(self, item):
         value = self.getVar(item, False)
@@ -23,6 +23,9 @@ BitBake build tools.
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os, sys
+import select
+import struct
+import time
 import warnings
 try:
     import cPickle as pickle
@@ -30,6 +33,7 @@ except ImportError:
     import pickle
 import logging
 import atexit
+import inspect
 import traceback
 import bb.utils
 import bb.compat
@@ -58,6 +62,28 @@ _handlers = bb.compat.OrderedDict()
 _ui_handlers = {}
 _ui_handler_seq = 0
 
+# The names of the event classes a handler or UI handler wants, handlers
+# without an entry get every event
+_handler_masks = {}
+_ui_handler_masks = {}
+
+# The log level and debug domain levels each UI handler shows, which workers
+# drop less important log records by
+_ui_handler_loglevels = {}
+
+# Event class -> the handlers or UI handlers which want it, filled in as
+# events are fired and emptied whenever the handlers change
+_handler_map = {}
+_ui_handler_map = {}
+
+def _class_names(cls):
+    return set("%s.%s" % (base.__module__, base.__name__) for base in inspect.getmro(cls))
+
+def _masked(handlers, masks, cls):
+    names = _class_names(cls)
+    return [(key, handlers[key]) for key in handlers
+            if key not in masks or masks[key] & names]
+
 # For compatibility
 bb.utils._context["NotHandled"] = NotHandled
 bb.utils._context["Handled"] = Handled
@@ -88,7 +114,10 @@ def fire_class_handlers(event, d):
     if isinstance(event, logging.LogRecord):
         return
 
-    for name, handler in _handlers.iteritems():
+    handlers = _handler_map.get(event.__class__)
+    if handlers is None:
+        handlers = _handler_map[event.__class__] = _masked(_handlers, _handler_masks, event.__class__)
+    for name, handler in handlers:
         try:
             execute_handler(name, handler, event, d)
         except Exception:
@@ -127,21 +156,28 @@ def fire_ui_handlers(event, d):
         ui_queue.append(event)
         return
 
+    handlers = _ui_handler_map.get(event.__class__)
+    if handlers is None:
+        handlers = _ui_handler_map[event.__class__] = _masked(_ui_handlers, _ui_handler_masks, event.__class__)
+
     errors = []
-    for h in _ui_handlers:
+    pickled = None
+    for h, handler in handlers:
         #print "Sending event %s" % event
         try:
              # We use pickle here since it better handles object instances
              # which xmlrpc's marshaller does not. Events *must* be serializable
              # by pickle.
-             if hasattr(_ui_handlers[h].event, "sendpickle"):
-                _ui_handlers[h].event.sendpickle((pickle.dumps(event)))
+             if hasattr(handler.event, "sendpickle"):
+                if pickled is None:
+                    pickled = pickle.dumps(event)
+                handler.event.sendpickle(pickled)
              else:
-                _ui_handlers[h].event.send(event)
+                handler.event.send(event)
         except:
             errors.append(h)
     for h in errors:
-        del _ui_handlers[h]
+        unregister_UIHhandler(h)
 
 def fire(event, d):
     """Fire off an Event"""
@@ -157,26 +193,91 @@ def fire(event, d):
     else:
         fire_ui_handlers(event, d)
 
+# Workers write each event to their pipe as a frame of a one byte kind and the
+# length of the pickled event which follows
+worker_frame = struct.Struct("!cI")
+
+# Log records below warnings are held back and written together once there
+# are this many bytes of them or the oldest has waited this many seconds
+# when another arrives, and otherwise at the end of each function bb.build
+# runs and before bb.process runs a command
+worker_batch_bytes = 32768
+worker_batch_interval = 0.25
+
+_worker_batch = []
+_worker_batch_size = 0
+_worker_batch_start = 0
+_worker_batch_pid = 0
+
 def worker_fire(event, d):
-    data = "<event>" + pickle.dumps(event) + "</event>"
+    global _worker_batch_size, _worker_batch_start, _worker_batch_pid
+
+    data = pickle.dumps(event, 2)
+    frame = worker_frame.pack("e", len(data)) + data
+    if isinstance(event, logging.LogRecord) and event.levelno < logging.WARNING:
+        now = time.time()
+        pid = os.getpid()
+        if _worker_batch_pid != pid:
+            # Anything held back was the parent process' to send
+            del _worker_batch[:]
+            _worker_batch_size = 0
+            _worker_batch_pid = pid
+        if not _worker_batch:
+            _worker_batch_start = now
+        _worker_batch.append(frame)
+        _worker_batch_size += len(frame)
+        if _worker_batch_size < worker_batch_bytes and now - _worker_batch_start < worker_batch_interval:
+            return
+        worker_flush()
+        return
+
+    worker_flush()
+    worker_pipe.write(frame)
+
+def worker_flush():
+    """
+    Write out any log records a worker is holding back, which has to happen
+    before it forks or exits
+    """
+    global _worker_batch_size
+
+    if not _worker_batch or _worker_batch_pid != os.getpid():
+        return
+    # Writes of up to PIPE_BUF bytes aren't interleaved with those of the
+    # task's children, which write events to the same pipe
+    data = ""
+    for frame in _worker_batch:
+        if data and len(data) + len(frame) > select.PIPE_BUF:
+            worker_pipe.write(data)
+            data = ""
+        data += frame
+    del _worker_batch[:]
+    _worker_batch_size = 0
     worker_pipe.write(data)
 
 def fire_from_worker(event, d):
-    if not event.startswith("<event>") or not event.endswith("</event>"):
-        print("Error, not an event %s" % event)
-        return
-    event = pickle.loads(event[7:-8])
+    """
+    Fire an event received from a worker, given the pickled event
+    """
+    event = pickle.loads(event)
     fire_ui_handlers(event, d)
 
 noop = lambda _: None
-def register(name, handler):
-    """Register an Event handler"""
+def register(name, handler, mask=None):
+    """
+    Register an Event handler, which is only passed events of the classes
+    named in mask (e.g. "bb.event.BuildStarted") and their subclasses if
+    one is given
+    """
 
     # already registered
     if name in _handlers:
         return AlreadyRegistered
 
     if handler is not None:
+        _handler_map.clear()
+        if mask:
+            _handler_masks[name] = set(mask)
         # handle string containing python code
         if isinstance(handler, basestring):
             tmp = "def %s(e):\n%s" % (name, handler)
@@ -199,17 +300,73 @@ def register(name, handler):
 def remove(name, handler):
     """Remove an Event handler"""
     _handlers.pop(name)
+    _handler_masks.pop(name, None)
+    _handler_map.clear()
 
-def register_UIHhandler(handler):
+def get_handlers():
+    """
+    Return a copy of the registered Event handlers and their masks, which
+    set_handlers() can put back
+    """
+    return bb.compat.OrderedDict(_handlers), dict(_handler_masks)
+
+def set_handlers(handlers):
+    """Replace the registered Event handlers with ones from get_handlers()"""
+    _handlers.clear()
+    _handlers.update(handlers[0])
+    _handler_masks.clear()
+    _handler_masks.update(handlers[1])
+    _handler_map.clear()
+
+def register_UIHhandler(handler, mask=None):
     bb.event._ui_handler_seq = bb.event._ui_handler_seq + 1
     _ui_handlers[_ui_handler_seq] = handler
+    set_UIHmask(_ui_handler_seq, mask)
     return _ui_handler_seq
 
 def unregister_UIHhandler(handlerNum):
     if handlerNum in _ui_handlers:
         del _ui_handlers[handlerNum]
+        _ui_handler_masks.pop(handlerNum, None)
+        _ui_handler_map.clear()
+        if _ui_handler_loglevels.pop(handlerNum, None):
+            LogHandler.workerfilter = None
     return
 
+def set_UIHmask(handlerNum, mask):
+    """
+    Only send a UI handler events of the classes named in mask and their
+    subclasses, or every event if mask is empty
+    """
+    if mask:
+        _ui_handler_masks[handlerNum] = set(mask)
+    else:
+        _ui_handler_masks.pop(handlerNum, None)
+    _ui_handler_map.clear()
+
+def set_UIHloglevels(handlerNum, level, debug_domains):
+    """
+    Record the log level and the levels of the debug domains a UI handler
+    shows, as from bb.msg.defaultLogLevels() in the UI
+    """
+    _ui_handler_loglevels[handlerNum] = (level, dict(debug_domains))
+    LogHandler.workerfilter = None
+
+def worker_loglevels():
+    """
+    Return the log level and debug domain levels workers have to send log
+    records at, the most verbose of those the UIs reported or the server's
+    own if none did
+    """
+    if not _ui_handler_loglevels:
+        return bb.msg.defaultLogLevels()
+    level = min(level for level, domains in _ui_handler_loglevels.itervalues())
+    debug_domains = {}
+    for _, domains in _ui_handler_loglevels.itervalues():
+        for domain, dlevel in domains.iteritems():
+            debug_domains[domain] = min(dlevel, debug_domains.get(domain, dlevel))
+    return level, debug_domains
+
 def getName(e):
     """Returns the name of a class or class instance"""
     if getattr(e, "__name__", None) == None:
@@ -531,8 +688,16 @@ class LogHandler(logging.Handler):
             record.exc_info = None
         fire(record, None)
 
+    # Workers drop the records no UI would show before sending them, this is
+    # reset whenever a UI reports different levels
+    workerfilter = None
+
     def filter(self, record):
         record.taskpid = worker_pid
+        if worker_pid != 0:
+            if LogHandler.workerfilter is None:
+                LogHandler.workerfilter = bb.msg.BBLogFilter(None, *worker_loglevels())
+            return LogHandler.workerfilter.filter(record)
         return True
 
 class RequestPackageInfo(Event):
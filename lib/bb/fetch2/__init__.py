@@ -724,6 +724,29 @@ def get_file_checksums(filelist, pn):
     checksums.sort()
     return checksums
 
+def prefetch_file_checksums(filelists, threads=1):
+    """Checksum the local files of a list of (filelist, pn) pairs
+
+    The work is spread over a pool of threads since the time is mostly spent
+    reading the files. The results land in the checksum cache, so the
+    get_file_checksums() calls which follow don't read the files again.
+
+    """
+    filelists = list(set(filelists))
+    if threads <= 1 or len(filelists) <= 1:
+        return
+
+    def checksums(args):
+        get_file_checksums(*args)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(filelists)))
+    try:
+        pool.map(checksums, filelists, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 
 class FetchData(object):
     """
@@ -83,8 +83,9 @@ class BBLogFilter(object):
         for domain in debug_domains:
             if debug_domains[domain] < loglevel:
                 loglevel = debug_domains[domain]
-        handler.setLevel(loglevel)
-        handler.addFilter(self)
+        if handler is not None:
+            handler.setLevel(loglevel)
+            handler.addFilter(self)
 
     def filter(self, record):
         if record.levelno >= self.stdlevel:
@@ -113,8 +114,11 @@ def init_msgconfig(verbose, debug, debug_domains = []):
         bb.msg.loggerVerboseLogs = True
     bb.msg.loggerDefaultDomains = debug_domains
 
-def addDefaultlogFilter(handler):
-
+def defaultLogLevels():
+    """
+    Return the log level and the levels of the debug domains from the
+    message configuration
+    """
     debug = loggerDefaultDebugLevel
     verbose = loggerDefaultVerbose
     domains = loggerDefaultDomains
@@ -131,6 +135,10 @@ def addDefaultlogFilter(handler):
         dlevel = len(tuple(iterator))
         debug_domains["BitBake.%s" % domainarg] = logging.DEBUG - dlevel + 1
 
+    return level, debug_domains
+
+def addDefaultlogFilter(handler):
+    level, debug_domains = defaultLogLevels()
     BBLogFilter(handler, level, debug_domains)
 
 #
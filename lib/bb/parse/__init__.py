@@ -28,6 +28,7 @@ handlers = []
 
 import os
 import stat
+import time
 import logging
 import bb
 import bb.utils
@@ -66,10 +67,99 @@ def cached_mtime_noerror(f):
             return 0
     return __mtime_cache[f]
 
+def cached_mtime_prefetch(files, threads=1):
+    """
+    Stat all of the given files not yet in the mtime cache, spread over
+    a pool of threads since the time is mostly spent waiting on the
+    filesystem.  Files which can't be stat'ed are left out of the cache.
+    """
+    files = [f for f in set(files) if f not in __mtime_cache]
+    if not files:
+        return
+
+    def mtime(f):
+        try:
+            return f, os.stat(f)[stat.ST_MTIME]
+        except OSError:
+            return f, None
+
+    if threads > 1 and len(files) > threads:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(mtime, files, chunksize=max(len(files) / (threads * 4), 1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(mtime, files)
+
+    for f, fmtime in results:
+        if fmtime is not None:
+            __mtime_cache[f] = fmtime
+
+def invalidate_mtime(f):
+    __mtime_cache.pop(f, None)
+
+def clear_mtime_cache():
+    __mtime_cache.clear()
+
 def update_mtime(f):
     __mtime_cache[f] = os.stat(f)[stat.ST_MTIME]
     return __mtime_cache[f]
 
+# Parse timings gathered when bitbake runs with --profile-parse, keyed by
+# (category, name) with a [count, total seconds] value.  None when the
+# profile is disabled.
+parse_profile = None
+
+def profile_enable():
+    global parse_profile
+    parse_profile = {}
+
+def profile_record(category, name, start):
+    """Add the time since start to the named parse profile entry"""
+    if parse_profile is None:
+        return
+    entry = parse_profile.setdefault((category, name), [0, 0.0])
+    entry[0] += 1
+    entry[1] += time.time() - start
+
+def profile_collect():
+    """Return the timings recorded since the last call and start afresh"""
+    global parse_profile
+    if parse_profile is None:
+        return None
+    collected = parse_profile
+    parse_profile = {}
+    return collected
+
+def profile_merge(profile, collected):
+    """Merge timings returned by profile_collect() into profile"""
+    for key, (count, total) in collected.iteritems():
+        entry = profile.setdefault(key, [0, 0.0])
+        entry[0] += count
+        entry[1] += total
+
+def profile_report(profile, filename):
+    """
+    Write merged parse timings to filename as tab separated columns of
+    category, total seconds, count, mean seconds and name, slowest first,
+    so the report can be further sorted or filtered with standard tools.
+    """
+    totals = {}
+    for (category, name), (count, total) in profile.iteritems():
+        totals[category] = totals.get(category, 0.0) + total
+
+    with open(filename, "w") as f:
+        f.write("# Times in seconds; include and class times contain nested includes\n")
+        for category in sorted(totals):
+            f.write("# %s total %.3f\n" % (category, totals[category]))
+        f.write("#category\ttotal\tcount\tmean\tname\n")
+        entries = sorted(profile.iteritems(), key=lambda e: e[1][1], reverse=True)
+        for (category, name), (count, total) in entries:
+            f.write("%s\t%.4f\t%d\t%.4f\t%s\n" % (category, total, count, total / count, name))
+
 def mark_dependency(d, f):
     if f.startswith('./'):
         f = "%s/%s" % (os.getcwd(), f[2:])
@@ -25,6 +25,7 @@ from __future__ import absolute_import
 from future_builtins import filter
 import re
 import string
+import time
 import logging
 import bb
 import itertools
@@ -161,7 +162,10 @@ class MethodFlagsNode(AstNode):
     def __init__(self, filename, lineno, key, m):
         AstNode.__init__(self, filename, lineno)
         self.key = key
-        self.m = m
+        # Keep the flags rather than the match object so that statements
+        # can be pickled into the statement cache
+        self.python = m.group("py") is not None
+        self.fakeroot = m.group("fr") is not None
 
     def eval(self, data):
         if data.getVar(self.key):
@@ -169,11 +173,11 @@ class MethodFlagsNode(AstNode):
             # flags could cause problems
             data.setVarFlag(self.key, 'python', None)
             data.setVarFlag(self.key, 'fakeroot', None)
-        if self.m.group("py") is not None:
+        if self.python:
             data.setVarFlag(self.key, "python", "1")
         else:
             data.delVarFlag(self.key, "python")
-        if self.m.group("fr") is not None:
+        if self.fakeroot:
             data.setVarFlag(self.key, "fakeroot", "1")
         else:
             data.delVarFlag(self.key, "fakeroot")
@@ -312,7 +316,7 @@ def finalize(fn, d, variant = None):
     for var in d.getVar('__BBHANDLERS') or []:
         # try to add the handler
         handler = d.getVar(var)
-        bb.event.register(var, handler)
+        bb.event.register(var, handler, (d.getVarFlag(var, "eventmask", True) or "").split())
 
     bb.event.fire(bb.event.RecipePreFinalise(fn), d)
 
@@ -321,13 +325,17 @@ def finalize(fn, d, variant = None):
     code = []
     for funcname in d.getVar("__BBANONFUNCS") or []:
         code.append("%s(d)" % funcname)
+    start = time.time()
     bb.utils.better_exec("\n".join(code), {"d": d})
+    bb.parse.profile_record("anonymous", fn, start)
     bb.data.update_data(d)
 
     tasklist = d.getVar('__BBTASKS') or []
     bb.build.add_tasks(tasklist, d)
 
+    start = time.time()
     bb.parse.siggen.finalise(fn, d, variant)
+    bb.parse.profile_record("siggen", fn, start)
 
     d.setVar('BBINCLUDED', bb.parse.get_file_depends(d))
 
@@ -26,10 +26,11 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from __future__ import absolute_import
-import re, bb, os
+import re, bb, os, time
 import logging
 import bb.build, bb.utils
 from bb import data
+from bb.cache import MultiProcessCache
 
 from . import ConfHandler
 from .. import resolve_file, ast, logger
@@ -54,6 +55,56 @@ __classname__ = ""
 classes = [ None, ]
 
 cached_statements = {}
+inherit_snapshots = {}
+
+class StatementCache(MultiProcessCache):
+    """
+    Parsed statements of .bbclass and .inc files, keyed by absolute path
+    and stored with the file's mtime so that parser processes and later
+    runs can load a class instead of feeding it through the parser again
+    """
+    cache_file_name = "bb_statements.dat"
+    # Bump whenever the ast node classes change
+    CACHE_VERSION = 1
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.statements = self.cachedata[0]
+        self.statementsextras = self.cachedata_extras[0]
+
+    def init_cache(self, d):
+        MultiProcessCache.init_cache(self, d)
+
+        # cachedata gets re-assigned in the parent
+        self.statements = self.cachedata[0]
+
+    def merge_data(self, source, dest):
+        # Unlike the other caches entries go stale, so a newer parse of
+        # a file replaces the stored one
+        for fn, entry in source[0].iteritems():
+            if fn not in dest[0] or dest[0][fn][0] != entry[0]:
+                dest[0][fn] = entry
+
+    def get(self, fn, mtime):
+        for cache in (self.statements, self.statementsextras):
+            entry = cache.get(fn)
+            if entry and entry[0] == mtime:
+                return entry[1]
+        return None
+
+    def add(self, fn, mtime, statements):
+        self.statementsextras[fn] = (mtime, statements)
+
+statementcache = StatementCache()
+
+def statement_cache_init(d):
+    statementcache.init_cache(d)
+
+def statement_cache_save(d):
+    statementcache.save_extras(d)
+
+def statement_cache_savemerge(d):
+    statementcache.save_merge(d)
 
 # We need to indicate EOF to the feeder. This code is so messy that
 # factoring it out to a close_parse_file method is out of question.
@@ -88,6 +139,19 @@ def get_statements(filename, absolute_filename, base_name):
     try:
         return cached_statements[absolute_filename]
     except KeyError:
+        cacheable = filename.endswith(".bbclass") or filename.endswith(".inc")
+        if cacheable:
+            mtime = bb.parse.cached_mtime_noerror(absolute_filename)
+            statements = statementcache.get(absolute_filename, mtime)
+            if statements is not None:
+                # EXPORT_FUNCTIONS looks at the classes being evaluated
+                # when it runs, which the pickled copy has lost
+                for statement in statements:
+                    if isinstance(statement, ast.ExportFuncsNode):
+                        statement.classes = classes
+                cached_statements[absolute_filename] = statements
+                return statements
+
         file = open(absolute_filename, 'r')
         statements = ast.StatementGroup()
 
@@ -102,10 +166,66 @@ def get_statements(filename, absolute_filename, base_name):
             # add a blank line to close out any python definition
             feeder(IN_PYTHON_EOF, "", filename, base_name, statements)
 
-        if filename.endswith(".bbclass") or filename.endswith(".inc"):
+        if cacheable:
             cached_statements[absolute_filename] = statements
+            statementcache.add(absolute_filename, mtime, statements)
         return statements
 
+def snapshot_inherits(statements, d):
+    """
+    Evaluate the inherit statements a recipe starts with from a snapshot
+    of the datastore kept per process and keyed by the class files they
+    resolve to, so recipes sharing the same leading inherits only pay
+    for evaluating those classes once.  Returns the datastore to carry
+    on parsing with and the statements left to evaluate.
+
+    The snapshot is evaluated without the variables set on the recipe's
+    datastore before parsing (such as __BBAPPEND), which are copied over
+    it afterwards.  If the classes set any of those variables this would
+    lose their assignments, so the recipe is parsed as normal instead.
+    The classes must also not read them, or anything else specific to
+    the recipe, at inherit time (e.g. by using ':=' on something derived
+    from FILE or PN), so this is only used if BB_PARSE_SNAPSHOT_INHERITS
+    is set.
+    """
+    prefix = 0
+    for statement in statements:
+        if not isinstance(statement, ast.InheritNode):
+            break
+        prefix += 1
+
+    if not prefix:
+        return d, statements
+
+    localvars = sorted(d.localkeys())
+    key = [tuple(localvars)]
+    for statement in statements[:prefix]:
+        bbpath = "%s:%s" % (os.path.dirname(d.expand(statement.filename)), d.getVar("BBPATH", True))
+        for file in d.expand(statement.classes).split():
+            if not os.path.isabs(file) and not file.endswith(".bbclass"):
+                file = os.path.join('classes', '%s.bbclass' % file)
+            key.append(bb.utils.which(bbpath, file) or file)
+    key = tuple(key)
+
+    snapshot = inherit_snapshots.get(key)
+    if snapshot is None:
+        snapshot = bb.data.createCopy(d)
+        for var in localvars:
+            snapshot.delVar(var)
+        ast.StatementGroup(statements[:prefix]).eval(snapshot)
+        touched = [var for var in localvars if snapshot.getVarRecord(var) is not None]
+        if touched:
+            logger.debug(1, "Not snapshotting %s, they set %s", " ".join(key[1:]), " ".join(touched))
+            snapshot = False
+        inherit_snapshots[key] = snapshot
+    if snapshot is False:
+        return d, statements
+
+    recipe_d = bb.data.createCopy(snapshot)
+    for var in localvars:
+        recipe_d.setVarRecord(var, d.getVarRecord(var))
+    return recipe_d, ast.StatementGroup(statements[prefix:])
+
 def handle(fn, d, include):
     global __func_start_regexp__, __inherit_regexp__, __export_func_regexp__, __addtask_regexp__, __addhandler_regexp__, __infunc__, __body__, __residue__
     __body__ = []
@@ -141,9 +261,15 @@ def handle(fn, d, include):
     if include:
         bb.parse.mark_dependency(d, abs_fn)
 
+    if include:
+        start = time.time()
+
     # actual loading
     statements = get_statements(fn, abs_fn, base_name)
 
+    if ext == ".bb" and include == 0 and d.getVar("BB_PARSE_SNAPSHOT_INHERITS", True):
+        d, statements = snapshot_inherits(statements, d)
+
     # DONE WITH PARSING... time to evaluate
     if ext != ".bbclass":
         data.setVar('FILE', abs_fn, d)
@@ -163,6 +289,9 @@ def handle(fn, d, include):
     if ext == ".bbclass" or ext == ".inc":
         bb.methodpool.set_parsed_module(base_name)
 
+    if include:
+        bb.parse.profile_record("class" if ext == ".bbclass" else "include", abs_fn, start)
+
     return d
 
 def feeder(lineno, s, fn, root, statements):
@@ -3,6 +3,7 @@ import signal
 import subprocess
 import errno
 import select
+import bb.event
 
 logger = logging.getLogger('BitBake.Process')
 
@@ -111,6 +112,8 @@ def run(cmd, input=None, log=None, **options):
     if isinstance(cmd, basestring) and not "shell" in options:
         options["shell"] = True
 
+    # Don't hold log records back for as long as the command runs
+    bb.event.worker_flush()
     try:
         pipe = Popen(cmd, **options)
     except OSError as exc:
@@ -9,6 +9,10 @@
 """
 import os.path
 import sys
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import pyshlex
 tokens = pyshlex.tokens
@@ -645,16 +649,71 @@ def p_error(p):
         w('  %r\n' % n)
     raise sherrors.ShellSyntaxError(''.join(msg))
 
-# Build the parser
-try:
-    import pyshtables
-except ImportError:
-    outputdir = os.path.dirname(__file__)
-    if not os.access(outputdir, os.W_OK):
-        outputdir = ''
-    yacc.yacc(tabmodule = 'pyshtables', outputdir = outputdir, debug = 0)
-else:
-    yacc.yacc(tabmodule = 'pysh.pyshtables', write_tables = 0, debug = 0)
+# Build the parser. Generating the LALR tables from the grammar is slow, so
+# they are pickled: setup.py build writes pyshtables.pickle next to this
+# module to be installed with it, and otherwise they are kept in
+# $XDG_CACHE_HOME/bitbake (~/.cache/bitbake). Tables for a different grammar
+# are ignored and regenerated in the cache directory.
+tables_file = 'pyshtables.pickle'
+
+def _tables_signature(picklefile):
+    # The tables start with the table version, the LR method and the grammar
+    # signature, which is all that is needed to tell whether they are usable
+    try:
+        f = open(picklefile, 'rb')
+        try:
+            if pickle.load(f) != yacc.__tabversion__:
+                return None
+            pickle.load(f)
+            return pickle.load(f)
+        finally:
+            f.close()
+    except Exception:
+        return None
+
+def build_tables(picklefile):
+    """Generate the parser tables into picklefile and return the parser.
+
+    yacc writes the file in place, so it writes a temporary file which then
+    replaces picklefile, and other processes never read a partial one.
+    """
+    module = sys.modules[__name__]
+    tmpfile = '%s.%d' % (picklefile, os.getpid())
+    try:
+        parser = yacc.yacc(module = module, picklefile = tmpfile, debug = 0)
+        os.rename(tmpfile, picklefile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    return parser
+
+def _build_parser():
+    module = sys.modules[__name__]
+    pinfo = yacc.ParserReflect(dict((k, getattr(module, k)) for k in dir(module)),
+                               log = yacc.NullLogger())
+    pinfo.get_all()
+    signature = pinfo.signature()
+
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    cachedir = os.path.join(cachedir, 'bitbake')
+    installed = os.path.join(os.path.dirname(os.path.abspath(__file__)), tables_file)
+    cached = os.path.join(cachedir, tables_file)
+    for picklefile in (installed, cached):
+        if _tables_signature(picklefile) == signature:
+            return yacc.yacc(module = module, picklefile = picklefile, debug = 0)
+
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+    except OSError:
+        pass
+    try:
+        return build_tables(cached)
+    except EnvironmentError:
+        # The tables could not be saved, use them for this process only
+        return yacc.yacc(module = module, write_tables = 0, debug = 0)
+
+_build_parser()
 
 
 def parse(input, eof=False, debug=False):
@@ -23,13 +23,20 @@ Handles preparation and execution of a queue of tasks
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import copy
+import heapq
 import os
 import sys
 import signal
 import stat
 import fcntl
+import io
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import logging
 import bb
+import bb.compat
 from bb import msg, data, event
 from bb import monitordisk
 
@@ -82,9 +89,18 @@ runQueueChildProcess = 10
 class RunQueueScheduler(object):
     """
     Control the order tasks are scheduled in.
+
+    A scheduler sets prio_map, the task ids in the order they should run.
+    The runqueue calls newbuildable() for each task as it becomes buildable
+    and next() whenever it can start another one. Schedulers needing a
+    different policy can override either.
     """
     name = "basic"
 
+    # Heap of (priority, task) for the buildable tasks not yet started,
+    # created on first use as subclasses don't have to call __init__
+    buildable = None
+
     def __init__(self, runqueue, rqdata):
         """
         The default scheduler just returns the first buildable task (the
@@ -97,21 +113,44 @@ class RunQueueScheduler(object):
         self.prio_map = []
         self.prio_map.extend(range(numTasks))
 
+    def newbuildable(self, task):
+        """
+        Called when task becomes buildable, queues it by its place in the
+        priority map
+        """
+        if self.buildable is None:
+            self.buildable = []
+            self.rev_prio_map = [0] * len(self.prio_map)
+            for prio, taskid in enumerate(self.prio_map):
+                self.rev_prio_map[taskid] = prio
+        heapq.heappush(self.buildable, (self.rev_prio_map[task], task))
+
     def next_buildable_task(self):
         """
         Return the id of the first task we find that is buildable
         """
-        for tasknum in xrange(len(self.rqdata.runq_fnid)):
-            taskid = self.prio_map[tasknum]
-            if self.rq.runq_running[taskid] == 1:
+        buildable = self.buildable
+        if not buildable:
+            return None
+
+        # Tasks sharing a stamp with a running one have to wait for it
+        deferred = []
+        taskid = None
+        while buildable:
+            entry = heapq.heappop(buildable)
+            if self.rq.runq_running[entry[1]] == 1:
                 continue
-            if self.rq.runq_buildable[taskid] == 1:
-                fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
-                taskname = self.rqdata.runq_task[taskid]
-                stamp = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
-                if stamp in self.rq.build_stamps.values():
-                    continue
-                return taskid
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[entry[1]]]
+            taskname = self.rqdata.runq_task[entry[1]]
+            stamp = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+            if stamp in self.rq.build_stamps_running:
+                deferred.append(entry)
+                continue
+            taskid = entry[1]
+            break
+        for entry in deferred:
+            heapq.heappush(buildable, entry)
+        return taskid
 
     def next(self):
         """
@@ -135,16 +174,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         self.rq = runqueue
         self.rqdata = rqdata
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
-        self.prio_map.reverse()
+        # Heaviest first, ties broken by the highest task number
+        weight = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(len(weight)), key=lambda task: (weight[task], task), reverse=True)
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
     """
@@ -162,21 +194,19 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
+        # Group the tasks by fnid, keeping their order within each group and
+        # ordering the groups by where their first task was
+        fnids = []
+        fnidtasks = {}
+        for task in self.prio_map:
+            fnid = self.rqdata.runq_fnid[task]
+            if fnid not in fnidtasks:
+                fnids.append(fnid)
+                fnidtasks[fnid] = []
+            fnidtasks[fnid].append(task)
         self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
-            fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+        for fnid in fnids:
+            self.prio_map.extend(fnidtasks[fnid])
 
 class RunQueueData:
     """
@@ -192,6 +222,7 @@ class RunQueueData:
 
         self.stampwhitelist = cfgData.getVar("BB_STAMP_WHITELIST", True) or ""
         self.multi_provider_whitelist = (cfgData.getVar("MULTI_PROVIDER_WHITELIST", True) or "").split()
+        self.number_threads = int(cfgData.getVar("BB_NUMBER_THREADS", True) or 1)
 
         self.reset()
 
@@ -723,18 +754,29 @@ class RunQueueData:
                 for st in self.cooker.configuration.invalidate_stamp.split(','):
                     invalidate_task(fn, "do_%s" % st, True)
 
-        # Interate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(range(len(self.runq_fnid)))
-        while len(todeal) > 0:
-            for task in todeal.copy():
-                if len(self.runq_depends[task] - dealtwith) == 0:
-                    dealtwith.add(task)
-                    todeal.remove(task)
-                    procdep = []
-                    for dep in self.runq_depends[task]:
-                        procdep.append(self.taskData.fn_index[self.runq_fnid[dep]] + "." + self.runq_task[dep])
-                    self.runq_hash[task] = bb.parse.siggen.get_taskhash(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], procdep, self.dataCache)
+        # Iterate over the task list in dependency order and call into the
+        # siggen code. Each level only depends on the ones before it, so the
+        # local file checksums for a whole level can be done in parallel
+        depsleft = [len(deps) for deps in self.runq_depends]
+        level = [task for task in xrange(len(self.runq_fnid)) if not depsleft[task]]
+        dealtwith = 0
+        while level:
+            bb.parse.siggen.prefetch_checksums([(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task]) for task in level],
+                                               self.dataCache, self.number_threads)
+            nextlevel = []
+            for task in level:
+                procdep = []
+                for dep in self.runq_depends[task]:
+                    procdep.append(self.taskData.fn_index[self.runq_fnid[dep]] + "." + self.runq_task[dep])
+                self.runq_hash[task] = bb.parse.siggen.get_taskhash(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], procdep, self.dataCache)
+                for revdep in self.runq_revdeps[task]:
+                    depsleft[revdep] -= 1
+                    if not depsleft[revdep]:
+                        nextlevel.append(revdep)
+            dealtwith += len(level)
+            level = nextlevel
+        if dealtwith != len(self.runq_fnid):
+            bb.msg.fatal("RunQueue", "Task hashes could not be computed for %s tasks, circular dependencies?" % (len(self.runq_fnid) - dealtwith))
 
         self.hashes = {}
         self.hash_deps = {}
@@ -793,6 +835,66 @@ class RunQueue:
 
         self.rqexe = None
 
+        # Written to on SIGCHLD so the server can wait for task exits
+        self.sigchld_pipe = None
+        self.sigchld_handler = None
+
+        # Long lived processes which tasks are handed to, if enabled
+        self.workerpool = None
+
+    def sigchld_setup(self):
+        """
+        Have SIGCHLD write to a pipe which the server can select() on
+        along with the task pipes, so exited tasks are reaped and replaced
+        straight away rather than on the next poll
+        """
+        if self.sigchld_pipe:
+            return
+        pipein, pipeout = os.pipe()
+        bb.utils.nonblockingfd(pipein)
+        bb.utils.nonblockingfd(pipeout)
+
+        def sigchld(signum, frame):
+            try:
+                os.write(pipeout, "x")
+            except OSError:
+                # The pipe is full, the server is awake already
+                pass
+
+        try:
+            self.sigchld_handler = signal.signal(signal.SIGCHLD, sigchld)
+        except ValueError:
+            # Not the main thread, the server polls instead
+            os.close(pipein)
+            os.close(pipeout)
+            return
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self.sigchld_pipe = (pipein, pipeout)
+
+    def sigchld_teardown(self):
+        if not self.sigchld_pipe:
+            return
+        signal.signal(signal.SIGCHLD, self.sigchld_handler or signal.SIG_DFL)
+        for fd in self.sigchld_pipe:
+            os.close(fd)
+        self.sigchld_pipe = None
+        self.sigchld_handler = None
+
+    def sigchld_drain(self):
+        if not self.sigchld_pipe:
+            return
+        try:
+            while os.read(self.sigchld_pipe[0], 4096):
+                pass
+        except OSError:
+            pass
+
+    def workerpool_teardown(self):
+        if not self.workerpool:
+            return
+        self.workerpool.shutdown()
+        self.workerpool = None
+
     def check_stamp_task(self, task, taskname = None, recurse = False, cache = None):
         def get_timestamp(f):
             try:
@@ -883,6 +985,10 @@ class RunQueue:
             if self.cooker.configuration.dump_signatures:
                 self.dump_signatures()
             else:
+                self.sigchld_setup()
+                if self.cfgData.getVar("BB_TASK_WORKER_POOL", True) == "1":
+                    cachesize = int(self.cfgData.getVar("BB_TASK_WORKER_CACHE", True) or 8)
+                    self.workerpool = RunQueueWorkerPool(self, self.rqdata.number_threads, cachesize)
                 self.rqexe = RunQueueExecuteScenequeue(self)
 
         if self.state in [runQueueSceneRun, runQueueRunning, runQueueCleanUp]:
@@ -901,8 +1007,13 @@ class RunQueue:
 
         if self.state is runQueueCleanUp:
            self.rqexe.finish()
+           if self.state is runQueueCleanUp:
+               retval = self.rqexe.wait_fds()
 
         if self.state is runQueueComplete or self.state is runQueueFailed:
+            self.workerpool_teardown()
+            self.sigchld_teardown()
+            bb.codeparser.compile_cache_savemerge(self.cfgData)
             if self.rqexe.stats.failed:
                 logger.info("Tasks Summary: Attempted %d tasks of which %d didn't need to be rerun and %d failed.", self.rqexe.stats.completed + self.rqexe.stats.failed, self.rqexe.stats.skipped, self.rqexe.stats.failed)
             else:
@@ -938,6 +1049,8 @@ class RunQueue:
         except:
             logger.error("An uncaught exception occured in runqueue, please see the failure below:")
             self.state = runQueueComplete
+            self.workerpool_teardown()
+            self.sigchld_teardown()
             raise
 
     def finish_runqueue(self, now = False):
@@ -966,6 +1079,9 @@ class RunQueue:
 
 class RunQueueExecute:
 
+    # Whether task failures are expected and should not be logged
+    quieterrors = False
+
     def __init__(self, rq):
         self.rq = rq
         self.cooker = rq.cooker
@@ -981,15 +1097,40 @@ class RunQueueExecute:
         self.build_pids = {}
         self.build_pipes = {}
         self.build_stamps = {}
+        self.build_stamps_running = set()
         self.failed_fnids = []
 
         self.stampcache = {}
 
+    def wait_fds(self):
+        """
+        Return the file descriptors which become readable when a running
+        task has something to report or exits, for the server to wait on,
+        or how long to sleep when exits can't be waited for
+        """
+        if not self.rq.sigchld_pipe:
+            # Off the main thread there's no SIGCHLD handler, so poll
+            return 0.5
+        fds = [pipe.input for pipe in self.build_pipes.itervalues()]
+        if self.rq.workerpool:
+            fds.extend(self.rq.workerpool.wait_fds())
+        fds.append(self.rq.sigchld_pipe[0])
+        return fds
+
     def runqueue_process_waitpid(self):
         """
         Return none is there are no processes awaiting result collection, otherwise
         collect the process exit codes and close the information pipe.
         """
+        self.rq.sigchld_drain()
+        if self.rq.workerpool:
+            # Pool workers report the exit codes of their tasks
+            exited = self.rq.workerpool.read()
+            for pid, status in exited:
+                self.task_exited(pid, status)
+            if exited:
+                return True
+
         pid, status = os.waitpid(-1, os.WNOHANG)
         if pid == 0 or os.WIFSTOPPED(status):
             return None
@@ -1001,14 +1142,31 @@ class RunQueueExecute:
             # a signal, we return an exit code of 128 + SIGNUM
             status = 128 + os.WTERMSIG(status)
 
+        if self.rq.workerpool:
+            reported = self.rq.workerpool.worker_exited(pid)
+            for exitpid, exitstatus in reported:
+                self.task_exited(exitpid, exitstatus)
+            if pid not in self.build_pids:
+                if not reported:
+                    logger.warn("Idle task worker %s exited with status %s", pid, status)
+                return True
+            if status == 0:
+                # The worker went away without reporting the task
+                status = 1
+
+        return self.task_exited(pid, status)
+
+    def task_exited(self, pid, status):
         task = self.build_pids[pid]
         del self.build_pids[pid]
 
-        self.build_pipes[pid].close()
-        del self.build_pipes[pid]
+        if pid in self.build_pipes:
+            self.build_pipes[pid].close()
+            del self.build_pipes[pid]
 
         # self.build_stamps[pid] may not exist when use shared work directory.
         if pid in self.build_stamps:
+            self.build_stamps_running.discard(self.build_stamps[pid])
             del self.build_stamps[pid]
 
         if status != 0:
@@ -1054,7 +1212,24 @@ class RunQueueExecute:
         self.rq.state = runQueueComplete
         return
 
-    def fork_off_task(self, fn, task, taskname, quieterrors=False):
+    def start_task(self, fn, task, taskname):
+        """
+        Run taskname of fn, either in a new process or on a pool worker, and
+        return the pid whose exit is waited on for it
+        """
+        if self.rq.workerpool:
+            return self.rq.workerpool.start(fn, task, taskname, self.quieterrors)
+
+        pid, pipein, pipeout = self.fork_off_task(fn, task, taskname, self.quieterrors)
+        self.build_pipes[pid] = runQueuePipe(pipein, pipeout, self.cfgData)
+        return pid
+
+    def fork_off_task(self, fn, task, taskname, quieterrors=False, the_data=None, pipeout=None):
+        """
+        Fork a process running taskname of fn. A pool worker passes in the
+        datastore it already has for fn and its own event pipe, otherwise
+        the child parses fn itself and reports over a new pipe.
+        """
         # We need to setup the environment BEFORE the fork, since
         # a fork() or exec*() activates PSEUDO...
 
@@ -1092,16 +1267,28 @@ class RunQueueExecute:
 
         sys.stdout.flush()
         sys.stderr.flush()
+        bb.event.worker_flush()
+        pipein = None
         try:
-            pipein, pipeout = os.pipe()
-            pipein = os.fdopen(pipein, 'rb', 4096)
-            pipeout = os.fdopen(pipeout, 'wb', 0)
+            if pipeout is None:
+                pipein, pipeout = os.pipe()
+                pipein = os.fdopen(pipein, 'rb', 4096)
+                pipeout = os.fdopen(pipeout, 'wb', 0)
             pid = os.fork()
         except OSError as e:
             bb.msg.fatal("RunQueue", "fork failed: %d (%s)" % (e.errno, e.strerror))
 
         if pid == 0:
-            pipein.close()
+            if pipein:
+                pipein.close()
+            bb.codeparser.compile_cache_forked()
+            if self.rq.sigchld_pipe:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for fd in self.rq.sigchld_pipe:
+                    os.close(fd)
+            if self.rq.workerpool:
+                # Forked from a pool worker, drop its SIGTERM handler
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
             # Save out the PID so that the event can include it the
             # events
@@ -1122,11 +1309,21 @@ class RunQueueExecute:
             bb.parse.siggen.set_taskdata(self.rqdata.hashes, self.rqdata.hash_deps)
             ret = 0
             try:
-                the_data = bb.cache.Cache.loadDataFull(fn, self.cooker.get_file_appends(fn), self.cooker.configuration.data)
+                if the_data is None:
+                    the_data = bb.cache.Cache.loadDataFull(fn, self.cooker.get_file_appends(fn), self.cooker.configuration.data)
+                    hashes = self.rqdata.hashes
+                    hash_deps = self.rqdata.hash_deps
+                else:
+                    for var in the_data.getVar('__BBHANDLERS') or []:
+                        bb.event.register(var, the_data.getVar(var), (the_data.getVarFlag(var, "eventmask", True) or "").split())
+                    # Only the hashes this task can refer to
+                    ident = "%s.%s" % (fn, self.rqdata.runq_task[task])
+                    hash_deps = {ident: self.rqdata.hash_deps[ident]}
+                    hashes = [ident] + hash_deps[ident]
                 the_data.setVar('BB_TASKHASH', self.rqdata.runq_hash[task])
-                for h in self.rqdata.hashes:
+                for h in hashes:
                     the_data.setVar("BBHASH_%s" % h, self.rqdata.hashes[h])
-                for h in self.rqdata.hash_deps:
+                for h in hash_deps:
                     the_data.setVar("BBHASHDEPS_%s" % h, self.rqdata.hash_deps[h])
 
                 # exported_vars() returns a generator which *cannot* be passed to os.environ.update() 
@@ -1145,10 +1342,14 @@ class RunQueueExecute:
             except Exception as exc:
                 if not quieterrors:
                     logger.critical(str(exc))
+                bb.event.worker_flush()
                 os._exit(1)
             try:
                 if not self.cooker.configuration.dry_run:
                     ret = bb.build.exec_task(fn, taskname, the_data)
+                # Hand code compiled by the task back for the next run
+                bb.codeparser.compile_cache_save(the_data)
+                bb.event.worker_flush()
                 os._exit(ret)
             except:
                 os._exit(1)
@@ -1260,6 +1461,10 @@ class RunQueueExecuteTasks(RunQueueExecute):
             bb.fatal("Invalid scheduler '%s'.  Available schedulers: %s" %
                      (self.scheduler, ", ".join(obj.name for obj in schedulers)))
 
+        for task in xrange(self.stats.total):
+            if self.runq_buildable[task] == 1:
+                self.sched.newbuildable(task)
+
 
     def get_schedulers(self):
         schedulers = set(obj for obj in globals().values()
@@ -1301,6 +1506,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
                     alldeps = 0
             if alldeps == 1:
                 self.runq_buildable[revdep] = 1
+                self.sched.newbuildable(revdep)
                 fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[revdep]]
                 taskname = self.rqdata.runq_task[revdep]
                 logger.debug(1, "Marking task %s (%s, %s) as buildable", revdep, fn, taskname)
@@ -1369,11 +1575,11 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 startevent = runQueueTaskStarted(task, self.stats, self.rq)
                 bb.event.fire(startevent, self.cfgData)
 
-            pid, pipein, pipeout = self.fork_off_task(fn, task, taskname)
+            pid = self.start_task(fn, task, taskname)
 
             self.build_pids[pid] = task
-            self.build_pipes[pid] = runQueuePipe(pipein, pipeout, self.cfgData)
             self.build_stamps[pid] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+            self.build_stamps_running.add(self.build_stamps[pid])
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1384,7 +1590,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
         if self.stats.active > 0:
             if self.runqueue_process_waitpid() is None:
-                return 0.5
+                return self.wait_fds()
             return True
 
         if len(self.failed_fnids) != 0:
@@ -1403,6 +1609,9 @@ class RunQueueExecuteTasks(RunQueueExecute):
         return True
 
 class RunQueueExecuteScenequeue(RunQueueExecute):
+
+    quieterrors = True
+
     def __init__(self, rq):
         RunQueueExecute.__init__(self, rq)
 
@@ -1653,10 +1862,9 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
             startevent = sceneQueueTaskStarted(task, self.stats, self.rq)
             bb.event.fire(startevent, self.cfgData)
 
-            pid, pipein, pipeout = self.fork_off_task(fn, realtask, taskname)
+            pid = self.start_task(fn, realtask, taskname)
 
             self.build_pids[pid] = task
-            self.build_pipes[pid] = runQueuePipe(pipein, pipeout, self.cfgData)
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1667,7 +1875,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
 
         if self.stats.active > 0:
             if self.runqueue_process_waitpid() is None:
-                return 0.5
+                return self.wait_fds()
             return True
 
         # Convert scenequeue_covered task numbers into full taskgraph ids
@@ -1684,9 +1892,6 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
         self.rq.state = runQueueRunInit
         return True
 
-    def fork_off_task(self, fn, task, taskname):
-        return RunQueueExecute.fork_off_task(self, fn, task, taskname, quieterrors=True)
-
 class TaskFailure(Exception):
     """
     Exception raised when a task in a runqueue fails
@@ -1765,30 +1970,291 @@ class runQueuePipe():
     """
     Abstraction for a pipe between a worker thread and the server
     """
+    # The kinds of frame the worker sends, and the largest frame expected.
+    # Anything else means the stream is garbled and can't be followed.
+    kinds = ("e",)
+    maxframe = 64 * 1024 * 1024
+
     def __init__(self, pipein, pipeout, d):
         self.input = pipein
         pipeout.close()
         bb.utils.nonblockingfd(self.input)
-        self.queue = ""
+        # Read straight into a buffer which is reused for the whole pipe,
+        # self.start and self.end mark the data not yet handled
+        self.reader = io.FileIO(self.input.fileno(), 'r', closefd=False)
+        self.queue = bytearray(102400)
+        self.start = 0
+        self.end = 0
+        self.garbled = False
         self.d = d
 
     def read(self):
-        start = len(self.queue)
+        if len(self.queue) - self.end < 4096:
+            # Move the partial frame to the front, and grow the buffer for
+            # frames larger than it
+            pending = self.end - self.start
+            self.queue[:pending] = self.queue[self.start:self.end]
+            self.start = 0
+            self.end = pending
+            if len(self.queue) - self.end < 4096:
+                self.queue.extend(bytearray(len(self.queue)))
+
+        view = memoryview(self.queue)
         try:
-            self.queue = self.queue + self.input.read(102400)
+            count = self.reader.readinto(view[self.end:]) or 0
         except (OSError, IOError):
-            pass
-        end = len(self.queue)
-        index = self.queue.find("</event>")
-        while index != -1:
-            bb.event.fire_from_worker(self.queue[:index+8], self.d)
-            self.queue = self.queue[index+8:]
-            index = self.queue.find("</event>")
-        return (end > start)
+            count = 0
+        self.end += count
+        if self.garbled:
+            # Keep draining the pipe so the worker doesn't block on it
+            self.start = self.end = 0
+            return count > 0
+
+        header = bb.event.worker_frame
+        while self.end - self.start >= header.size:
+            kind, length = header.unpack_from(self.queue, self.start)
+            if kind not in self.kinds or length > self.maxframe:
+                logger.error("Garbled message from a worker (type %s, length %d), ignoring the rest of its output" % (repr(kind), length))
+                self.garbled = True
+                self.start = self.end = 0
+                break
+            begin = self.start + header.size
+            if self.end - begin < length:
+                break
+            self.start = begin + length
+            self.handle(kind, view[begin:self.start].tobytes())
+        if self.start == self.end:
+            self.start = self.end = 0
+        return count > 0
+
+    def handle(self, kind, data):
+        if kind == "e":
+            bb.event.fire_from_worker(data, self.d)
 
     def close(self):
         while self.read():
             continue
-        if len(self.queue) > 0:
-            print("Warning, worker left partial message: %s" % self.queue)
+        if self.end > self.start:
+            print("Warning, worker left partial message: %s" % repr(str(self.queue[self.start:self.end])))
+        self.reader.close()
         self.input.close()
+
+class runQueueWorkerPipe(runQueuePipe):
+    """
+    The event pipe of a pool worker, which also carries the exit codes of
+    the tasks the worker has run
+    """
+    kinds = ("e", "x")
+
+    def __init__(self, pipein, pipeout, d):
+        runQueuePipe.__init__(self, pipein, pipeout, d)
+        self.exitcodes = []
+
+    def handle(self, kind, data):
+        if kind == "x":
+            self.exitcodes.append(int(data))
+        else:
+            runQueuePipe.handle(self, kind, data)
+
+class RunQueueWorkerPool:
+    """
+    Long lived worker processes forked from the server which tasks are handed
+    to over a pipe. Each worker keeps the datastores of the last few recipes
+    it ran tasks for, so a recipe is parsed once per worker rather than once
+    per task, and forks each task off from its copy of the datastore.
+    """
+    def __init__(self, rq, size, cachesize):
+        self.rq = rq
+        self.size = size
+        self.cachesize = cachesize
+        # pid -> (command pipe, event pipe)
+        self.workers = {}
+        self.idle = set()
+        # pid -> the recipes the worker has datastores for, oldest first
+        self.loaded = {}
+
+        # Worker side state
+        self.datastores = None
+        self.handlers = None
+        self.child = None
+
+    def wait_fds(self):
+        return [pipe.input for cmd, pipe in self.workers.itervalues()]
+
+    def start(self, fn, task, taskname, quieterrors):
+        """
+        Hand a task to a worker, preferring an idle one which has fn parsed
+        already, and return the pid of the worker
+        """
+        pid = None
+        for worker in self.idle:
+            if fn in self.loaded[worker]:
+                pid = worker
+                break
+        if pid is None:
+            if len(self.workers) < self.size:
+                pid = self.spawn()
+            elif self.idle:
+                pid = next(iter(self.idle))
+            else:
+                bb.msg.fatal("RunQueue", "All %d task workers are busy - Should never happen!" % self.size)
+        self.idle.discard(pid)
+
+        loaded = self.loaded[pid]
+        if fn in loaded:
+            loaded.remove(fn)
+        loaded.append(fn)
+        del loaded[:-self.cachesize]
+
+        pickle.dump((fn, task, taskname, quieterrors), self.workers[pid][0], -1)
+        return pid
+
+    def read(self):
+        """
+        Process the output of the workers, returning (pid, exitcode) for each
+        task which has finished
+        """
+        exited = []
+        for pid, (cmd, pipe) in self.workers.iteritems():
+            pipe.read()
+            for status in pipe.exitcodes:
+                exited.append((pid, status))
+                self.idle.add(pid)
+            del pipe.exitcodes[:]
+        return exited
+
+    def worker_exited(self, pid):
+        """
+        Forget a worker which has exited, returning anything it reported
+        before it went
+        """
+        if pid not in self.workers:
+            return []
+        cmd, pipe = self.workers.pop(pid)
+        self.idle.discard(pid)
+        del self.loaded[pid]
+        cmd.close()
+        pipe.close()
+        return [(pid, status) for status in pipe.exitcodes]
+
+    def shutdown(self):
+        for pid, (cmd, pipe) in self.workers.iteritems():
+            if pid not in self.idle:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            cmd.close()
+        for pid, (cmd, pipe) in self.workers.iteritems():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            pipe.close()
+        self.workers = {}
+        self.idle = set()
+        self.loaded = {}
+
+    def spawn(self):
+        cmdin, cmdout = os.pipe()
+        pipein, pipeout = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            bb.msg.fatal("RunQueue", "fork failed: %d (%s)" % (e.errno, e.strerror))
+
+        if pid == 0:
+            os.close(cmdout)
+            os.close(pipein)
+            try:
+                self.worker(os.fdopen(cmdin, 'rb'), os.fdopen(pipeout, 'wb', 0))
+            except:
+                logger.exception("Task worker %s failed", os.getpid())
+                os._exit(1)
+            os._exit(0)
+
+        os.close(cmdin)
+        self.workers[pid] = (os.fdopen(cmdout, 'wb', 0),
+                             runQueueWorkerPipe(os.fdopen(pipein, 'rb', 4096), os.fdopen(pipeout, 'wb', 0), self.rq.cfgData))
+        self.loaded[pid] = []
+        return pid
+
+    def worker(self, cmdin, pipeout):
+        # The other workers' pipes must only be open in the server or they
+        # never see the end of their command stream
+        for cmd, pipe in self.workers.itervalues():
+            cmd.close()
+            pipe.input.close()
+        self.workers = {}
+        if self.rq.sigchld_pipe:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in self.rq.sigchld_pipe:
+                os.close(fd)
+            self.rq.sigchld_pipe = None
+
+        def sigterm(signum, frame):
+            if self.child:
+                try:
+                    os.kill(-self.child, signal.SIGTERM)
+                except OSError:
+                    pass
+            os._exit(1)
+        signal.signal(signal.SIGTERM, sigterm)
+
+        bb.event.worker_pid = os.getpid()
+        bb.event.worker_pipe = pipeout
+        self.rq.state = runQueueChildProcess
+        os.setpgid(0, 0)
+        newsi = os.open(os.devnull, os.O_RDWR)
+        os.dup2(newsi, sys.stdin.fileno())
+
+        cooker = self.rq.cooker
+        cooker.configuration.data.setVar("BB_WORKERCONTEXT", "1")
+        self.datastores = bb.compat.OrderedDict()
+        bb.codeparser.compile_cache_forked()
+        # Parsing a recipe registers its event handlers, which mustn't be
+        # left behind for the next recipe. The task's own are registered
+        # again in the process forked off for it.
+        self.handlers = bb.event.get_handlers()
+
+        while True:
+            try:
+                command = pickle.load(cmdin)
+            except EOFError:
+                break
+            fn, task, taskname, quieterrors = command
+
+            try:
+                the_data = self.datastores.pop(fn, None)
+                if the_data is None:
+                    try:
+                        the_data = bb.cache.Cache.loadDataFull(fn, cooker.get_file_appends(fn), cooker.configuration.data)
+                    finally:
+                        bb.event.set_handlers(self.handlers)
+                    # Save what parsing compiled here rather than in each task
+                    bb.codeparser.compile_cache_save(cooker.configuration.data)
+                    bb.codeparser.compile_cache_forked()
+                self.datastores[fn] = the_data
+                while len(self.datastores) > self.cachesize:
+                    self.datastores.popitem(last=False)
+            except Exception as exc:
+                if not quieterrors:
+                    logger.critical(str(exc))
+                self.exited(pipeout, 1)
+                continue
+
+            self.child, pipein, pipeout = self.rq.rqexe.fork_off_task(fn, task, taskname, quieterrors, the_data, pipeout)
+            pid, status = os.waitpid(self.child, 0)
+            self.child = None
+            if os.WIFEXITED(status):
+                status = os.WEXITSTATUS(status)
+            elif os.WIFSIGNALED(status):
+                status = 128 + os.WTERMSIG(status)
+            self.exited(pipeout, status)
+
+    def exited(self, pipeout, status):
+        bb.event.worker_flush()
+        status = str(status)
+        pipeout.write(bb.event.worker_frame.pack("x", len(status)) + status)
@@ -26,6 +26,7 @@
     in the server's main loop.
 """
 
+import errno
 import time
 import bb
 import signal
@@ -126,6 +127,7 @@ class BitBakeNoneServer():
         #print "Idle timeout, running idle functions"
         #if len(self._idlefuns) == 0:
         nextsleep = delay
+        fds = []
         for function, data in self._idlefuns.items():
             try:
                 retval = function(self, data, False)
@@ -134,6 +136,9 @@ class BitBakeNoneServer():
                     del self._idlefuns[function]
                 elif retval is True:
                     nextsleep = None
+                elif isinstance(retval, list):
+                    # File descriptors to wake up on
+                    fds = fds + retval
                 elif nextsleep is None:
                     continue
                 elif retval < nextsleep:
@@ -147,9 +152,16 @@ class BitBakeNoneServer():
                 pass
         if nextsleep is not None:
             #print "Sleeping for %s (%s)" % (nextsleep, delay)
-            signal.signal(signal.SIGCHLD, chldhandler)
-            time.sleep(nextsleep)
-            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            if fds:
+                try:
+                    select.select(fds, [], [], nextsleep)
+                except select.error as exc:
+                    if exc.args[0] != errno.EINTR:
+                        raise
+            else:
+                handler = signal.signal(signal.SIGCHLD, chldhandler)
+                time.sleep(nextsleep)
+                signal.signal(signal.SIGCHLD, handler)
 
     def server_exit(self):
         # Tell idle functions we're exiting
@@ -22,10 +22,12 @@
 
 import bb
 import bb.event
+import errno
 import itertools
 import logging
 import multiprocessing
 import os
+import select
 import signal
 import sys
 import time
@@ -104,7 +106,7 @@ class ProcessServer(Process):
                     command = self.command_channel.recv()
                     self.runCommand(command)
 
-                self.idle_commands(.1)
+                self.idle_commands(.1, [self.command_channel])
             except Exception:
                 logger.exception('Running command %s', command)
 
@@ -114,8 +116,9 @@ class ProcessServer(Process):
         self.cooker.stop()
         self.idle_commands(.1)
 
-    def idle_commands(self, delay):
+    def idle_commands(self, delay, fds=None):
         nextsleep = delay
+        fds = fds or []
 
         for function, data in self._idlefunctions.items():
             try:
@@ -124,6 +127,9 @@ class ProcessServer(Process):
                     del self._idlefunctions[function]
                 elif retval is True:
                     nextsleep = None
+                elif isinstance(retval, list):
+                    # File descriptors to wake up on
+                    fds = fds + retval
                 elif nextsleep is None:
                     continue
                 elif retval < nextsleep:
@@ -134,7 +140,14 @@ class ProcessServer(Process):
                 logger.exception('Running idle function')
 
         if nextsleep is not None:
-            time.sleep(nextsleep)
+            if fds:
+                try:
+                    select.select(fds, [], [], nextsleep)
+                except select.error as exc:
+                    if exc.args[0] != errno.EINTR:
+                        raise
+            else:
+                time.sleep(nextsleep)
 
     def runCommand(self, command):
         """
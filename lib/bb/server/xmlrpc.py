@@ -32,6 +32,8 @@
 """
 
 import bb
+import errno
+import socket
 import xmlrpclib, sys
 from bb import daemonize
 from bb.ui import uievent
@@ -121,6 +123,52 @@ def _create_server(host, port):
 
     return s
 
+class BBUIEventChannel():
+    """
+    Holds on to the events for a remote UI and sends them in batches over a
+    single connection to it
+    """
+
+    # Send once this many bytes of events are waiting
+    batch_bytes = 65536
+
+    def __init__(self, host, port, compress=False):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.compress = compress
+        self.pending = []
+        self.size = 0
+        # Set once the UI has gone away, the server then drops the channel
+        self.dead = False
+        # bb.event hands events to the event attribute of a UI handler
+        self.event = self
+
+    def sendpickle(self, event):
+        if self.dead:
+            return
+        self.pending.append(event)
+        self.size += len(event)
+        if self.size >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.pending or self.dead:
+            return
+        batch = uievent.encode_batch(self.pending, self.compress)
+        self.pending = []
+        self.size = 0
+        try:
+            self.sock.sendall(batch)
+        except socket.error:
+            self.dead = True
+            self.sock.close()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.sock.close()
+
 class BitBakeServerCommands():
     def __init__(self, server):
         self.server = server
@@ -133,11 +181,25 @@ class BitBakeServerCommands():
 
         return bb.event.register_UIHhandler(s)
 
+    def registerEventChannel(self, host, port, compress=False):
+        """
+        Register a remote UI which is sent batches of events over a
+        connection to host:port, compressed with zlib if compress is set
+        """
+        channel = BBUIEventChannel(host, port, compress)
+        handlerNum = bb.event.register_UIHhandler(channel)
+        self.server.event_channels[handlerNum] = channel
+        return handlerNum
+
     def unregisterEventHandler(self, handlerNum):
         """
         Unregister a remote UI Event Handler
         """
-        return bb.event.unregister_UIHhandler(handlerNum)
+        ret = bb.event.unregister_UIHhandler(handlerNum)
+        channel = self.server.event_channels.pop(handlerNum, None)
+        if channel:
+            channel.close()
+        return ret
 
     def runCommand(self, command):
         """
@@ -171,6 +233,7 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
                                     requestHandler=SimpleXMLRPCRequestHandler,
                                     logRequests=False, allow_none=True)
         self._idlefuns = {}
+        self.event_channels = {}
         self.host, self.port = self.socket.getsockname()
         #self.register_introspection_functions()
         self.commands = BitBakeServerCommands(self)
@@ -198,6 +261,17 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
     def serve_forever(self):
         bb.cooker.server_main(self.cooker, self._serve_forever)
 
+    def flush_events(self):
+        """
+        Send the events waiting for each remote UI, dropping any UI which
+        has gone away
+        """
+        for handlerNum, channel in self.event_channels.items():
+            channel.flush()
+            if channel.dead:
+                bb.event.unregister_UIHhandler(handlerNum)
+                del self.event_channels[handlerNum]
+
     def _serve_forever(self):
         """
         Serve Requests. Overloaded to honor a quit command
@@ -209,6 +283,7 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
             self.handle_request()
             #print "Idle timeout, running idle functions"
             nextsleep = None
+            fds = []
             for function, data in self._idlefuns.items():
                 try:
                     retval = function(self, data, False)
@@ -216,6 +291,9 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
                         del self._idlefuns[function]
                     elif retval is True:
                         nextsleep = 0
+                    elif isinstance(retval, list):
+                        # File descriptors to wake up on
+                        fds = fds + retval
                     elif nextsleep is 0:
                         continue
                     elif nextsleep is None:
@@ -228,6 +306,16 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
                     import traceback
                     traceback.print_exc()
                     pass
+            self.flush_events()
+            if fds and nextsleep is not 0:
+                # Wait for a request or for one of the descriptors, whichever
+                # comes first, and then handle any request without blocking
+                try:
+                    select.select([self] + fds, [], [], nextsleep or 0.5)
+                except select.error as exc:
+                    if exc.args[0] != errno.EINTR:
+                        raise
+                nextsleep = 0
             if nextsleep is None and len(self._idlefuns) > 0:
                 nextsleep = 0
             self.timeout = nextsleep
@@ -238,6 +326,9 @@ class BitBakeXMLRPCServer(SimpleXMLRPCServer):
             except:
                 pass
 
+        self.flush_events()
+        for channel in self.event_channels.values():
+            channel.sock.close()
         self.server_close()
         return
 
@@ -249,7 +340,9 @@ class BitbakeServerInfo():
 class BitBakeServerConnection():
     def __init__(self, serverinfo, clientinfo=("localhost", 0)):
         self.connection = _create_server(serverinfo.host, serverinfo.port)
-        self.events = uievent.BBUIEventQueue(self.connection, clientinfo)
+        # Only compress events when they come from another machine
+        compress = serverinfo.host not in ("localhost", "127.0.0.1")
+        self.events = uievent.BBUIEventQueue(self.connection, clientinfo, compress)
         for event in bb.event.ui_queue:
             self.events.queue_event(event)
 
@@ -42,6 +42,9 @@ class SignatureGenerator(object):
     def get_taskhash(self, fn, task, deps, dataCache):
         return "0"
 
+    def prefetch_checksums(self, tasks, dataCache, threads):
+        return
+
     def set_taskdata(self, hashes, deps):
         return
 
@@ -83,6 +86,69 @@ class SignatureGeneratorBasic(SignatureGenerator):
         else:
             self.twl = None
 
+    def _dep_closures(self, roots, gendeps):
+        """
+        Return the variables reachable from each of roots, not looking
+        past whitelisted variables. Variables in a dependency loop share
+        the same set, found with Tarjan's strongly connected components
+        algorithm, and each set is built from those of the variables it
+        depends on so tasks share the work for their common dependencies.
+        """
+        whitelist = self.basewhitelist
+        empty = frozenset()
+        def edges(var):
+            if var in whitelist:
+                return empty
+            return gendeps[var]
+
+        closure = {}
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        for root in roots:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(edges(root)))]
+            while work:
+                var, it = work[-1]
+                for dep in it:
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = len(index)
+                        stack.append(dep)
+                        onstack.add(dep)
+                        work.append((dep, iter(edges(dep))))
+                        break
+                    elif dep in onstack:
+                        lowlink[var] = min(lowlink[var], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[var])
+                    if lowlink[var] != index[var]:
+                        continue
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        onstack.discard(member)
+                        component.add(member)
+                        if member == var:
+                            break
+                    reach = set()
+                    for member in component:
+                        for dep in edges(member):
+                            reach.add(dep)
+                            if dep not in component:
+                                reach |= closure[dep]
+                    reach = frozenset(reach) or empty
+                    for member in component:
+                        closure[member] = reach
+        return closure
+
     def _build_data(self, fn, d):
 
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d)
@@ -90,6 +156,15 @@ class SignatureGeneratorBasic(SignatureGenerator):
         taskdeps = {}
         basehash = {}
 
+        deps = set()
+        for task in tasklist:
+            deps |= gendeps[task]
+        closure = self._dep_closures(deps, gendeps)
+
+        # Hash of each variable's name and value, combined into the hash of
+        # every task which depends on it
+        varhash = {}
+
         for task in tasklist:
             data = d.getVar(task, False)
             lookupcache[task] = data
@@ -98,22 +173,14 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 bb.error("Task %s from %s seems to be empty?!" % (task, fn))
                 data = ''
 
-            newdeps = gendeps[task]
-            seen = set()
-            while newdeps:
-                nextdeps = newdeps
-                seen |= nextdeps
-                newdeps = set()
-                for dep in nextdeps:
-                    if dep in self.basewhitelist:
-                        continue
-                    newdeps |= gendeps[dep]
-                newdeps -= seen
-
-            alldeps = seen - self.basewhitelist
+            alldeps = set(gendeps[task])
+            for dep in gendeps[task]:
+                alldeps |= closure[dep]
+            alldeps = sorted(alldeps - self.basewhitelist)
 
-            for dep in sorted(alldeps):
-                data = data + dep
+            for dep in alldeps:
+                if dep in varhash:
+                    continue
                 if dep in lookupcache:
                     var = lookupcache[dep]
                 elif dep[-1] == ']':
@@ -123,10 +190,15 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 else:
                     var = d.getVar(dep, False)
                     lookupcache[dep] = var
+                varh = hashlib.md5(dep)
                 if var:
-                    data = data + str(var)
-            self.basehash[fn + "." + task] = hashlib.md5(data).hexdigest()
-            taskdeps[task] = sorted(alldeps)
+                    varh.update("\0" + str(var))
+                varhash[dep] = varh.digest()
+
+            h = hashlib.md5(data)
+            h.update("".join([varhash[dep] for dep in alldeps]))
+            self.basehash[fn + "." + task] = h.hexdigest()
+            taskdeps[task] = alldeps
 
         self.taskdeps[fn] = taskdeps
         self.gendeps[fn] = gendeps
@@ -170,6 +242,17 @@ class SignatureGeneratorBasic(SignatureGenerator):
             pass
         return taint
 
+    def prefetch_checksums(self, tasks, dataCache, threads):
+        """
+        Checksum the local files of the (fn, task) pairs in tasks ahead of
+        their get_taskhash() calls, which have to be made in dependency order
+        """
+        filelists = []
+        for (fn, task) in tasks:
+            if task in dataCache.file_checksums[fn]:
+                filelists.append((dataCache.file_checksums[fn][task], dataCache.pkg_fn[fn]))
+        bb.fetch2.prefetch_file_checksums(filelists, threads)
+
     def get_taskhash(self, fn, task, deps, dataCache):
         k = fn + "." + task
         data = dataCache.basetaskhash[k]
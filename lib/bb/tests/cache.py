@@ -0,0 +1,150 @@
+#
+# BitBake Tests for the recipe cache store (cache.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import bb
+import bb.cache
+
+class IndexedCacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tempdir, "bb_cache.dat.test")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self):
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        cachefile.load()
+        return cachefile
+
+    def test_missing(self):
+        cachefile = self.reopen()
+        self.assertFalse(cachefile.valid)
+        self.assertEqual(len(cachefile), 0)
+
+    def test_roundtrip(self):
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : ["a"], "virtual:native:a.bb" : ["b"]}, [])
+        cachefile = self.reopen()
+        self.assertTrue(cachefile.valid)
+        self.assertEqual(sorted(cachefile.keys()), ["a.bb", "virtual:native:a.bb"])
+        self.assertEqual(cachefile.get("virtual:native:a.bb"), ["b"])
+
+    def test_journal(self):
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a", "b.bb" : "b", "c.bb" : "c"}, [])
+        size = os.path.getsize(self.cachefile)
+        cachefile = self.reopen()
+        cachefile.update({"b.bb" : "b2"}, ["c.bb"], limit=4096)
+        self.assertEqual(os.path.getsize(self.cachefile), size)
+        self.assertTrue(os.path.exists(cachefile.journalfile))
+        cachefile = self.reopen()
+        self.assertEqual(sorted(cachefile.keys()), ["a.bb", "b.bb"])
+        self.assertFalse("c.bb" in cachefile)
+        self.assertEqual(cachefile.get("a.bb"), "a")
+        self.assertEqual(cachefile.get("b.bb"), "b2")
+
+    def test_truncated_journal(self):
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a"}, [])
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a2"}, [], limit=4096)
+        with open(cachefile.journalfile, "ab") as f:
+            f.write("\x05\x00")
+        cachefile = self.reopen()
+        self.assertEqual(cachefile.get("a.bb"), "a2")
+        cachefile.update({"b.bb" : "b"}, [], limit=4096)
+        cachefile = self.reopen()
+        self.assertEqual(cachefile.get("a.bb"), "a2")
+        self.assertEqual(cachefile.get("b.bb"), "b")
+
+    def test_compact(self):
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a" * 100, "b.bb" : "b" * 100}, [])
+        for i in range(10):
+            cachefile = self.reopen()
+            cachefile.update({"a.bb" : str(i) * 100}, [], limit=512)
+        if os.path.exists(cachefile.journalfile):
+            self.assertTrue(os.path.getsize(cachefile.journalfile) <= 512)
+        cachefile = self.reopen()
+        self.assertEqual(cachefile.get("a.bb"), "9" * 100)
+        self.assertEqual(cachefile.get("b.bb"), "b" * 100)
+        cachefile.update({}, ["a.bb"], limit=0)
+        self.assertFalse(os.path.exists(cachefile.journalfile))
+        cachefile = self.reopen()
+        self.assertEqual(cachefile.keys(), ["b.bb"])
+
+    def test_stale_journal(self):
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a", "b.bb" : "b"}, [])
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a2"}, [], limit=4096)
+        with open(cachefile.journalfile, "rb") as f:
+            journal = f.read()
+        cachefile = self.reopen()
+        cachefile.update({"a.bb" : "a3"}, ["b.bb"], limit=0)
+        # As if we crashed before the old journal was removed
+        with open(cachefile.journalfile, "wb") as f:
+            f.write(journal)
+        cachefile = self.reopen()
+        self.assertEqual(cachefile.keys(), ["a.bb"])
+        self.assertEqual(cachefile.get("a.bb"), "a3")
+        cachefile.update({"c.bb" : "c"}, [], limit=4096)
+        cachefile = self.reopen()
+        self.assertEqual(sorted(cachefile.keys()), ["a.bb", "c.bb"])
+        self.assertEqual(cachefile.get("a.bb"), "a3")
+
+    def test_invalid(self):
+        with open(self.cachefile, "wb") as f:
+            f.write("not a cache file at all")
+        cachefile = self.reopen()
+        self.assertFalse(cachefile.valid)
+
+class DependsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tempdir, "bb_cache.dat.test")
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        cachefile.update({"a.bb" : "a", "b.bb" : "b"}, [])
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        cachefile.load()
+        self.depends_cache = bb.cache.DependsCache([cachefile])
+
+    def tearDown(self):
+        self.depends_cache.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_lazy(self):
+        self.assertTrue("a.bb" in self.depends_cache)
+        self.assertEqual(self.depends_cache.loaded, {})
+        self.assertEqual(self.depends_cache["a.bb"], ["a"])
+        self.assertEqual(list(self.depends_cache.loaded), ["a.bb"])
+
+    def test_tracking(self):
+        info = self.depends_cache["a.bb"]
+        self.depends_cache["a.bb"] = info
+        self.assertEqual(self.depends_cache.changed, set())
+        self.depends_cache["c.bb"] = ["c"]
+        del self.depends_cache["b.bb"]
+        self.assertFalse("b.bb" in self.depends_cache)
+        self.assertEqual(self.depends_cache.changed, set(["c.bb"]))
+        self.assertEqual(self.depends_cache.removed, set(["b.bb"]))
+        self.assertEqual(sorted(self.depends_cache.keys()), ["a.bb", "c.bb"])
@@ -359,6 +359,64 @@ esac
 
         self.assertEquals(deps, set(["oe_libinstall"]))
 
+    def test_memoised_across_datastores(self):
+        self.d.setVar("CMD", "bar")
+        self.d.setVar("FOO", "${CMD} --opt\nbaz")
+        self.d.setVarFlag("FOO", "func", True)
+        self.setEmptyVars(["bar", "baz", "qux"])
+
+        deps, values = bb.data.build_dependencies("FOO", set(self.d.keys()), set(), set(), self.d)
+        self.assertEquals(deps, set(["CMD", "bar", "baz"]))
+
+        # Same function, same expansion
+        other = bb.data.createCopy(self.d)
+        deps, values = bb.data.build_dependencies("FOO", set(other.keys()), set(), set(), other)
+        self.assertEquals(deps, set(["CMD", "bar", "baz"]))
+
+        # A referenced variable now expands differently
+        other.setVar("CMD", "qux")
+        deps, values = bb.data.build_dependencies("FOO", set(other.keys()), set(), set(), other)
+        self.assertEquals(deps, set(["CMD", "qux", "baz"]))
+
+        # And back, which finds the first entry again
+        other.setVar("CMD", "bar")
+        deps, values = bb.data.build_dependencies("FOO", set(other.keys()), set(), set(), other)
+        self.assertEquals(deps, set(["CMD", "bar", "baz"]))
+
+    def test_memoised_arguments(self):
+        self.d.setVar("S", "/work/foo-1.0")
+        self.d.setVar("FOO", "cd ${S}\nbar ${S}/configure")
+        self.d.setVarFlag("FOO", "func", True)
+        self.setEmptyVars(["bar", "baz"])
+        h = hash("FOO\0False\0%s" % self.d.getVar("FOO", False))
+        deps, values = bb.data.build_dependencies("FOO", set(self.d.keys()), set(), set(), self.d)
+        self.assertEquals(deps, set(["S", "bar"]))
+
+        # A word only used as an argument can change without a new entry
+        other = bb.data.createCopy(self.d)
+        other.setVar("S", "/work/bar-2.0")
+        deps, values = bb.data.build_dependencies("FOO", set(other.keys()), set(), set(), other)
+        self.assertEquals(deps, set(["S", "bar"]))
+        self.assertEquals(len(list(bb.codeparser.codeparsercache.get_deps(h))), 1)
+
+        # but not to something which splits into more words
+        other.setVar("S", "/work/bar-2.0; baz")
+        deps, values = bb.data.build_dependencies("FOO", set(other.keys()), set(), set(), other)
+        self.assertEquals(deps, set(["S", "bar", "baz"]))
+
+    def test_memoised_merge(self):
+        cache = bb.codeparser.CodeParserCache()
+        first = {"lookups" : (("CMD", hash("bar")),), "refs" : set(["CMD"]),
+                 "execs" : set(["bar"]), "tabs" : False}
+        second = {"lookups" : (("CMD", hash("qux")),), "refs" : set(["CMD"]),
+                  "execs" : set(["qux"]), "tabs" : False}
+        data = cache.create_cachedata()
+        data[2][1] = [first]
+        extras = cache.create_cachedata()
+        extras[2][1] = [second, first]
+        cache.merge_data(extras, data)
+        self.assertEquals(data[2][1], [second, first])
+
     #Currently no wildcard support
     #def test_vardeps_wildcards(self):
     #    self.d.setVar("oe_libinstall", "echo test")
@@ -367,3 +425,38 @@ esac
     #    self.assertEquals(deps, set(["oe_libinstall"]))
 
 
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = bb.codeparser.CompileCache()
+
+    def test_roundtrip(self):
+        h, code = self.cache.get("x = 1\n", "test", "exec")
+        self.assertIsNone(code)
+        self.cache.add(h, compile("x = 1\n", "test", "exec"))
+
+        # A fresh process only has the marshalled copy
+        self.cache.codeobjects = {}
+        h2, code = self.cache.get("x = 1\n", "test", "exec")
+        self.assertEqual(h, h2)
+        context = {}
+        exec(code, context)
+        self.assertEqual(context["x"], 1)
+        self.assertEqual(code.co_filename, "test")
+
+    def test_name_in_key(self):
+        h, _ = self.cache.get("x = 1\n", "test", "exec")
+        self.cache.add(h, compile("x = 1\n", "test", "exec"))
+        _, code = self.cache.get("x = 1\n", "other", "exec")
+        self.assertIsNone(code)
+
+    def test_forked(self):
+        h, _ = self.cache.get("x = 1\n", "test", "exec")
+        self.cache.add(h, compile("x = 1\n", "test", "exec"))
+        self.cache.forked()
+
+        # A forked process keeps the inherited entry but doesn't save it
+        self.assertEqual(self.cache.codeextras, {})
+        self.cache.codeobjects = {}
+        _, code = self.cache.get("x = 1\n", "test", "exec")
+        self.assertIsNotNone(code)
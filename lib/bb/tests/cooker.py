@@ -0,0 +1,115 @@
+#
+# BitBake Tests for the cooker's file change tracking (cooker.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import bb
+import bb.cooker
+
+class GlobRootTest(unittest.TestCase):
+    def test_globroot(self):
+        self.assertEqual(bb.cooker.globroot("/layer/recipes-*/*/*.bb"), "/layer")
+        self.assertEqual(bb.cooker.globroot("/layer/recipes/a/a_1.0.bb"), "/layer/recipes/a")
+        self.assertEqual(bb.cooker.globroot("*.bb"), os.curdir)
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(bb.cooker.globroot(tempdir), tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+
+@unittest.skipIf(bb.cooker.pyinotify is None, "pyinotify is not available")
+class FileWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.layer = os.path.join(self.tempdir, "layer")
+        os.makedirs(os.path.join(self.layer, "recipes-a", "a"))
+        self.recipe = self.write("layer/recipes-a/a/a_1.0.bb")
+        self.include = self.write("include.inc")
+        self.watcher = bb.cooker.FileWatcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, path, data=""):
+        path = os.path.join(self.tempdir, path)
+        with open(path, "w") as f:
+            f.write(data)
+        return path
+
+    def test_files(self):
+        self.watcher.add_files([self.include])
+        self.write("unrelated")
+        self.assertEqual(self.watcher.changes(), (set(), False))
+        self.write("include.inc", "A = '1'")
+        self.assertEqual(self.watcher.changes(), (set([self.include]), False))
+        self.assertEqual(self.watcher.changes(), (set(), False))
+
+    def test_new_recipe_dir(self):
+        self.watcher.add_trees([bb.cooker.globroot(self.layer + "/recipes-*/*/*.bb")])
+        self.watcher.add_files([self.recipe])
+        self.assertEqual(self.watcher.trees, set([self.layer]))
+        self.assertEqual(self.watcher.dirs, set())
+
+        newdir = os.path.join(self.layer, "recipes-b", "b")
+        os.makedirs(newdir)
+        changed, overflow = self.watcher.changes()
+        self.assertTrue(os.path.join(self.layer, "recipes-b") in changed)
+
+        # The new directory is watched from now on
+        recipe = self.write("layer/recipes-b/b/b_1.0.bb")
+        self.write("layer/recipes-b/b/README")
+        self.assertEqual(self.watcher.changes(), (set([recipe]), False))
+
+    def test_moved_dir(self):
+        self.watcher.add_trees([self.layer])
+        os.makedirs(os.path.join(self.tempdir, "c"))
+        self.watcher.changes()
+        os.rename(os.path.join(self.tempdir, "c"), os.path.join(self.layer, "c"))
+        self.assertEqual(self.watcher.changes(), (set([os.path.join(self.layer, "c")]), False))
+        recipe = self.write("layer/c/c_1.0.bb")
+        self.assertEqual(self.watcher.changes(), (set([recipe]), False))
+
+    def test_ignored(self):
+        self.watcher.add_trees([self.layer])
+        os.makedirs(os.path.join(self.layer, ".git", "objects"))
+        self.watcher.changes()
+        self.write("layer/.git/objects/x.bb")
+        self.assertEqual(self.watcher.changes(), (set(), False))
+
+    def test_dirs(self):
+        self.watcher.add_dirs([os.path.join(self.layer, "recipes-a")])
+        os.makedirs(os.path.join(self.layer, "recipes-a", "b"))
+        self.watcher.changes()
+        self.write("layer/recipes-a/b/b_1.0.bb")
+        self.assertEqual(self.watcher.changes(), (set(), False))
+        recipe = self.write("layer/recipes-a/c_1.0.bb")
+        self.assertEqual(self.watcher.changes(), (set([recipe]), False))
+
+    def test_failed(self):
+        self.watcher.add_files([self.include])
+        self.assertFalse(self.watcher.failed)
+        # pyinotify logs the failure itself
+        log = logging.getLogger("pyinotify")
+        log.disabled = True
+        try:
+            self.watcher.add_files([os.path.join(self.tempdir, "missing", "x.inc")])
+        finally:
+            log.disabled = False
+        self.assertTrue(self.watcher.failed)
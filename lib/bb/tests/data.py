@@ -186,6 +186,48 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(d.getVar("foo"),
                          d.getVar("bar"))
 
+class TestExpandCache(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "${FOO}bar")
+        self.d.setVar("BAZ", "${BAR}baz")
+
+    def test_indirect_change(self):
+        self.assertEqual(self.d.getVar("BAZ", True), "foobarbaz")
+        self.d.setVar("FOO", "oof")
+        self.assertEqual(self.d.getVar("BAZ", True), "oofbarbaz")
+
+    def test_unrelated_change(self):
+        self.assertEqual(self.d.getVar("BAZ", True), "foobarbaz")
+        self.d.setVar("OTHER", "value")
+        self.assertTrue("BAZ" in self.d.expand_cache)
+
+    def test_undefined_becomes_defined(self):
+        self.d.setVar("TEST", "${UNDEFINED}")
+        self.assertEqual(self.d.getVar("TEST", True), "${UNDEFINED}")
+        self.d.setVar("UNDEFINED", "now")
+        self.assertEqual(self.d.getVar("TEST", True), "now")
+
+    def test_weak_default(self):
+        self.d.setVar("TEST", "${WEAK}")
+        self.assertEqual(self.d.getVar("TEST", True), "${WEAK}")
+        self.d.setVarFlag("WEAK", "defaultval", "weak")
+        self.assertEqual(self.d.getVar("TEST", True), "weak")
+
+    def test_deletion(self):
+        self.assertEqual(self.d.getVar("BAZ", True), "foobarbaz")
+        self.d.delVar("FOO")
+        self.assertEqual(self.d.getVar("BAZ", True), "${FOO}barbaz")
+
+    def test_python_volatile(self):
+        self.d.setVar("PY", "${@d.getVar('HIDDEN', True)}")
+        self.d.setVar("TEST", "${PY}x")
+        self.d.setVar("HIDDEN", "one")
+        self.assertEqual(self.d.getVar("TEST", True), "onex")
+        self.d.setVar("HIDDEN", "two")
+        self.assertEqual(self.d.getVar("TEST", True), "twox")
+
 class TestConcat(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -232,6 +274,18 @@ class TestOverrides(unittest.TestCase):
         bb.data.update_data(self.d)
         self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
 
+    def test_conditional_appends(self):
+        self.d.setVar("TEST_append", " a1")
+        self.d.setVar("TEST_append_foo", " a2")
+        self.d.setVar("TEST_append_foo_bar", " a3")
+        self.d.setVar("TEST_append_foo_other", " a4")
+        self.d.setVar("TEST_prepend_bar", "p1 ")
+        self.d.setVar("TEST_prepend", "p2 ")
+        bb.data.update_data(self.d)
+        self.assertEqual(self.d.getVar("TEST", True), "p2 p1 testvalue a1 a2 a3")
+        self.assertEqual(self.d.getVarFlag("TEST", "_append"), [(" a4", "foo_other")])
+        self.assertEqual(self.d.getVarFlag("TEST", "_prepend"), None)
+
 
 class TestFlags(unittest.TestCase):
     def setUp(self):
@@ -249,4 +303,55 @@ class TestFlags(unittest.TestCase):
         self.assertEqual(self.d.getVarFlag("foo", "flag1"), "value of flag1")
         self.assertEqual(self.d.getVarFlag("foo", "flag2"), None)
 
+    def test_weak_default(self):
+        self.d.setVarFlag("bar", "defaultval", "weak")
+        self.assertEqual(self.d.getVar("bar"), "weak")
+        self.assertEqual(self.d.getVar("bar", noweakdefault=True), None)
+        self.d.setVar("bar", "strong")
+        self.assertEqual(self.d.getVar("bar"), "strong")
+        self.d.delVarFlag("bar", "defaultval")
+        self.assertEqual(self.d.getVarFlags("bar"), None)
+        self.assertEqual(self.d.getVar("bar"), "strong")
+
+    def test_getflags(self):
+        self.d.setVarFlag("foo", "export", "1")
+        self.assertEqual(self.d.getVarFlags("foo"),
+                         {"export" : "1", "flag1" : "value of flag1",
+                          "flag2" : "value of flag2"})
+
+    def test_copy_flags(self):
+        copy = bb.data.createCopy(self.d)
+        copy.setVarFlag("foo", "flag1", "copied flag1")
+        copy.setVarFlag("foo", "export", "1")
+        copy.delVarFlag("foo", "flag2")
+        self.assertEqual(copy.getVarFlag("foo", "flag1"), "copied flag1")
+        self.assertEqual(copy.getVarFlag("foo", "flag2"), None)
+        self.assertEqual(self.d.getVarFlag("foo", "flag1"), "value of flag1")
+        self.assertEqual(self.d.getVarFlag("foo", "flag2"), "value of flag2")
+        self.assertEqual(self.d.getVarFlag("foo", "export"), None)
+        self.assertEqual(copy.getVar("foo"), "value of foo")
+
+
+
+class TestCopyKeys(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("foo", "value of foo")
+        self.copy = bb.data.createCopy(self.d)
+        self.copy.setVar("bar", "value of bar")
+        self.deep = bb.data.createCopy(self.copy)
 
+    def test_keys(self):
+        self.assertEqual(sorted(self.deep.keys()), ["bar", "foo"])
+        self.assertEqual(len(self.deep), 2)
+
+    def test_override_in_copy(self):
+        self.deep.setVar("foo", "another value")
+        self.assertEqual(sorted(self.deep.keys()), ["bar", "foo"])
+
+    def test_parent_changed(self):
+        self.assertEqual(sorted(self.deep.keys()), ["bar", "foo"])
+        self.d.setVar("baz", "value of baz")
+        self.copy.setVar("qux", "value of qux")
+        self.assertEqual(sorted(self.deep.keys()), ["bar", "baz", "foo", "qux"])
+        self.assertEqual(sorted(self.d.keys()), ["baz", "foo"])
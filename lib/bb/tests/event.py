@@ -0,0 +1,195 @@
+#
+# BitBake Tests for the event dispatch (event.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import select
+import unittest
+import pickle
+import logging
+import socket
+import bb
+import bb.event
+import bb.ui.uievent
+import bb.server.xmlrpc
+
+class WritesRecorder(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+class EventQueue(object):
+    def __init__(self):
+        self.events = []
+
+    def send(self, event):
+        self.events.append(event)
+
+class UIHandler(object):
+    def __init__(self):
+        self.event = EventQueue()
+
+class EventChannelServer(object):
+    flush_events = bb.server.xmlrpc.BitBakeXMLRPCServer.flush_events.im_func
+
+class EventMaskTest(unittest.TestCase):
+    def setUp(self):
+        self.handlers = bb.event._handlers.copy()
+        self.ui_handlers = bb.event._ui_handlers.copy()
+        bb.event._handlers.clear()
+        bb.event._ui_handlers.clear()
+        bb.event._handler_map.clear()
+        bb.event._ui_handler_map.clear()
+        self.seen = []
+
+    def tearDown(self):
+        bb.event._handlers.clear()
+        bb.event._handlers.update(self.handlers)
+        bb.event._ui_handlers.clear()
+        bb.event._ui_handlers.update(self.ui_handlers)
+        bb.event._handler_masks.clear()
+        bb.event._ui_handler_masks.clear()
+        bb.event._handler_map.clear()
+        bb.event._ui_handler_map.clear()
+
+    def handler(self, name):
+        return lambda e: self.seen.append((name, e.__class__.__name__))
+
+    def test_class_handlers(self):
+        bb.event.register("all", self.handler("all"))
+        bb.event.register("build", self.handler("build"), ["bb.event.BuildBase"])
+        bb.event.register("parse", self.handler("parse"), ["bb.event.ParseStarted"])
+        bb.event.fire_class_handlers(bb.event.BuildStarted("world", []), None)
+        bb.event.fire_class_handlers(bb.event.ParseStarted(1), None)
+        self.assertEqual(self.seen, [("all", "BuildStarted"), ("build", "BuildStarted"),
+                                     ("all", "ParseStarted"), ("parse", "ParseStarted")])
+
+        bb.event.remove("all", None)
+        del self.seen[:]
+        bb.event.fire_class_handlers(bb.event.BuildCompleted(1, "world", []), None)
+        self.assertEqual(self.seen, [("build", "BuildCompleted")])
+
+    def test_restore_handlers(self):
+        bb.event.register("build", self.handler("build"), ["bb.event.BuildBase"])
+        saved = bb.event.get_handlers()
+        bb.event.fire_class_handlers(bb.event.BuildStarted("world", []), None)
+        bb.event.register("recipe", self.handler("recipe"))
+        bb.event.set_handlers(saved)
+        bb.event.fire_class_handlers(bb.event.ParseStarted(1), None)
+        bb.event.fire_class_handlers(bb.event.BuildCompleted(1, "world", []), None)
+        self.assertEqual(self.seen, [("build", "BuildStarted"), ("build", "BuildCompleted")])
+
+    def test_ui_handlers(self):
+        allui = UIHandler()
+        buildui = UIHandler()
+        bb.event.register_UIHhandler(allui)
+        handle = bb.event.register_UIHhandler(buildui, ["bb.event.BuildBase"])
+        bb.event.fire_ui_handlers(bb.event.ParseStarted(1), None)
+        bb.event.fire_ui_handlers(bb.event.BuildStarted("world", []), None)
+        self.assertEqual([e.__class__.__name__ for e in allui.event.events], ["ParseStarted", "BuildStarted"])
+        self.assertEqual([e.__class__.__name__ for e in buildui.event.events], ["BuildStarted"])
+
+        bb.event.set_UIHmask(handle, None)
+        bb.event.fire_ui_handlers(bb.event.ParseStarted(1), None)
+        self.assertEqual([e.__class__.__name__ for e in buildui.event.events], ["BuildStarted", "ParseStarted"])
+
+class WorkerLogLevelsTest(unittest.TestCase):
+    def setUp(self):
+        self.loglevels = bb.event._ui_handler_loglevels.copy()
+        bb.event._ui_handler_loglevels.clear()
+        bb.event.LogHandler.workerfilter = None
+
+    def tearDown(self):
+        bb.event._ui_handler_loglevels.clear()
+        bb.event._ui_handler_loglevels.update(self.loglevels)
+        bb.event.LogHandler.workerfilter = None
+
+    def test_loglevels(self):
+        self.assertEqual(bb.event.worker_loglevels(), bb.msg.defaultLogLevels())
+        bb.event.set_UIHloglevels(1, logging.INFO, {"BitBake.Fetcher" : logging.DEBUG})
+        bb.event.set_UIHloglevels(2, logging.DEBUG, {"BitBake.Fetcher" : logging.DEBUG - 1,
+                                                     "BitBake.Parsing" : logging.DEBUG})
+        self.assertEqual(bb.event.worker_loglevels(),
+                         (logging.DEBUG, {"BitBake.Fetcher" : logging.DEBUG - 1,
+                                          "BitBake.Parsing" : logging.DEBUG}))
+        bb.event.LogHandler.workerfilter = bb.msg.BBLogFilter(None, *bb.event.worker_loglevels())
+        bb.event.set_UIHloglevels(2, logging.WARNING, {})
+        self.assertEqual(bb.event.LogHandler.workerfilter, None)
+        self.assertEqual(bb.event.worker_loglevels(),
+                         (logging.INFO, {"BitBake.Fetcher" : logging.DEBUG}))
+
+class EventBatchTest(unittest.TestCase):
+    def test_batches(self):
+        events = [bb.event.ParseStarted(i) for i in xrange(100)]
+        pickled = [pickle.dumps(event) for event in events]
+        for compress in (False, True):
+            batch = bb.ui.uievent.encode_batch(pickled, compress)
+            kind, length = bb.ui.uievent.batchheader.unpack_from(batch)
+            self.assertEqual(length, len(batch) - bb.ui.uievent.batchheader.size)
+            decoded = bb.ui.uievent.decode_batch(kind, batch[bb.ui.uievent.batchheader.size:])
+            self.assertEqual([event.total for event in decoded], range(100))
+
+    def test_worker_flush(self):
+        record = logging.LogRecord("BitBake", logging.INFO, __file__, 1, "x" * 1000, None, None)
+        pipe = WritesRecorder()
+        bb.event.worker_pid = os.getpid()
+        bb.event.worker_pipe = pipe
+        try:
+            for i in xrange(20):
+                bb.event.worker_fire(record, None)
+            bb.event.worker_flush()
+        finally:
+            bb.event.worker_pid = 0
+            bb.event.worker_pipe = None
+
+        # Written in whole frames, each write no larger than PIPE_BUF
+        self.assertTrue(len(pipe.writes) > 1)
+        frames = 0
+        for write in pipe.writes:
+            self.assertTrue(len(write) <= select.PIPE_BUF)
+            while write:
+                kind, length = bb.event.worker_frame.unpack_from(write)
+                write = write[bb.event.worker_frame.size + length:]
+                frames += 1
+        self.assertEqual(frames, 20)
+
+    def test_dead_channel(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        channel = bb.server.xmlrpc.BBUIEventChannel(*listener.getsockname())
+        conn, _ = listener.accept()
+        conn.close()
+        listener.close()
+
+        handlerNum = bb.event.register_UIHhandler(channel)
+        server = EventChannelServer()
+        server.event_channels = {handlerNum : channel}
+        event = pickle.dumps(bb.event.ParseStarted(1))
+        try:
+            while not channel.dead:
+                channel.sendpickle(event * 1000)
+                channel.flush()
+            # Events for the UI are dropped until the server reaps it
+            channel.sendpickle(event)
+            self.assertEqual(channel.pending, [])
+            server.flush_events()
+            self.assertEqual(server.event_channels, {})
+            self.assertFalse(handlerNum in bb.event._ui_handlers)
+        finally:
+            bb.event.unregister_UIHhandler(handlerNum)
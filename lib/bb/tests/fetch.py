@@ -168,6 +168,17 @@ class FetcherTest(unittest.TestCase):
         uris, uds = bb.fetch2.build_mirroruris(fetcher, mirrors, self.d)
         self.assertEqual(uris, ['file:///someotherpath/downloads/bitbake-1.0.tar.gz'])
 
+    def test_prefetch_file_checksums(self):
+        filelists = []
+        for i in range(4):
+            f = os.path.join(self.tempdir, "file%d" % i)
+            with open(f, "w") as fobj:
+                fobj.write("contents %d" % i)
+            filelists.append((f, "pn%d" % i))
+        bb.fetch2.prefetch_file_checksums(filelists, 4)
+        for f, pn in filelists:
+            self.assertEqual(bb.fetch2.get_file_checksums(f, pn), [(f, bb.utils.md5_file(f))])
+
 
 class URLHandle(unittest.TestCase):
 
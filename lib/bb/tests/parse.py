@@ -0,0 +1,137 @@
+#
+# BitBake Tests for the recipe parser (parse/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import bb
+import bb.cache
+import bb.data
+import bb.parse
+
+classes = {
+    "first" : """
+DEPENDS ?= "first-native"
+CFLAGS += "-O2"
+CFLAGS[doc] = "Compiler flags"
+EXTRA_append = " first"
+do_compile () {
+    oe_runmake ${CFLAGS}
+}
+do_compile[dirs] = "${B}"
+""",
+    "second" : """
+inherit first
+SUMMARY ?= "${PN} from second"
+python do_second () {
+    bb.note(d.getVar("PN", True))
+}
+addtask second after do_compile
+""",
+    "appends" : """
+__BBAPPEND += "${TOPDIR}/extra.bbappend"
+""",
+}
+
+recipes = {
+    "one_1.0.bb" : """
+inherit second
+DEPENDS = "zlib"
+CFLAGS = "-g"
+EXTRA = "one"
+""",
+    "two_1.0.bb" : """
+inherit second
+inherit first
+EXTRA = "two"
+""",
+    "three_1.0.bb" : """
+inherit appends
+""",
+}
+
+class InheritSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        # Parsing needs a working directory, which other tests may remove
+        os.chdir(self.tempdir)
+        os.mkdir(os.path.join(self.tempdir, "classes"))
+        for name, content in classes.items():
+            self.write(os.path.join("classes", name + ".bbclass"), content)
+        for name, content in recipes.items():
+            self.write(name, content)
+        self.write("one_1.0.bbappend", 'DEPENDS += "bzip2"\n')
+        self.write("three_1.0.bbappend", 'EXTRA = "three"\n')
+        self.write("extra.bbappend", 'EXTRA += "extra"\n')
+
+        self.d = bb.data.init()
+        self.d.setVar("BBPATH", self.tempdir)
+        self.d.setVar("TOPDIR", self.tempdir)
+        self.d.setVar("B", "${WORKDIR}/build")
+        self.d.setVar("OVERRIDES", "")
+        self.d.setVar("PN", "${@bb.parse.BBHandler.vars_from_file(d.getVar('FILE'),d)[0]}")
+        bb.parse.init_parser(self.d)
+        bb.parse.BBHandler.inherit_snapshots.clear()
+
+    def tearDown(self):
+        bb.parse.BBHandler.inherit_snapshots.clear()
+        bb.parse.BBHandler.cached_statements.clear()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.tempdir, name), "w") as f:
+            f.write(content)
+
+    def environment(self, recipe, snapshot):
+        if snapshot:
+            self.d.setVar("BB_PARSE_SNAPSHOT_INHERITS", "1")
+        else:
+            self.d.delVar("BB_PARSE_SNAPSHOT_INHERITS")
+        fn = os.path.join(self.tempdir, recipe)
+        appends = []
+        if os.path.exists(fn + "append"):
+            appends.append(fn + "append")
+        datastores = bb.cache.Cache.load_bbfile(fn, appends, self.d)
+        # As bitbake -e shows it, in a stable order and without the switch
+        d = datastores[""]
+        env = StringIO()
+        for var in sorted(d.keys()):
+            if var != "BB_PARSE_SNAPSHOT_INHERITS":
+                bb.data.emit_var(var, env, d, True)
+        return env.getvalue()
+
+    def test_equivalent(self):
+        for recipe in ("one_1.0.bb", "two_1.0.bb", "one_1.0.bb"):
+            self.assertEqual(self.environment(recipe, True), self.environment(recipe, False))
+        keys = bb.parse.BBHandler.inherit_snapshots.keys()
+        self.assertEqual(len(keys), 2)
+        self.assertTrue(all(bb.parse.BBHandler.inherit_snapshots[key] for key in keys))
+
+    def test_precedence(self):
+        env = self.environment("one_1.0.bb", True)
+        self.assertTrue('DEPENDS="zlib bzip2"' in env)
+        self.assertTrue('CFLAGS="-g"' in env)
+        self.assertTrue('EXTRA="one first"' in env)
+        self.assertTrue('SUMMARY="one from second"' in env)
+
+    def test_sets_local(self):
+        # The class sets a variable the recipe's datastore already has, so
+        # no snapshot can be used
+        self.assertEqual(self.environment("three_1.0.bb", True), self.environment("three_1.0.bb", False))
+        self.assertEqual(bb.parse.BBHandler.inherit_snapshots.values(), [False])
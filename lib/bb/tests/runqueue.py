@@ -0,0 +1,314 @@
+#
+# BitBake Tests for the runqueue schedulers (runqueue.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import random
+import logging
+import unittest
+import pickle
+import select
+import time
+import bb
+import bb.build
+import bb.runqueue
+
+class FakeRunQueueData(object):
+    def __init__(self, weights, fnids):
+        self.runq_weight = weights
+        self.runq_fnid = fnids
+
+class StubRunQueue(object):
+    cfgData = None
+    sigchld_pipe = None
+
+class StubWorkerPool(bb.runqueue.RunQueueWorkerPool):
+    """
+    A pool whose workers report the task number as the exit code of each
+    task, rather than parsing recipes and forking tasks off
+    """
+    def worker(self, cmdin, pipeout):
+        for cmd, pipe in self.workers.itervalues():
+            cmd.close()
+            pipe.input.close()
+        self.workers = {}
+        while True:
+            try:
+                fn, task, taskname, quieterrors = pickle.load(cmdin)
+            except EOFError:
+                break
+            if taskname == "do_crash":
+                os._exit(1)
+            elif taskname == "do_hang":
+                time.sleep(60)
+            self.exited(pipeout, task)
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.weights = [random.randint(1, 20) for i in xrange(500)]
+        self.fnids = [random.randint(0, 40) for i in xrange(500)]
+        self.rqdata = FakeRunQueueData(self.weights, self.fnids)
+
+    def speed_order(self):
+        # The order as the scheduler originally computed it
+        sortweight = sorted(self.weights)
+        copyweight = list(self.weights)
+        prio_map = []
+        for weight in sortweight:
+            idx = copyweight.index(weight)
+            prio_map.append(idx)
+            copyweight[idx] = -1
+        prio_map.reverse()
+        return prio_map
+
+    def test_speed(self):
+        sched = bb.runqueue.RunQueueSchedulerSpeed(None, self.rqdata)
+        self.assertEqual(sched.prio_map, self.speed_order())
+
+    def test_completion(self):
+        basemap = self.speed_order()
+        prio_map = []
+        while basemap:
+            entry = basemap.pop(0)
+            prio_map.append(entry)
+            fnid = self.fnids[entry]
+            rest = [task for task in basemap if self.fnids[task] == fnid]
+            prio_map.extend(rest)
+            basemap = [task for task in basemap if self.fnids[task] != fnid]
+
+        sched = bb.runqueue.RunQueueSchedulerCompletion(None, self.rqdata)
+        self.assertEqual(sched.prio_map, prio_map)
+
+class FakeTaskData(object):
+    def __init__(self, fns):
+        self.fn_index = fns
+
+class FakeRunQueue(object):
+    def __init__(self, numtasks):
+        self.runq_running = [0] * numtasks
+        self.build_stamps_running = set()
+
+class ReadyQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.rqdata = FakeRunQueueData([3, 1, 2, 5], [0, 0, 1, 1])
+        self.rqdata.runq_task = ["do_a", "do_b", "do_a", "do_b"]
+        self.rqdata.taskData = FakeTaskData(["one.bb", "two.bb"])
+        self.rqdata.dataCache = None
+        self.rq = FakeRunQueue(4)
+        self.stampfile = bb.build.stampfile
+        bb.build.stampfile = lambda taskname, d, fn: fn + "." + taskname
+
+    def tearDown(self):
+        bb.build.stampfile = self.stampfile
+
+    def test_priority_order(self):
+        sched = bb.runqueue.RunQueueSchedulerSpeed(self.rq, self.rqdata)
+        self.assertEqual(sched.next_buildable_task(), None)
+        for task in (1, 2, 0):
+            sched.newbuildable(task)
+        self.assertEqual(sched.next_buildable_task(), 0)
+        sched.newbuildable(3)
+        self.assertEqual(sched.next_buildable_task(), 3)
+        self.assertEqual(sched.next_buildable_task(), 2)
+        self.assertEqual(sched.next_buildable_task(), 1)
+        self.assertEqual(sched.next_buildable_task(), None)
+
+    def test_running_stamp(self):
+        sched = bb.runqueue.RunQueueSchedulerSpeed(self.rq, self.rqdata)
+        for task in (0, 2):
+            sched.newbuildable(task)
+        self.rq.build_stamps_running.add("one.bb.do_a")
+        self.assertEqual(sched.next_buildable_task(), 2)
+        self.assertEqual(sched.next_buildable_task(), None)
+        self.rq.build_stamps_running.clear()
+        self.assertEqual(sched.next_buildable_task(), 0)
+
+class WorkerPipeTest(unittest.TestCase):
+    def setUp(self):
+        self.fired = []
+        self.fire_from_worker = bb.event.fire_from_worker
+        bb.event.fire_from_worker = lambda event, d: self.fired.append(event)
+
+    def tearDown(self):
+        bb.event.fire_from_worker = self.fire_from_worker
+
+    def frame(self, kind, data):
+        return bb.event.worker_frame.pack(kind, len(data)) + data
+
+    def test_exitcodes(self):
+        pipein, pipeout = os.pipe()
+        pipein = os.fdopen(pipein, 'rb')
+        writer = os.fdopen(os.dup(pipeout), 'wb', 0)
+        pipe = bb.runqueue.runQueueWorkerPipe(pipein, os.fdopen(pipeout, 'wb'), None)
+        two = self.frame("e", "two")
+        writer.write(self.frame("e", "one") + self.frame("x", "0") + two[:5])
+        pipe.read()
+        self.assertEqual(self.fired, ["one"])
+        self.assertEqual(pipe.exitcodes, [0])
+        writer.write(two[5:] + self.frame("x", "130"))
+        pipe.read()
+        self.assertEqual(self.fired, ["one", "two"])
+        self.assertEqual(pipe.exitcodes, [0, 130])
+        writer.close()
+        pipe.close()
+
+    def test_large_events(self):
+        pipein, pipeout = os.pipe()
+        pipein = os.fdopen(pipein, 'rb')
+        writer = os.fdopen(os.dup(pipeout), 'wb', 0)
+        pipe = bb.runqueue.runQueuePipe(pipein, os.fdopen(pipeout, 'wb'), None)
+        # Larger than the pipe's buffer, and containing what used to end an event
+        events = ["%d</event>" % i * 30000 for i in xrange(4)]
+        for event in events:
+            data = self.frame("e", event)
+            for i in xrange(0, len(data), 8192):
+                writer.write(data[i:i+8192])
+                pipe.read()
+        writer.close()
+        pipe.close()
+        self.assertEqual(self.fired, events)
+
+    def test_garbled(self):
+        pipein, pipeout = os.pipe()
+        pipein = os.fdopen(pipein, 'rb')
+        writer = os.fdopen(os.dup(pipeout), 'wb', 0)
+        pipe = bb.runqueue.runQueuePipe(pipein, os.fdopen(pipeout, 'wb'), None)
+        logger = logging.getLogger("BitBake.RunQueue")
+        logger.disabled = True
+        try:
+            writer.write(self.frame("e", "one") + "garbage" + self.frame("e", "two"))
+            pipe.read()
+            self.assertTrue(pipe.garbled)
+            self.assertEqual(self.fired, ["one"])
+
+            # The rest of the stream is read and dropped
+            size = len(pipe.queue)
+            for i in xrange(10):
+                writer.write(self.frame("e", "x" * 8192))
+                pipe.read()
+            self.assertEqual(self.fired, ["one"])
+            self.assertEqual(len(pipe.queue), size)
+        finally:
+            logger.disabled = False
+            writer.close()
+            pipe.close()
+
+    def test_log_batching(self):
+        pipein, pipeout = os.pipe()
+        pipein = os.fdopen(pipein, 'rb')
+        writer = os.fdopen(os.dup(pipeout), 'wb', 0)
+        pipe = bb.runqueue.runQueuePipe(pipein, os.fdopen(pipeout, 'wb'), None)
+        bb.event.worker_pid = os.getpid()
+        bb.event.worker_pipe = writer
+        logger = logging.getLogger("BitBake.Test")
+        logger.propagate = False
+        handler = bb.event.LogHandler()
+        logger.addHandler(handler)
+        try:
+            logger.debug(1, "debug")
+            logger.info("note one")
+            logger.info("note two")
+            pipe.read()
+            self.assertEqual(self.fired, [])
+            logger.warn("warning")
+            pipe.read()
+            messages = [pickle.loads(event).getMessage() for event in self.fired]
+            self.assertEqual(messages, ["note one", "note two", "warning"])
+        finally:
+            bb.event.worker_pid = 0
+            bb.event.worker_pipe = None
+            logger.removeHandler(handler)
+            writer.close()
+            pipe.close()
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = StubWorkerPool(StubRunQueue(), 2, 2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def wait(self):
+        exited = []
+        while not exited:
+            ready = select.select(self.pool.wait_fds(), [], [], 10)[0]
+            self.assertTrue(ready, "No task finished")
+            exited = self.pool.read()
+        return exited
+
+    def test_loaded_worker(self):
+        a = self.pool.start("a.bb", 1, "do_a", False)
+        self.assertEqual(self.wait(), [(a, 1)])
+        # There is room for another worker, but a has the recipe already
+        self.assertEqual(self.pool.start("a.bb", 2, "do_a", False), a)
+        self.assertEqual(self.wait(), [(a, 2)])
+        b = self.pool.start("b.bb", 3, "do_b", False)
+        self.assertNotEqual(a, b)
+        self.assertEqual(self.wait(), [(b, 3)])
+        self.assertEqual(self.pool.start("b.bb", 4, "do_b", False), b)
+        self.assertEqual(self.pool.start("a.bb", 5, "do_a", False), a)
+        self.assertEqual(self.pool.loaded, {a : ["a.bb"], b : ["b.bb"]})
+
+    def test_busy(self):
+        a = self.pool.start("a.bb", 1, "do_hang", False)
+        b = self.pool.start("b.bb", 2, "do_hang", False)
+        self.assertEqual(len(self.pool.workers), 2)
+        self.assertEqual(self.pool.idle, set())
+        logger = logging.getLogger("BitBake.RunQueue")
+        logger.disabled = True
+        try:
+            self.assertRaises(SystemExit, self.pool.start, "c.bb", 3, "do_c", False)
+        finally:
+            logger.disabled = False
+
+    def test_idle(self):
+        a = self.pool.start("a.bb", 1, "do_a", False)
+        self.assertEqual(self.pool.idle, set())
+        self.assertEqual(self.wait(), [(a, 1)])
+        self.assertEqual(self.pool.idle, set([a]))
+        # A worker is reused for another recipe once the pool is full
+        b = self.pool.start("b.bb", 2, "do_b", False)
+        c = self.pool.start("c.bb", 3, "do_c", False)
+        self.assertNotEqual(b, a)
+        self.assertEqual(c, a)
+        self.assertEqual(self.pool.loaded[a], ["a.bb", "c.bb"])
+
+    def test_worker_exited(self):
+        a = self.pool.start("a.bb", 1, "do_crash", False)
+        os.waitpid(a, 0)
+        # Nothing to report, so the task is failed as the worker's own
+        self.assertEqual(self.pool.worker_exited(a), [])
+        self.assertFalse(a in self.pool.workers)
+        self.assertFalse(a in self.pool.loaded)
+
+        b = self.pool.start("b.bb", 2, "do_b", False)
+        self.pool.workers[b][0].close()
+        os.waitpid(b, 0)
+        # The exit code was written but never read
+        self.assertEqual(self.pool.worker_exited(b), [(b, 2)])
+        self.assertEqual(self.pool.workers, {})
+
+    def test_shutdown(self):
+        a = self.pool.start("a.bb", 1, "do_a", False)
+        self.wait()
+        b = self.pool.start("b.bb", 2, "do_hang", False)
+        self.pool.shutdown()
+        self.assertEqual(self.pool.workers, {})
+        self.assertEqual(self.pool.idle, set())
+        # Both were reaped, the busy one after being terminated
+        for pid in (a, b):
+            self.assertRaises(OSError, os.waitpid, pid, os.WNOHANG)
@@ -249,6 +249,16 @@ def main(server, eventHandler, tf = TerminalFilter):
         consolelog.setFormatter(format)
         logger.addHandler(consolelog)
 
+    # Tasks needn't send the log records the filters above drop. Only set
+    # the levels for our own handler where it is known, as other UIs may be
+    # attached to an xmlrpc server, and the process server only has us.
+    level, debug_domains = bb.msg.defaultLogLevels()
+    handlerNum = getattr(eventHandler, "EventHandle", None)
+    _, error = server.runCommand(["setLogLevels", handlerNum, level, debug_domains])
+    if error:
+        logger.error("Unable to set the log levels of tasks: %s" % error)
+        return 1
+
     try:
         cmdline, error = server.runCommand(["getCmdLineAction"])
         if error:
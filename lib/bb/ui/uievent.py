@@ -24,18 +24,56 @@ server and queue them for the UI to process. This process must be used to avoid
 client/server deadlocks.
 """
 
-import socket, threading, pickle
-from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+import socket, threading, struct, zlib
+import collections
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# The server sends events in batches, each a one byte kind ("b" or "z" when
+# compressed with zlib) and the length of the batch, which is the length
+# and pickle of each event in turn
+batchheader = struct.Struct("!cI")
+eventheader = struct.Struct("!I")
+
+def encode_batch(events, compress=False):
+    """
+    Make a batch from a list of pickled events
+    """
+    data = "".join([eventheader.pack(len(event)) + event for event in events])
+    kind = "b"
+    if compress:
+        data = zlib.compress(data, 1)
+        kind = "z"
+    return batchheader.pack(kind, len(data)) + data
+
+def decode_batch(kind, data):
+    """
+    Return the events in a batch
+    """
+    if kind == "z":
+        data = zlib.decompress(data)
+    events = []
+    offset = 0
+    while offset < len(data):
+        length, = eventheader.unpack_from(data, offset)
+        offset += eventheader.size
+        events.append(pickle.loads(data[offset:offset+length]))
+        offset += length
+    return events
 
 class BBUIEventQueue:
-    def __init__(self, BBServer, clientinfo=("localhost, 0")):
+    def __init__(self, BBServer, clientinfo=("localhost", 0), compress=False):
 
-        self.eventQueue = []
+        self.eventQueue = collections.deque()
         self.eventQueueLock = threading.Lock()
         self.eventQueueNotify = threading.Event()
 
         self.BBServer = BBServer
         self.clientinfo = clientinfo
+        self.compress = compress
+        self.quit = False
 
         self.t = threading.Thread()
         self.t.setDaemon(True)
@@ -50,7 +88,7 @@ class BBUIEventQueue:
             self.eventQueueLock.release()
             return None
 
-        item = self.eventQueue.pop(0)
+        item = self.eventQueue.popleft()
 
         if len(self.eventQueue) == 0:
             self.eventQueueNotify.clear()
@@ -63,29 +101,66 @@ class BBUIEventQueue:
         return self.getEvent()
 
     def queue_event(self, event):
+        self.queue_events([event])
+
+    def queue_events(self, events):
         self.eventQueueLock.acquire()
-        self.eventQueue.append(event)
+        self.eventQueue.extend(events)
         self.eventQueueNotify.set()
         self.eventQueueLock.release()
 
-    def send_event(self, event):
-        self.queue_event(pickle.loads(event))
-
     def startCallbackHandler(self):
 
-        server = UIXMLRPCServer(self.clientinfo)
-        self.host, self.port = server.socket.getsockname()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(self.clientinfo)
+        listener.listen(1)
+        listener.settimeout(1)
+        self.host, self.port = listener.getsockname()
 
-        server.register_function( self.system_quit, "event.quit" )
-        server.register_function( self.send_event, "event.sendpickle" )
-        server.socket.settimeout(1)
+        # The server connects back to us before this returns
+        self.EventHandle = self.BBServer.registerEventChannel(self.host, self.port, self.compress)
 
-        self.EventHandle = self.BBServer.registerEventHandler(self.host, self.port)
+        connection = None
+        while not self.quit:
+            try:
+                connection, addr = listener.accept()
+                break
+            except socket.timeout:
+                pass
+        listener.close()
+        if connection is None:
+            return
 
-        self.server = server
-        while not server.quit:
-            server.handle_request()
-        server.server_close()
+        connection.settimeout(1)
+        while True:
+            header = self.receive(connection, batchheader.size)
+            if header is None:
+                break
+            kind, length = batchheader.unpack(header)
+            data = self.receive(connection, length)
+            if data is None:
+                break
+            self.queue_events(decode_batch(kind, data))
+        connection.close()
+
+    def receive(self, connection, size):
+        """
+        Read size bytes from the server, or return None if it has gone away
+        or we are quitting
+        """
+        chunks = []
+        while size > 0:
+            try:
+                chunk = connection.recv(min(size, 1048576))
+            except socket.timeout:
+                if self.quit:
+                    return None
+                continue
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
 
     def system_quit( self ):
         """
@@ -95,34 +170,4 @@ class BBUIEventQueue:
             self.BBServer.unregisterEventHandler(self.EventHandle)
         except:
             pass
-        self.server.quit = True
-
-class UIXMLRPCServer (SimpleXMLRPCServer):
-
-    def __init__( self, interface ):
-        self.quit = False
-        SimpleXMLRPCServer.__init__( self,
-                                    interface,
-                                    requestHandler=SimpleXMLRPCRequestHandler,
-                                    logRequests=False, allow_none=True)
-
-    def get_request(self):
-        while not self.quit:
-            try:
-                sock, addr = self.socket.accept()
-                sock.settimeout(1)
-                return (sock, addr)
-            except socket.timeout:
-                pass
-        return (None, None)
-
-    def close_request(self, request):
-        if request is None:
-            return
-        SimpleXMLRPCServer.close_request(self, request)
-
-    def process_request(self, request, client_address):
-        if request is None:
-            return
-        SimpleXMLRPCServer.process_request(self, request, client_address)
-
+        self.quit = True
@@ -248,10 +248,17 @@ def _print_trace(body, line):
 def better_compile(text, file, realfile, mode = "exec"):
     """
     A better compile method. This method
-    will print  the offending lines.
+    will print  the offending lines. Code objects are
+    shared through the codeparser compile cache.
     """
+    import bb.codeparser
+    h, code = bb.codeparser.compilecache.get(text, file, mode)
+    if code is not None:
+        return code
     try:
-        return compile(text, file, mode)
+        code = compile(text, file, mode)
+        bb.codeparser.compilecache.add(h, code)
+        return code
     except Exception as e:
         # split the text into lines again
         body = text.split('\n')
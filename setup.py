@@ -28,10 +28,13 @@ from distutils.core import setup
 
 
 doctype = "html"
+tablesfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib", "bb", "pysh", "pyshtables.pickle")
 
 class Clean(clean):
     def run(self):
         clean.run(self)
+        if os.path.exists(tablesfile):
+            os.unlink(tablesfile)
         origpath = os.path.abspath(os.curdir)
         os.chdir(os.path.join(origpath, 'doc', 'manual'))
         make = os.environ.get('MAKE') or 'make'
@@ -39,6 +42,9 @@ class Clean(clean):
 
 class Build(build):
     def run(self):
+        # Generate the shell parser tables so they are installed with it
+        import bb.pysh.pyshyacc
+        bb.pysh.pyshyacc.build_tables(tablesfile)
         build.run(self)
         origpath = os.path.abspath(os.curdir)
         os.chdir(os.path.join(origpath, 'doc', 'manual'))
@@ -55,6 +61,7 @@ setup(name='bitbake',
       package_dir = {"": "lib"},
       packages = ["bb.server", "bb.parse.parse_py", "bb.parse", 
                   "bb.fetch2", "bb.ui.crumbs", "bb.ui", "bb.pysh", "bb", "prserv", "bb.tests"],
+      package_data = {"bb.pysh": ["pyshtables.pickle"]},
       py_modules = ["codegen"],
       scripts = ["bin/bitbake", "bin/bitbake-layers", "bin/bitbake-diffsigs", "bin/bitbake-prserv", "bin/bitbake-selftest", "bin/image-writer"],
       data_files = [("share/bitbake", glob("conf/*") + glob("classes/*")),